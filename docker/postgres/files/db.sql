@@ -4,8 +4,9 @@
 -- Using for various hasing algorithms
 CREATE EXTENSION IF NOT EXISTS pgcrypto;
 
--- Used for checksum of asset bytes.
-CREATE OR REPLACE FUNCTION sha512(bytea) returns text AS $$
+-- Used for checksum of asset bytes. Schema-qualified, because since Postgres 11 pg_catalog has its own
+-- sha512(bytea) (returning bytea), which would otherwise be found first.
+CREATE OR REPLACE FUNCTION public.sha512(bytea) returns text AS $$
   SELECT encode(digest($1, 'sha512'), 'hex')
 $$ LANGUAGE SQL STRICT IMMUTABLE;
 
@@ -54,6 +55,9 @@ CREATE TABLE IF NOT EXISTS an_corpora (
 
 CREATE INDEX IF NOT EXISTS an_corpora_name ON an_corpora(name);
 
+-- Set once a corpus' Assignment partitions have been detached (see an_detach_corpus_partitions).
+ALTER TABLE an_corpora ADD COLUMN IF NOT EXISTS archived_on TIMESTAMPTZ;
+
 -- Primary asset table.
 CREATE TABLE IF NOT EXISTS an_assets (
   id                           BIGSERIAL PRIMARY KEY,
@@ -67,10 +71,32 @@ CREATE TABLE IF NOT EXISTS an_assets (
   type_description             TEXT        NOT NULL,
   corpus_id                    BIGINT      NOT NULL REFERENCES an_corpora (id),
   uploader_id                  BIGINT      NOT NULL REFERENCES an_users (id),
-  CHECK (sha512(content) = checksum),
   UNIQUE (name, corpus_id)
 );
 
+-- Gzipped copy of text assets' content, filled in by the process_asset job
+ALTER TABLE an_assets ADD COLUMN IF NOT EXISTS content_gzip BYTEA;
+
+-- Checksums are verified by the API as assets are uploaded, and re-verified in the background by the
+-- scrub_assets job (see jobs.py), rather than by a CHECK hashing every byte inside the insert.
+ALTER TABLE an_assets DROP CONSTRAINT IF EXISTS an_assets_check;
+ALTER TABLE an_assets ADD COLUMN IF NOT EXISTS last_verified TIMESTAMPTZ;
+-- Set by the scrubber when content no longer matches its checksum
+ALTER TABLE an_assets ADD COLUMN IF NOT EXISTS corrupted_on TIMESTAMPTZ;
+CREATE INDEX IF NOT EXISTS an_assets_corrupted_idx ON an_assets (id) WHERE corrupted_on IS NOT NULL;
+
+-- Assets in cloned corpora share the original's bytes: content_asset_id points at the Asset holding them,
+-- and content is left NULL (see CorpusController.clone_corpus).
+ALTER TABLE an_assets ADD COLUMN IF NOT EXISTS content_asset_id BIGINT REFERENCES an_assets (id);
+ALTER TABLE an_assets ALTER COLUMN content DROP NOT NULL;
+DO $$ BEGIN
+  ALTER TABLE an_assets ADD CONSTRAINT an_assets_content_check CHECK ((content IS NULL) != (content_asset_id IS NULL));
+  EXCEPTION
+    WHEN duplicate_object THEN null;
+END $$;
+CREATE INDEX IF NOT EXISTS an_assets_content_asset_id_idx ON an_assets (content_asset_id)
+  WHERE content_asset_id IS NOT NULL;
+
 CREATE TABLE IF NOT EXISTS an_annotations (
   id           BIGSERIAL PRIMARY KEY,
   source       AN_ANNOTATION_SOURCE_V1 NOT NULL,
@@ -109,8 +135,33 @@ CREATE TABLE IF NOT EXISTS an_assignments_old (
   corrected_annotation_id BIGINT REFERENCES an_annotations (id)
 );
 
+-- an_assignments, an_assignment_history and an_assignments_assets_xref are LIST partitioned by corpus_id,
+-- with one partition of each per corpus (see an_create_corpus_partitions). Queries which know the corpus
+-- only touch its partitions, and a finished campaign is archived by detaching them (see
+-- an_detach_corpus_partitions) rather than DELETEd, so indexes and vacuum only cover active work.
+
+-- Databases which pre-date partitioning have plain tables: move them (and their indexes) aside,
+-- so that their rows can be copied into the partitioned tables further down.
+DO $$
+DECLARE
+  t TEXT;
+  i RECORD;
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('public.an_assignments') AND relkind = 'r') THEN
+    FOREACH t IN ARRAY ARRAY ['an_assignments', 'an_assignment_history', 'an_assignments_assets_xref'] LOOP
+      FOR i IN SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = t LOOP
+        EXECUTE 'ALTER INDEX ' || quote_ident(i.indexname) || ' RENAME TO ' || quote_ident(i.indexname || '_legacy');
+      END LOOP;
+      EXECUTE 'ALTER TABLE ' || quote_ident(t) || ' RENAME TO ' || quote_ident(t || '_legacy');
+      -- Keep the sequences (and so the IDs already handed out) for the new tables
+      EXECUTE 'ALTER SEQUENCE ' || quote_ident(t || '_id_seq') || ' OWNED BY NONE';
+    END LOOP;
+  END IF;
+END $$;
+
+CREATE SEQUENCE IF NOT EXISTS an_assignments_id_seq;
 CREATE TABLE IF NOT EXISTS an_assignments (
-  id               BIGSERIAL   NOT NULL PRIMARY KEY,
+  id               BIGINT      NOT NULL DEFAULT nextval('an_assignments_id_seq'),
   summary_code     TEXT        NOT NULL,
   assigned_user_id BIGINT REFERENCES an_users (id),
   annotator_id     BIGINT      NOT NULL REFERENCES an_users (id),
@@ -123,23 +174,267 @@ CREATE TABLE IF NOT EXISTS an_assignments (
   response         JSONB,
   state            TEXT        NOT NULL DEFAULT 'created',
   CHECK (NOT ((state = 'approved') AND (response IS NULL))),
-  CHECK (NOT ((state != 'approved') AND (assigned_user_id IS NULL)))
-);
+  CHECK (NOT ((state != 'approved') AND (assigned_user_id IS NULL))),
+  -- The partition key has to be part of the primary key, but IDs are unique on their own.
+  PRIMARY KEY (id, corpus_id)
+) PARTITION BY LIST (corpus_id);
+ALTER SEQUENCE an_assignments_id_seq OWNED BY an_assignments.id;
 
+CREATE SEQUENCE IF NOT EXISTS an_assignment_history_id_seq;
 CREATE TABLE IF NOT EXISTS an_assignment_history (
-  id               BIGSERIAL PRIMARY KEY,
-  assignment_id    BIGINT      NOT NULL REFERENCES an_assignments (id),
+  id               BIGINT      NOT NULL DEFAULT nextval('an_assignment_history_id_seq'),
+  assignment_id    BIGINT      NOT NULL,
+  corpus_id        BIGINT      NOT NULL REFERENCES an_corpora (id),
   updating_user_id BIGINT      NOT NULL REFERENCES an_users (id),
   updated_on       TIMESTAMPTZ NOT NULL,
   state            TEXT        NOT NULL,
   notes            TEXT,
-  response         JSONB
-);
+  response         JSONB,
+  PRIMARY KEY (id, corpus_id),
+  FOREIGN KEY (assignment_id, corpus_id) REFERENCES an_assignments (id, corpus_id)
+) PARTITION BY LIST (corpus_id);
+ALTER SEQUENCE an_assignment_history_id_seq OWNED BY an_assignment_history.id;
 
+CREATE SEQUENCE IF NOT EXISTS an_assignments_assets_xref_id_seq;
 CREATE TABLE IF NOT EXISTS an_assignments_assets_xref (
-  id            BIGSERIAL PRIMARY KEY,
-  assignment_id BIGINT REFERENCES an_assignments (id),
-  asset_id      BIGINT REFERENCES an_assets (id)
+  id            BIGINT NOT NULL DEFAULT nextval('an_assignments_assets_xref_id_seq'),
+  assignment_id BIGINT NOT NULL,
+  corpus_id     BIGINT NOT NULL REFERENCES an_corpora (id),
+  asset_id      BIGINT REFERENCES an_assets (id),
+  PRIMARY KEY (id, corpus_id),
+  FOREIGN KEY (assignment_id, corpus_id) REFERENCES an_assignments (id, corpus_id)
+) PARTITION BY LIST (corpus_id);
+ALTER SEQUENCE an_assignments_assets_xref_id_seq OWNED BY an_assignments_assets_xref.id;
+
+-- Catches rows for corpora without partitions of their own (e.g. ones that have been archived).
+CREATE TABLE IF NOT EXISTS an_assignments_default PARTITION OF an_assignments DEFAULT;
+CREATE TABLE IF NOT EXISTS an_assignment_history_default PARTITION OF an_assignment_history DEFAULT;
+CREATE TABLE IF NOT EXISTS an_assignments_assets_xref_default PARTITION OF an_assignments_assets_xref DEFAULT;
+
+CREATE OR REPLACE FUNCTION an_create_corpus_partitions(corpus BIGINT) RETURNS VOID AS $$
+DECLARE
+  t TEXT;
+BEGIN
+  FOREACH t IN ARRAY ARRAY ['an_assignments', 'an_assignment_history', 'an_assignments_assets_xref'] LOOP
+    EXECUTE 'CREATE TABLE IF NOT EXISTS ' || quote_ident(t || '_c' || corpus) || ' PARTITION OF ' || quote_ident(t)
+              || ' FOR VALUES IN (' || corpus || ')';
+  END LOOP;
+END $$ LANGUAGE plpgsql;
+
+-- Archives a corpus' Assignments: its partitions become ordinary tables (an_assignments_c<id> etc.),
+-- which can be dumped and dropped at leisure.
+CREATE OR REPLACE FUNCTION an_detach_corpus_partitions(corpus BIGINT) RETURNS VOID AS $$
+DECLARE
+  t TEXT;
+  c RECORD;
+BEGIN
+  -- The referencing tables go first, and lose their copy of the foreign key to an_assignments,
+  -- since the Assignments partition can't be detached while anything still points into it.
+  FOREACH t IN ARRAY ARRAY ['an_assignment_history', 'an_assignments_assets_xref', 'an_assignments'] LOOP
+    EXECUTE 'ALTER TABLE ' || quote_ident(t) || ' DETACH PARTITION ' || quote_ident(t || '_c' || corpus);
+    FOR c IN SELECT conname FROM pg_constraint
+             WHERE conrelid = (t || '_c' || corpus)::regclass AND confrelid = 'an_assignments'::regclass LOOP
+      EXECUTE 'ALTER TABLE ' || quote_ident(t || '_c' || corpus) || ' DROP CONSTRAINT ' || quote_ident(c.conname);
+    END LOOP;
+  END LOOP;
+  UPDATE an_corpora SET archived_on = now() WHERE id = corpus;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION an_corpora_create_partitions() RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM an_create_corpus_partitions(NEW.id);
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DO $$ BEGIN
+  CREATE TRIGGER an_corpora_create_partitions AFTER INSERT ON an_corpora
+    FOR EACH ROW EXECUTE FUNCTION an_corpora_create_partitions();
+  EXCEPTION
+    WHEN duplicate_object THEN null;
+END $$;
+
+DO $$ BEGIN
+  PERFORM an_create_corpus_partitions(id) FROM an_corpora WHERE archived_on IS NULL;
+END $$;
+
+-- Finish moving pre-partitioning data across.
+DO $$ BEGIN
+  IF to_regclass('public.an_assignments_legacy') IS NOT NULL THEN
+    INSERT INTO an_assignments (id, summary_code, assigned_user_id, annotator_id, reviewer_id, corpus_id, created,
+                                updated, completed, question, response, state)
+      SELECT id, summary_code, assigned_user_id, annotator_id, reviewer_id, corpus_id, created,
+             updated, completed, question, response, state
+      FROM an_assignments_legacy;
+    INSERT INTO an_assignment_history (id, assignment_id, corpus_id, updating_user_id, updated_on, state, notes,
+                                       response)
+      SELECT h.id, h.assignment_id, a.corpus_id, h.updating_user_id, h.updated_on, h.state, h.notes, h.response
+      FROM an_assignment_history_legacy h JOIN an_assignments_legacy a ON a.id = h.assignment_id;
+    INSERT INTO an_assignments_assets_xref (id, assignment_id, corpus_id, asset_id)
+      SELECT x.id, x.assignment_id, a.corpus_id, x.asset_id
+      FROM an_assignments_assets_xref_legacy x JOIN an_assignments_legacy a ON a.id = x.assignment_id;
+    -- CASCADE also drops an_annotations' old foreign key into an_assignments_legacy
+    DROP TABLE an_assignments_assets_xref_legacy, an_assignment_history_legacy, an_assignments_legacy CASCADE;
+  END IF;
+END $$;
+
+-- Assignments made from one of their corpus' Questions refer to it by question_id rather than carrying
+-- a copy of it, so question is only filled in for ad-hoc ones (see AssignmentController.create_assigment).
+-- Existing copies are swapped for a reference the first time the column is added.
+CREATE INDEX IF NOT EXISTS an_questions_content_idx ON an_questions (corpus_id, md5(content::text));
+DO $$ BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'an_assignments' AND column_name = 'question_id') THEN
+    ALTER TABLE an_assignments ADD COLUMN question_id BIGINT REFERENCES an_questions (id);
+    ALTER TABLE an_assignments ALTER COLUMN question DROP NOT NULL;
+    ALTER TABLE an_assignments ADD CONSTRAINT an_assignments_question_check
+      CHECK ((question IS NULL) != (question_id IS NULL));
+    UPDATE an_assignments a SET question_id = q.id, question = NULL
+      FROM an_questions q
+      WHERE q.corpus_id = a.corpus_id AND md5(q.content::text) = md5(a.question::text) AND q.content = a.question;
+  END IF;
+END $$;
+CREATE INDEX IF NOT EXISTS an_assignments_question_id_idx ON an_assignments (question_id);
+-- Dense segmentations keep their boundaries and labels here rather than in response (see packing.py).
+ALTER TABLE an_assignments ADD COLUMN IF NOT EXISTS response_packed BYTEA;
+-- ...and their distinct labels here, so that the search trigger can see them.
+ALTER TABLE an_assignments ADD COLUMN IF NOT EXISTS response_labels TEXT[];
+
+-- Annotations are attached to the Asset they describe, and (for Human ones) the Assignment that produced them.
+ALTER TABLE an_annotations ADD COLUMN IF NOT EXISTS asset_id BIGINT REFERENCES an_assets (id);
+-- No foreign key for assignment_id: annotations outlive their Assignments' partitions being archived.
+ALTER TABLE an_annotations ADD COLUMN IF NOT EXISTS assignment_id BIGINT;
+ALTER TABLE an_annotations ADD COLUMN IF NOT EXISTS annotator_id BIGINT REFERENCES an_users (id);
+
+CREATE INDEX IF NOT EXISTS an_annotations_asset_summary_code_idx ON an_annotations (asset_id, summary_code, source);
+
+-- Durable queue for work that shouldn't happen inside a request (checksums, MIME sniffing, derivatives).
+-- Workers claim rows with SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can share the table.
+CREATE TABLE IF NOT EXISTS an_jobs (
+  id           BIGSERIAL PRIMARY KEY,
+  kind         TEXT        NOT NULL,
+  payload      JSONB       NOT NULL DEFAULT '{}',
+  state        TEXT        NOT NULL DEFAULT 'queued',
+  created      TIMESTAMPTZ NOT NULL DEFAULT now(),
+  run_after    TIMESTAMPTZ NOT NULL DEFAULT now(),
+  started      TIMESTAMPTZ,
+  finished     TIMESTAMPTZ,
+  attempts     INTEGER     NOT NULL DEFAULT 0,
+  max_attempts INTEGER     NOT NULL DEFAULT 3,
+  result       JSONB,
+  last_error   TEXT,
+  CHECK (state IN ('queued', 'running', 'done', 'failed'))
+);
+
+CREATE INDEX IF NOT EXISTS an_jobs_queued_idx ON an_jobs (run_after, id) WHERE state = 'queued';
+-- Who asked for the job (NULL for scheduled ones), and so may see how it went
+ALTER TABLE an_jobs ADD COLUMN IF NOT EXISTS enqueued_by BIGINT REFERENCES an_users (id) ON DELETE SET NULL;
+-- A running job's worker keeps pushing this forward; once it's passed, the worker is presumed dead
+-- and the job is put back on the queue.
+ALTER TABLE an_jobs ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMPTZ;
+
+-- Sufficient statistics for inter-annotator agreement, kept up to date as Assignments are approved
+-- so that kappa/alpha can be read without rescanning an_annotations.
+CREATE TABLE IF NOT EXISTS an_agreement_stats (
+  corpus_id          BIGINT           NOT NULL REFERENCES an_corpora (id),
+  summary_code       TEXT             NOT NULL,
+  -- Every categorical rating seen
+  ratings            BIGINT           NOT NULL DEFAULT 0,
+  -- Assets with at least two ratings, and the number of ratings on them
+  items              BIGINT           NOT NULL DEFAULT 0,
+  pairable           BIGINT           NOT NULL DEFAULT 0,
+  -- Sum over items of sum_c n_c(n_c - 1)/(m - 1) (Krippendorff) and sum_c n_c(n_c - 1)/(m(m - 1)) (Fleiss)
+  observed_agreement DOUBLE PRECISION NOT NULL DEFAULT 0,
+  fleiss_sum_p       DOUBLE PRECISION NOT NULL DEFAULT 0,
+  -- Pairable ratings per label
+  category_totals    JSONB            NOT NULL DEFAULT '{}',
+  PRIMARY KEY (corpus_id, summary_code)
+);
+-- Sum of Cohen's kappa over the annotator pairs in an_agreement_pairs for which it's defined, and how
+-- many of those there are, so that the mean is read from this row alone. Rows from before these columns
+-- were added need the rebuild_agreement job.
+ALTER TABLE an_agreement_stats ADD COLUMN IF NOT EXISTS cohen_kappa_sum DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE an_agreement_stats ADD COLUMN IF NOT EXISTS cohen_kappa_pairs BIGINT NOT NULL DEFAULT 0;
+
+-- Confusion counts between each pair of annotators (rater_a < rater_b) who rated the same Asset.
+CREATE TABLE IF NOT EXISTS an_agreement_pairs (
+  corpus_id    BIGINT NOT NULL REFERENCES an_corpora (id),
+  summary_code TEXT   NOT NULL,
+  rater_a      BIGINT NOT NULL REFERENCES an_users (id),
+  rater_b      BIGINT NOT NULL REFERENCES an_users (id),
+  label_a      TEXT   NOT NULL,
+  label_b      TEXT   NOT NULL,
+  count        BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (corpus_id, summary_code, rater_a, rater_b, label_a, label_b)
 );
 
---CREATE INDEX IF NOT EXISTS an_annotations_asset_summary_code_idx ON an_annotations (asset_id, summary_code, source);
+-- Secondary indexes for the lookups the controllers make on every request.
+-- Tokens are looked up on every authenticated request, and must be unique anyway.
+CREATE UNIQUE INDEX IF NOT EXISTS an_user_tokens_token_idx ON an_user_tokens (token);
+CREATE INDEX IF NOT EXISTS an_user_tokens_user_id_idx ON an_user_tokens (user_id);
+CREATE INDEX IF NOT EXISTS an_user_tokens_expires_idx ON an_user_tokens (expires);
+-- (corpus_id, name) lets the corpus asset listing be answered from the index alone.
+CREATE INDEX IF NOT EXISTS an_assets_corpus_id_idx ON an_assets (corpus_id, name);
+-- Serves containment (@>) and SQL/JSON path (@?, @@) queries over asset metadata
+CREATE INDEX IF NOT EXISTS an_assets_user_metadata_idx ON an_assets USING GIN (user_metadata jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS an_assignments_assigned_user_id_idx ON an_assignments (assigned_user_id);
+CREATE INDEX IF NOT EXISTS an_assignment_history_assignment_id_idx ON an_assignment_history (assignment_id);
+CREATE INDEX IF NOT EXISTS an_assignments_assets_xref_assignment_id_idx ON an_assignments_assets_xref (assignment_id);
+CREATE INDEX IF NOT EXISTS an_assignments_assets_xref_asset_id_idx ON an_assignments_assets_xref (asset_id);
+CREATE INDEX IF NOT EXISTS an_questions_corpus_id_idx ON an_questions (corpus_id);
+
+-- Full-text search (see search.py). Each searchable table carries a search_vector, kept
+-- up to date by a trigger and indexed with GIN. Existing rows are filled in the first time
+-- the column is added.
+CREATE OR REPLACE FUNCTION an_questions_search_vector() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.search_vector := setweight(to_tsvector('english', coalesce(NEW.summary_code, '')), 'A')
+                       || setweight(jsonb_to_tsvector('english', NEW.content, '["string"]'), 'B');
+  RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION an_assignments_search_vector() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.search_vector := jsonb_to_tsvector('english', coalesce(NEW.response, '{}'), '["string"]')
+                       || to_tsvector('english', coalesce(array_to_string(NEW.response_labels, ' '), ''));
+  RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION an_assignment_history_search_vector() RETURNS TRIGGER AS $$
+BEGIN
+  NEW.search_vector := to_tsvector('english', coalesce(NEW.notes, ''));
+  RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DO $$ BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'an_questions' AND column_name = 'search_vector') THEN
+    ALTER TABLE an_questions ADD COLUMN search_vector TSVECTOR;
+    CREATE TRIGGER an_questions_search_vector BEFORE INSERT OR UPDATE OF content, summary_code ON an_questions
+      FOR EACH ROW EXECUTE FUNCTION an_questions_search_vector();
+    UPDATE an_questions SET content = content;
+  END IF;
+END $$;
+
+DO $$ BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'an_assignments' AND column_name = 'search_vector') THEN
+    ALTER TABLE an_assignments ADD COLUMN search_vector TSVECTOR;
+    CREATE TRIGGER an_assignments_search_vector BEFORE INSERT OR UPDATE OF response, response_labels ON an_assignments
+      FOR EACH ROW EXECUTE FUNCTION an_assignments_search_vector();
+    UPDATE an_assignments SET response = response;
+  END IF;
+END $$;
+
+DO $$ BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                 WHERE table_name = 'an_assignment_history' AND column_name = 'search_vector') THEN
+    ALTER TABLE an_assignment_history ADD COLUMN search_vector TSVECTOR;
+    CREATE TRIGGER an_assignment_history_search_vector BEFORE INSERT OR UPDATE OF notes ON an_assignment_history
+      FOR EACH ROW EXECUTE FUNCTION an_assignment_history_search_vector();
+    UPDATE an_assignment_history SET notes = notes;
+  END IF;
+END $$;
+
+CREATE INDEX IF NOT EXISTS an_questions_search_idx ON an_questions USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS an_assignments_search_idx ON an_assignments USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS an_assignment_history_search_idx ON an_assignment_history USING GIN (search_vector);
@@ -0,0 +1,287 @@
+"""
+Summary functions: turn the Human annotations collected for an Asset into a
+single Aggregated annotation per summary code.
+
+Annotations are grouped by (asset, summary code) and each batch of groups is
+summarised with NumPy. Categorical kinds get a majority vote, time-series
+segmentations get pairwise boundary agreement and label IoU (the reported
+segmentation is the one which agrees best with everyone else).
+"""
+import collections
+import itertools
+import logging
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+from agreement import CATEGORICAL_KINDS, CHOICE_SEPARATOR, categorical_value
+from models import InternalAnnotation, InternalAsset
+
+SEGMENTATION_KINDS = {"TimeSeriesSegmentationAnnotation", "1d_segmentation"}
+
+# How close (in seconds) two segment boundaries have to be to count as the same boundary.
+DEFAULT_BOUNDARY_TOLERANCE = 0.05
+
+
+def _categorical_content(kind: str, label: str) -> dict:
+    if kind == "MultipleChoiceAnnotation":
+        return {"choices": label.split(CHOICE_SEPARATOR) if label else []}
+    return {"content": label}
+
+
+def majority_vote(groups: [[str]]) -> [(str, int, int)]:
+    """
+    Finds the most common label in each group, all groups at once.
+    Ties are broken by picking the label that sorts first.
+    :param groups: A list of label lists, one per (asset, summary code)
+    :return: A (winning label, votes for it, total votes) tuple per group
+    """
+    sizes = np.fromiter((len(g) for g in groups), dtype=np.int64, count=len(groups))
+    if sizes.sum() == 0:
+        return [(None, 0, 0) for _ in groups]
+    labels = np.array(list(itertools.chain.from_iterable(groups)), dtype=object)
+    group_idx = np.repeat(np.arange(len(groups)), sizes)
+
+    vocabulary, label_idx = np.unique(labels.astype(str), return_inverse=True)
+    keys, counts = np.unique(group_idx * len(vocabulary) + label_idx, return_counts=True)
+    key_group, key_label = keys // len(vocabulary), keys % len(vocabulary)
+
+    # Sort by group, then descending count, then label, and take the first row of each group
+    order = np.lexsort((key_label, -counts, key_group))
+    sorted_groups = key_group[order]
+    first = order[np.r_[True, sorted_groups[1:] != sorted_groups[:-1]]]
+
+    ret = [(None, 0, 0) for _ in groups]
+    for k in first:
+        g = key_group[k]
+        ret[g] = (str(vocabulary[key_label[k]]), int(counts[k]), int(sizes[g]))
+    return ret
+
+
+def boundary_agreement(boundaries: [np.ndarray], tolerance: float) -> np.ndarray:
+    """
+    Pairwise boundary F1: a boundary counts as found if the other annotator
+    placed one within `tolerance` of it.
+    :return: A symmetric (annotators x annotators) matrix
+    """
+    n = len(boundaries)
+    ret = np.ones((n, n))
+    for i, j in itertools.combinations(range(n), 2):
+        a, b = boundaries[i], boundaries[j]
+        if len(a) == 0 or len(b) == 0:
+            f1 = float(len(a) == len(b))
+        else:
+            close = np.abs(a[:, None] - b[None, :]) <= tolerance
+            precision = close.any(axis=1).mean()
+            recall = close.any(axis=0).mean()
+            f1 = 0.0 if precision + recall == 0 else 2 * precision * recall / (precision + recall)
+        ret[i, j] = ret[j, i] = f1
+    return ret
+
+
+def segment_iou(boundaries: [np.ndarray], labels: [np.ndarray]) -> np.ndarray:
+    """
+    Pairwise label IoU between segmentations. Each segment runs from its
+    boundary to the next one; the last segment runs to the latest boundary
+    anyone placed, since the Asset's duration isn't known here.
+    :param boundaries: Sorted segment start times, one array per annotator
+    :param labels: Integer label for each segment, one array per annotator (as long as their boundaries)
+    :return: A symmetric (annotators x annotators) matrix
+    """
+    for i, (b, l) in enumerate(zip(boundaries, labels)):
+        if len(b) != len(l):
+            raise ValueError("Annotator {} has {} boundaries but {} labels".format(i, len(b), len(l)))
+    n = len(boundaries)
+    cuts = np.unique(np.concatenate(boundaries)) if n else np.array([])
+    if len(cuts) < 2:
+        return np.ones((n, n))
+
+    # Label every annotator's timeline on the shared set of elementary intervals
+    widths = np.diff(cuts)
+    starts = cuts[:-1]
+    timeline = np.full((n, len(starts)), -1, dtype=np.int64)
+    for i in range(n):
+        if len(boundaries[i]) == 0:
+            continue
+        position = np.searchsorted(boundaries[i], starts, side="right") - 1
+        covered = position >= 0
+        timeline[i, covered] = labels[i][position[covered]]
+
+    vocabulary = np.unique(timeline[timeline >= 0])
+    one_hot = timeline[:, None, :] == vocabulary[None, :, None]       # annotator x label x interval
+    weighted = one_hot * widths[None, None, :]
+    intersection = np.einsum("alt,blt->abl", one_hot.astype(float), weighted)
+    own = weighted.sum(axis=2)                                          # annotator x label
+    union = own[:, None, :] + own[None, :, :] - intersection
+    present = union > 0
+    per_label = np.divide(intersection, union, out=np.zeros_like(intersection), where=present)
+    with np.errstate(invalid="ignore"):
+        ret = per_label.sum(axis=2) / present.sum(axis=2)
+    return np.nan_to_num(ret, nan=1.0)
+
+
+def is_well_formed_segmentation(content: dict) -> bool:
+    """
+    Whether a segmentation has a label for each of its boundaries.
+    """
+    return len(content.get("segments") or []) == len(content.get("annotations") or [])
+
+
+def summarise_segmentations(contents: [dict], tolerance: float) -> (dict, dict):
+    """
+    Picks the medoid segmentation (highest mean IoU against everyone else).
+    Every one of contents must be well-formed (see is_well_formed_segmentation).
+    :return: (chosen annotation content, agreement statistics)
+    """
+    order = [np.argsort(np.asarray(c.get("segments") or [], dtype=float), kind="stable") for c in contents]
+    boundaries = [np.asarray(c.get("segments") or [], dtype=float)[o] for c, o in zip(contents, order)]
+    raw_labels = [np.asarray(c.get("annotations") or [], dtype=object)[o] for c, o in zip(contents, order)]
+
+    vocabulary = sorted(set(itertools.chain.from_iterable((str(x) for x in l) for l in raw_labels)))
+    index = {label: i for i, label in enumerate(vocabulary)}
+    labels = [np.array([index[str(x)] for x in l], dtype=np.int64) for l in raw_labels]
+
+    iou = segment_iou(boundaries, labels)
+    f1 = boundary_agreement(boundaries, tolerance)
+    n = len(contents)
+    if n > 1:
+        off_diagonal = ~np.eye(n, dtype=bool)
+        mean_iou, mean_f1 = float(iou[off_diagonal].mean()), float(f1[off_diagonal].mean())
+        medoid = int(np.argmax(iou.sum(axis=1)))
+    else:
+        mean_iou, mean_f1, medoid = 1.0, 1.0, 0
+
+    chosen = {
+        "segments": contents[medoid].get("segments"),
+        "annotations": contents[medoid].get("annotations"),
+    }
+    return chosen, {"iou": mean_iou, "boundaryF1": mean_f1, "annotators": n}
+
+
+def summarise_groups(groups: [dict], tolerance: float = DEFAULT_BOUNDARY_TOLERANCE) -> [dict]:
+    """
+    Summarises a batch of groups. Runs inside pool workers, so it only deals in plain data.
+    :param groups: dicts with assetId, summaryCode, kind and contents (a list of annotation JSON)
+    :return: One row per group, ready to insert into an_annotations
+    """
+    ret = []
+    categorical = [g for g in groups if g["kind"] in CATEGORICAL_KINDS]
+    votes = majority_vote([[categorical_value(c) for c in g["contents"]] for g in categorical])
+    for g, (label, support, total) in zip(categorical, votes):
+        content = _categorical_content(g["kind"], label)
+        content["agreement"] = {"support": support / total if total else 0.0, "votes": total}
+        ret.append((g, content))
+
+    for g in groups:
+        if g["kind"] in SEGMENTATION_KINDS:
+            contents = [c for c in g["contents"] if is_well_formed_segmentation(c)]
+            if len(contents) < len(g["contents"]):
+                logging.warning("Skipping %d segmentations of asset %d (%s) without a label per boundary",
+                                len(g["contents"]) - len(contents), g["assetId"], g["summaryCode"])
+            if not contents:
+                continue
+            content, agreement = summarise_segmentations(contents, tolerance)
+            content["agreement"] = agreement
+            ret.append((g, content))
+        elif g["kind"] not in CATEGORICAL_KINDS:
+            logging.warning("No summary function for %s annotations (asset %d, %s)",
+                            g["kind"], g["assetId"], g["summaryCode"])
+
+    rows = []
+    for g, content in ret:
+        content.update({
+            "kind": g["kind"],
+            "source": "Aggregated",
+            "summaryCode": g["summaryCode"],
+            "created": datetime.utcnow().isoformat() + "Z",
+        })
+        rows.append({
+            "asset_id": g["assetId"],
+            "summary_code": g["summaryCode"],
+            "kind": g["kind"],
+            "source": "Aggregated",
+            "content": content,
+            "created": datetime.utcnow(),
+        })
+    return rows
+
+
+def group_human_annotations(storage, corpus_id: int, batch_size: int = 1000):
+    """
+    Streams the Human annotations in a corpus as (asset, summary code) groups.
+    Groups mixing several kinds keep the most common one, with a warning.
+    """
+    query = storage.query(InternalAnnotation.asset_id, InternalAnnotation.summary_code,
+                          InternalAnnotation.kind, InternalAnnotation.content)\
+        .join(InternalAsset, InternalAsset.id == InternalAnnotation.asset_id)\
+        .filter(InternalAsset.corpus_id == corpus_id)\
+        .filter(InternalAnnotation.source == "Human")\
+        .order_by(InternalAnnotation.asset_id, InternalAnnotation.summary_code)\
+        .execution_options(stream_results=True)\
+        .yield_per(batch_size)
+
+    for (asset_id, summary_code), rows in itertools.groupby(query, key=lambda r: (r[0], r[1])):
+        rows = list(rows)
+        kinds = [r[2] for r in rows]
+        kind = max(set(kinds), key=kinds.count)
+        if len(set(kinds)) > 1:
+            logging.warning("Asset %d has mixed kinds for %s: %s", asset_id, summary_code, set(kinds))
+        yield {"assetId": asset_id, "summaryCode": summary_code, "kind": kind,
+               "contents": [r[3] for r in rows if r[2] == kind]}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def aggregate_corpus(storage, corpus_id: int, processes: int = None, chunk_size: int = 500) -> dict:
+    """
+    Re-computes every Aggregated annotation in a corpus, replacing the previous ones.
+    Groups are streamed from the database a chunk at a time, summarised across a pool
+    of (spawned, so connection-free) processes, and each chunk's results are written as
+    they arrive, so only a few chunks are ever in memory. It all happens in one
+    transaction, so readers never see a partly re-aggregated corpus.
+    :return: Counts of groups summarised and annotations written
+    """
+    asset_ids = storage.query(InternalAsset.id).filter(InternalAsset.corpus_id == corpus_id)
+    storage.query(InternalAnnotation)\
+        .filter(InternalAnnotation.source == "Aggregated")\
+        .filter(InternalAnnotation.asset_id.in_(asset_ids.subquery()))\
+        .delete(synchronize_session=False)
+
+    counts = {"groups": 0, "written": 0}
+
+    def write(rows):
+        storage.bulk_insert_mappings(InternalAnnotation, rows)
+        counts["written"] += len(rows)
+
+    chunks = _chunks(group_human_annotations(storage, corpus_id), chunk_size)
+    # A corpus which fits in one chunk isn't worth starting processes for
+    first = list(itertools.islice(chunks, 2))
+    chunks = itertools.chain(first, chunks)
+    if processes == 1 or len(first) <= 1:
+        for chunk in chunks:
+            counts["groups"] += len(chunk)
+            write(summarise_groups(chunk))
+    else:
+        processes = processes or multiprocessing.cpu_count()
+        # Chunks are handed over here rather than through Pool.imap, whose feeder thread would
+        # read the query (and so the session) concurrently, and as fast as it could.
+        pending = collections.deque()
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            for chunk in chunks:
+                counts["groups"] += len(chunk)
+                pending.append(pool.apply_async(summarise_groups, (chunk,)))
+                if len(pending) >= 2 * processes:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+
+    storage.commit()
+    return counts
@@ -0,0 +1,245 @@
+"""
+Inter-annotator agreement (Cohen's kappa, Fleiss' kappa, Krippendorff's alpha)
+for categorical summary codes.
+
+Rather than rescanning every annotation when someone asks, the sufficient
+statistics are updated each time an Assignment is approved: per-corpus,
+per-summary code totals in an_agreement_stats, and per-annotator-pair
+confusion counts in an_agreement_pairs. The stats rows also keep the sum of
+the pairs' Cohen's kappas, so reading the metrics only touches a corpus'
+an_agreement_stats rows.
+"""
+import itertools
+from collections import Counter, defaultdict
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import InternalAgreementStats, InternalAgreementPair, InternalAnnotation, InternalAsset
+
+CATEGORICAL_KINDS = {"TextAnnotation", "MultipleChoiceAnnotation", "text"}
+
+# Separates the members of a multiple-choice answer when it's treated as a single label.
+CHOICE_SEPARATOR = "\x1f"
+
+
+def categorical_value(content: dict) -> str:
+    """
+    Reduces a categorical annotation to a single comparable label.
+    """
+    if "choices" in content:
+        return CHOICE_SEPARATOR.join(sorted(content["choices"]))
+    return content.get("content")
+
+
+def item_contribution(counts: Counter) -> (int, int, float, float, Counter):
+    """
+    What a single item (the ratings of one Asset) adds to the running totals.
+    Items rated fewer than twice can't be paired, so they only count as ratings.
+    :return: (items, pairable, observed agreement, Fleiss P_i, pairable ratings per label)
+    """
+    m = sum(counts.values())
+    if m < 2:
+        return 0, 0, 0.0, 0.0, Counter()
+    agreeing_pairs = sum(n * (n - 1) for n in counts.values())
+    return 1, m, agreeing_pairs / (m - 1), agreeing_pairs / (m * (m - 1)), Counter(counts)
+
+
+def fleiss_kappa(stats: InternalAgreementStats):
+    if stats.items == 0 or stats.pairable == 0:
+        return None
+    p_bar = stats.fleiss_sum_p / stats.items
+    p_e = sum((n / stats.pairable) ** 2 for n in stats.category_totals.values())
+    if p_e == 1:
+        return None
+    return (p_bar - p_e) / (1 - p_e)
+
+
+def krippendorff_alpha(stats: InternalAgreementStats):
+    """
+    Nominal alpha, computed from the coincidence matrix's diagonal and marginals.
+    """
+    n = stats.pairable
+    expected = n * n - sum(x * x for x in stats.category_totals.values())
+    if n < 2 or expected == 0:
+        return None
+    return 1 - (n - 1) * (n - stats.observed_agreement) / expected
+
+
+def cohen_kappa(confusion: {(str, str): int}):
+    total = sum(confusion.values())
+    if total == 0:
+        return None
+    rows, columns = Counter(), Counter()
+    for (a, b), count in confusion.items():
+        rows[a] += count
+        columns[b] += count
+    p_o = sum(count for (a, b), count in confusion.items() if a == b) / total
+    p_e = sum(rows[label] * columns[label] for label in rows) / (total * total)
+    if p_e == 1:
+        return None
+    return (p_o - p_e) / (1 - p_e)
+
+
+class AgreementController:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _get_stats_for_update(self, corpus_id: int, summary_code: str) -> InternalAgreementStats:
+        self.storage.execute(insert(InternalAgreementStats.__table__)
+                             .values(corpus_id=corpus_id, summary_code=summary_code, category_totals={})
+                             .on_conflict_do_nothing())
+        return self.storage.query(InternalAgreementStats)\
+            .filter_by(corpus_id=corpus_id, summary_code=summary_code)\
+            .with_for_update().one()
+
+    def _add_pairs(self, corpus_id: int, summary_code: str, pairs: Counter):
+        for (rater_a, rater_b, label_a, label_b), count in pairs.items():
+            statement = insert(InternalAgreementPair.__table__).values(
+                corpus_id=corpus_id, summary_code=summary_code, rater_a=rater_a, rater_b=rater_b,
+                label_a=label_a, label_b=label_b, count=count
+            )
+            self.storage.execute(statement.on_conflict_do_update(
+                index_elements=["corpus_id", "summary_code", "rater_a", "rater_b", "label_a", "label_b"],
+                set_={"count": InternalAgreementPair.__table__.c.count + statement.excluded.count}
+            ))
+
+    def _update_cohen_kappas(self, corpus_id: int, summary_code: str, stats: InternalAgreementStats,
+                             pairs: Counter):
+        """
+        Moves stats' running sum of per-pair Cohen's kappas by however much adding pairs
+        (which haven't been added yet) changes them. Only the rater pairs involved are read.
+        """
+        added = defaultdict(Counter)
+        for (rater_a, rater_b, label_a, label_b), count in pairs.items():
+            added[(rater_a, rater_b)][(label_a, label_b)] += count
+        if not added:
+            return
+        confusion = defaultdict(Counter)
+        for p in self.storage.query(InternalAgreementPair)\
+                .filter_by(corpus_id=corpus_id, summary_code=summary_code)\
+                .filter(tuple_(InternalAgreementPair.rater_a, InternalAgreementPair.rater_b).in_(list(added))):
+            confusion[(p.rater_a, p.rater_b)][(p.label_a, p.label_b)] += p.count
+        for raters, counts in added.items():
+            self._apply_kappa(stats, cohen_kappa(confusion[raters]), -1)
+            self._apply_kappa(stats, cohen_kappa(confusion[raters] + counts), 1)
+
+    @staticmethod
+    def _apply_kappa(stats: InternalAgreementStats, kappa: float, sign: int):
+        # Pairs whose kappa isn't defined (yet) don't count towards the mean
+        if kappa is not None:
+            stats.cohen_kappa_sum += sign * kappa
+            stats.cohen_kappa_pairs += sign
+
+    @staticmethod
+    def _apply(stats: InternalAgreementStats, contribution, sign: int):
+        items, pairable, observed, fleiss_p, totals = contribution
+        stats.items += sign * items
+        stats.pairable += sign * pairable
+        stats.observed_agreement += sign * observed
+        stats.fleiss_sum_p += sign * fleiss_p
+        # Re-assign rather than mutate, so that the JSON column is marked dirty
+        category_totals = Counter(stats.category_totals)
+        for label, n in totals.items():
+            category_totals[label] += sign * n
+        stats.category_totals = {k: v for k, v in category_totals.items() if v}
+
+    def record_rating(self, corpus_id: int, summary_code: str, asset_id: int, annotator_id: int,
+                      annotation: dict):
+        """
+        Folds one approved (categorical) response into the statistics. Must be
+        called before the matching Human annotation is added to the session.
+        """
+        if annotation.get("kind") not in CATEGORICAL_KINDS:
+            return
+        label = categorical_value(annotation)
+
+        # Locked first, so that a concurrent approval of the same Asset has either committed
+        # its annotation (which the query below then sees) or waits for this one to
+        stats = self._get_stats_for_update(corpus_id, summary_code)
+
+        existing = self.storage.query(InternalAnnotation.annotator_id, InternalAnnotation.content)\
+            .filter_by(asset_id=asset_id, summary_code=summary_code, source="Human").all()
+        existing = [(rater, categorical_value(content)) for rater, content in existing
+                    if content.get("kind") in CATEGORICAL_KINDS]
+
+        before = Counter(l for _, l in existing)
+        after = before + Counter([label])
+
+        stats.ratings += 1
+        self._apply(stats, item_contribution(before), -1)
+        self._apply(stats, item_contribution(after), 1)
+
+        pairs = Counter()
+        for rater, other_label in existing:
+            if rater is None or rater == annotator_id:
+                continue
+            if rater < annotator_id:
+                pairs[(rater, annotator_id, other_label, label)] += 1
+            else:
+                pairs[(annotator_id, rater, label, other_label)] += 1
+        self._update_cohen_kappas(corpus_id, summary_code, stats, pairs)
+        self._add_pairs(corpus_id, summary_code, pairs)
+
+    def rebuild(self, corpus_id: int):
+        """
+        Recomputes the statistics for a corpus from scratch, e.g. for data that
+        pre-dates incremental tracking.
+        """
+        self.storage.query(InternalAgreementStats).filter_by(corpus_id=corpus_id).delete()
+        self.storage.query(InternalAgreementPair).filter_by(corpus_id=corpus_id).delete()
+
+        rows = self.storage.query(InternalAnnotation.asset_id, InternalAnnotation.summary_code,
+                                  InternalAnnotation.annotator_id, InternalAnnotation.content)\
+            .join(InternalAsset, InternalAsset.id == InternalAnnotation.asset_id)\
+            .filter(InternalAsset.corpus_id == corpus_id)\
+            .filter(InternalAnnotation.source == "Human")\
+            .order_by(InternalAnnotation.summary_code, InternalAnnotation.asset_id, InternalAnnotation.id)
+
+        for summary_code, by_code in itertools.groupby(rows, key=lambda r: r[1]):
+            stats = InternalAgreementStats(corpus_id=corpus_id, summary_code=summary_code, ratings=0, items=0,
+                                           pairable=0, observed_agreement=0.0, fleiss_sum_p=0.0,
+                                           category_totals={}, cohen_kappa_sum=0.0, cohen_kappa_pairs=0)
+            pairs = Counter()
+            for _, by_asset in itertools.groupby(by_code, key=lambda r: r[0]):
+                ratings = [(r[2], categorical_value(r[3])) for r in by_asset
+                           if r[3].get("kind") in CATEGORICAL_KINDS]
+                stats.ratings += len(ratings)
+                self._apply(stats, item_contribution(Counter(l for _, l in ratings)), 1)
+                for (rater_a, label_a), (rater_b, label_b) in itertools.combinations(ratings, 2):
+                    if rater_a is None or rater_b is None or rater_a == rater_b:
+                        continue
+                    if rater_a < rater_b:
+                        pairs[(rater_a, rater_b, label_a, label_b)] += 1
+                    else:
+                        pairs[(rater_b, rater_a, label_b, label_a)] += 1
+            confusion = defaultdict(Counter)
+            for (rater_a, rater_b, label_a, label_b), count in pairs.items():
+                confusion[(rater_a, rater_b)][(label_a, label_b)] += count
+            for counts in confusion.values():
+                self._apply_kappa(stats, cohen_kappa(counts), 1)
+            if stats.ratings:
+                self.storage.add(stats)
+                self.storage.flush()
+                self._add_pairs(corpus_id, summary_code, pairs)
+        self.storage.commit()
+
+    def get_metrics(self, corpus_id: int) -> dict:
+        """
+        :return: Agreement metrics, keyed by summary code. Metrics which aren't
+                 defined yet (e.g. nothing has been rated twice) are None.
+        """
+        ret = {}
+        for stats in self.storage.query(InternalAgreementStats).filter_by(corpus_id=corpus_id):
+            # Cohen's kappa is only defined for two raters, so report the mean over pairs of annotators
+            pairs = stats.cohen_kappa_pairs
+            ret[stats.summary_code] = {
+                "ratings": stats.ratings,
+                "items": stats.items,
+                "cohenKappa": stats.cohen_kappa_sum / pairs if pairs else None,
+                "annotatorPairs": pairs,
+                "fleissKappa": fleiss_kappa(stats),
+                "krippendorffAlpha": krippendorff_alpha(stats),
+            }
+        return ret
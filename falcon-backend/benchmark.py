@@ -0,0 +1,518 @@
+"""
+Load-testing and benchmark harness for the annotation API.
+
+Seeds a scratch database with a synthetic corpus at a configurable scale, then
+drives annotator, reviewer and staff workloads against it, either in-process
+through falcon.testing or over HTTP against a real WSGI server. Throughput and
+p50/p95/p99 latency are reported per endpoint, and the results are written to
+a JSON file so that each run can be compared against the previous one.
+
+    python benchmark.py --annotators 20 --assets 2000 --asset-size 65536 --duration 60
+    python benchmark.py --transport http --concurrency 16 --fail-on-regression
+
+To benchmark a deployment, create a blank database with the schema, point the
+server at it, and have the benchmark seed that database rather than a scratch one:
+
+    python benchmark.py --transport http --url http://api:8000 --database postgresql+psycopg2://.../bench
+"""
+import argparse
+import glob
+import hashlib
+import http.client
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from socketserver import ThreadingMixIn
+from wsgiref import simple_server
+
+import bcrypt
+from falcon import testing
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import fixtures
+from main import create_app, obfuscate_int64_field, TokenController
+from models import InternalUser, InternalCorpus, InternalAsset, InternalAssignment, InternalAssignmentAssetXRef, \
+    InternalQuestion
+
+Scale = namedtuple("Scale", ["annotators", "reviewers", "assets", "asset_size", "assignments_per_annotator",
+                             "assets_per_assignment", "reviewed_fraction"])
+
+BENCHMARK_QUESTION = {
+    "created": "2018-04-23T18:25:43.511000Z",
+    "summaryCode": "WORDS",
+    "humanPrompt": "Divide this audio file into words",
+    "kind": "TimeSeriesSegmentationQuestion",
+    "annotationInstructions": "Click between each word",
+    "detailedAnnotationInstructions": "So much more to say",
+    "maximumSegments": 5,
+    "minimumSegments": 1,
+    "segmentChoices": ["hi", "world"],
+    "freeFormAllowed": True,
+    "assets": None,
+}
+
+BENCHMARK_RESPONSE = {
+    "created": "2018-04-23T18:25:43.511000Z",
+    "kind": "TimeSeriesSegmentationAnnotation",
+    "source": "Human",
+    "summaryCode": "WORDS",
+    "segments": [0.1, 2.0],
+    "annotations": ["hello", "world"]
+}
+
+
+def create_benchmark_database(server_url: str) -> (str, str):
+    """
+    Creates a blank database with the current schema on the given server.
+    :param server_url: A SQLAlchemy URL for the server's maintenance database.
+    :return: (name of the new database, URL to connect to it)
+    """
+    return fixtures.create_database("annotatron_bench", "empty", server_url)
+
+
+def drop_benchmark_database(server_url: str, db_name: str):
+    fixtures.drop_database(db_name, server_url)
+
+
+def seed(session, scale: Scale, seed_value: int = 0) -> dict:
+    """
+    Populates a blank database with a corpus, its assets, and users who have
+    Assignments waiting for them. Rows are bulk inserted rather than going
+    through the API, so seeding doesn't dominate the run.
+    :return: The users the workloads should log in as, with their bearer tokens.
+    """
+    rng = random.Random(seed_value)
+    # Hashing once keeps seeding fast; nobody logs in with the password
+    password = bcrypt.hashpw(b"benchmark", bcrypt.gensalt(4))
+
+    def make_user(username, role):
+        return InternalUser(username=username, role=role, email="{}@bench.annotatron".format(username),
+                            password=password, random_seed=bcrypt.gensalt(), password_reset_needed=False,
+                            deactivated_on=None)
+
+    staff = make_user("staff", "Administrator")
+    annotators = [make_user("annotator{}".format(i), "Annotator") for i in range(scale.annotators)]
+    reviewers = [make_user("reviewer{}".format(i), "Reviewer") for i in range(scale.reviewers)]
+    session.add_all([staff] + annotators + reviewers)
+
+    corpus = InternalCorpus(name="benchmark", description="Synthetic benchmark corpus",
+                            copyright_usage_restrictions="None", created=datetime.utcnow())
+    session.add(corpus)
+    session.flush()
+
+    question = InternalQuestion(content=BENCHMARK_QUESTION, created=datetime.utcnow(), creator_id=staff.id,
+                                corpus_id=corpus.id, summary_code=BENCHMARK_QUESTION["summaryCode"],
+                                kind=BENCHMARK_QUESTION["kind"])
+    session.add(question)
+    session.flush()
+
+    assets = []
+    for i in range(scale.assets):
+        content = rng.getrandbits(8 * scale.asset_size).to_bytes(scale.asset_size, "little")
+        assets.append({
+            "name": "asset{}".format(i), "content": content, "user_metadata": {"index": i},
+            "date_uploaded": datetime.utcnow(), "copyright_usage_restrictions": "None",
+            "checksum": hashlib.sha512(content).hexdigest(), "mime_type": "application/octet-stream",
+            "type_description": "binary", "corpus_id": corpus.id, "uploader_id": staff.id,
+        })
+    session.bulk_insert_mappings(InternalAsset, assets, return_defaults=True)
+    asset_ids = [a["id"] for a in assets]
+
+    assignments = []
+    for annotator in annotators:
+        for _ in range(scale.assignments_per_annotator):
+            reviewer = None
+            if reviewers and rng.random() < scale.reviewed_fraction:
+                reviewer = rng.choice(reviewers)
+            assignments.append({
+                "summary_code": BENCHMARK_QUESTION["summaryCode"], "assigned_user_id": annotator.id,
+                "annotator_id": annotator.id, "reviewer_id": reviewer.id if reviewer else None,
+                "corpus_id": corpus.id, "created": datetime.utcnow(), "question_id": question.id,
+                "response": None, "state": "created",
+            })
+    session.bulk_insert_mappings(InternalAssignment, assignments, return_defaults=True)
+    session.bulk_insert_mappings(InternalAssignmentAssetXRef, [
+        {"assignment_id": a["id"], "corpus_id": corpus.id, "asset_id": asset_id}
+        for a in assignments for asset_id in rng.sample(asset_ids, min(scale.assets_per_assignment, len(asset_ids)))
+    ])
+    session.commit()
+
+    token_controller = TokenController(session)
+
+    def describe(user, role):
+        return {"role": role, "id": obfuscate_int64_field(user.id),
+                "token": token_controller.issue_token(user).token}
+
+    return {
+        "corpus": corpus.name,
+        "staff": describe(staff, "staff"),
+        "annotators": [describe(u, "annotator") for u in annotators],
+        "reviewers": [describe(u, "reviewer") for u in reviewers],
+    }
+
+
+class InProcessTransport:
+    """
+    Calls the WSGI app directly, which measures the application without
+    socket and HTTP parsing overhead.
+    """
+
+    def __init__(self, app):
+        self.client = testing.TestClient(app)
+
+    def request(self, method: str, path: str, token: str, body=None) -> (int, bytes, dict):
+        headers = {"Authorization": "Bearer {}".format(token)}
+        response = self.client.simulate_request(method, path, headers=headers,
+                                                body=json.dumps(body) if body is not None else None)
+        return response.status_code, response.content, response.headers
+
+    def close(self):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPTransport:
+    """
+    Sends real HTTP requests, either to a server started here around the app or
+    to an already-running deployment (which must use the seeded database).
+    """
+
+    def __init__(self, app=None, url: str = None):
+        self.server = None
+        if url is None:
+            self.server = simple_server.make_server("127.0.0.1", 0, app, server_class=ThreadingWSGIServer,
+                                                    handler_class=QuietHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            self.host, self.port = self.server.server_address
+        else:
+            host_port = url.split("://", 1)[-1].rstrip("/")
+            self.host, _, port = host_port.partition(":")
+            self.port = int(port or 80)
+
+    def request(self, method: str, path: str, token: str, body=None) -> (int, bytes, dict):
+        headers = {"Authorization": "Bearer {}".format(token), "Accept": "application/json"}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf8")
+            headers["Content-Type"] = "application/json"
+        conn = http.client.HTTPConnection(self.host, self.port)
+        try:
+            conn.request(method, path, body=payload, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read(), {k.lower(): v for k, v in response.getheaders()}
+        finally:
+            conn.close()
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class Recorder:
+    """
+    Collects latency samples, keyed by endpoint (method and route template).
+    """
+
+    def __init__(self, warmup_until: float = 0):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.warmup_until = warmup_until
+
+    def timed(self, transport, endpoint: str, method: str, path: str, token: str, body=None, expected=(200,)):
+        started = time.perf_counter()
+        status, content, headers = transport.request(method, path, token, body)
+        elapsed = time.perf_counter() - started
+        if started >= self.warmup_until:
+            with self.lock:
+                self.samples[endpoint].append(elapsed)
+                if status not in expected:
+                    self.errors[endpoint] += 1
+        if status not in expected:
+            logging.debug("%s %s returned %d: %s", method, path, status, content[:200])
+            return status, None
+        if content and headers.get("content-type", "").startswith("application/json"):
+            return status, json.loads(content.decode("utf8"))
+        return status, content
+
+
+def annotator_session(transport, recorder: Recorder, user: dict, rng: random.Random) -> bool:
+    """
+    Fetches the annotator's to-do list, then opens, downloads and submits one Assignment.
+    :return: False once the annotator has nothing left to do.
+    """
+    status, todo = recorder.timed(transport, "GET /assignments/byUser/{id}", "GET",
+                                  "/assignments/byUser/{}".format(user["id"]), user["token"])
+    if not todo or not todo["forAnnotation"]:
+        return False
+    assignment_id = rng.choice(todo["forAnnotation"])
+    status, assignment = recorder.timed(transport, "GET /assignments/{id}", "GET",
+                                        "/assignments/{}".format(assignment_id), user["token"])
+    if assignment:
+        for asset_id in assignment["assets"]:
+            recorder.timed(transport, "GET /asset/{id}/content", "GET",
+                           "/asset/{}/content".format(obfuscate_int64_field(asset_id)), user["token"])
+    recorder.timed(transport, "PATCH /assignments/{id}/submit", "PATCH",
+                   "/assignments/{}/submit".format(assignment_id), user["token"],
+                   body={"notes": "", "response": BENCHMARK_RESPONSE}, expected=(202,))
+    return True
+
+
+def reviewer_session(transport, recorder: Recorder, user: dict, rng: random.Random) -> bool:
+    """
+    Fetches the reviewer's queue, then approves (or occasionally rejects) one submission.
+    """
+    status, todo = recorder.timed(transport, "GET /assignments/byUser/{id}", "GET",
+                                  "/assignments/byUser/{}".format(user["id"]), user["token"])
+    if not todo or not todo["forReview"]:
+        return False
+    assignment_id = rng.choice(todo["forReview"])
+    recorder.timed(transport, "GET /assignments/{id}", "GET", "/assignments/{}".format(assignment_id), user["token"])
+    action = "reject" if rng.random() < 0.1 else "approve"
+    recorder.timed(transport, "PATCH /assignments/{id}/" + action, "PATCH",
+                   "/assignments/{}/{}".format(assignment_id, action), user["token"],
+                   body={"notes": "", "response": None}, expected=(202,))
+    return True
+
+
+def staff_session(transport, recorder: Recorder, user: dict, corpus: str, rng: random.Random) -> bool:
+    """
+    Monitors progress on the corpus, the way the dashboard does.
+    """
+    recorder.timed(transport, "GET /assignments/byCorpus/{corpus}", "GET",
+                   "/assignments/byCorpus/{}/".format(corpus), user["token"])
+    recorder.timed(transport, "GET /corpus/{corpus}/assets", "GET", "/corpus/{}/assets".format(corpus),
+                   user["token"])
+    return True
+
+
+def run_workload(transport, users: dict, concurrency: int, duration: float, warmup: float,
+                 seed_value: int = 0) -> (Recorder, float):
+    """
+    Runs annotator, reviewer and staff sessions from `concurrency` threads until
+    `duration` seconds have passed or the annotators and reviewers run out of work.
+    :return: The Recorder, and the measured (post-warmup) wall-clock time.
+    """
+    started = time.perf_counter()
+    deadline = started + warmup + duration
+    recorder = Recorder(warmup_until=started + warmup)
+    actors = [("annotator", u) for u in users["annotators"]] + [("reviewer", u) for u in users["reviewers"]]
+    idle = set()
+    lock = threading.Lock()
+
+    def worker(n):
+        rng = random.Random(seed_value + n)
+        while time.perf_counter() < deadline:
+            with lock:
+                if len(idle) >= len(actors):
+                    return
+                candidates = [a for a in actors if a[1]["token"] not in idle]
+            if rng.random() < 0.05:
+                staff_session(transport, recorder, users["staff"], users["corpus"], rng)
+                continue
+            kind, user = rng.choice(candidates)
+            session = annotator_session if kind == "annotator" else reviewer_session
+            if not session(transport, recorder, user, rng):
+                with lock:
+                    idle.add(user["token"])
+            elif kind == "annotator":
+                # Submissions create review work, so reviewers may have something to do again
+                with lock:
+                    idle.difference_update(u["token"] for u in users["reviewers"])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return recorder, max(time.perf_counter() - started - warmup, 1e-9)
+
+
+def percentile(sorted_samples: [float], p: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_samples:
+        return None
+    rank = max(math.ceil(p / 100.0 * len(sorted_samples)) - 1, 0)
+    return sorted_samples[rank]
+
+
+def summarise(recorder: Recorder, elapsed: float) -> dict:
+    ret = {}
+    for endpoint, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        ret[endpoint] = {
+            "count": len(samples),
+            "errors": recorder.errors[endpoint],
+            "throughput": len(samples) / elapsed,
+            "mean": sum(samples) / len(samples),
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+        }
+    return ret
+
+
+def compare_results(previous: dict, current: dict, tolerance: float) -> [str]:
+    """
+    :return: A description of each endpoint whose p95 latency got worse by more than `tolerance`.
+    """
+    regressions = []
+    for endpoint, stats in current["endpoints"].items():
+        before = previous["endpoints"].get(endpoint)
+        if not before or not before["p95"]:
+            continue
+        if stats["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append("{}: p95 {:.1f}ms -> {:.1f}ms".format(
+                endpoint, before["p95"] * 1000, stats["p95"] * 1000))
+    return regressions
+
+
+def find_previous_result(results_dir: str, scenario: dict):
+    """
+    Finds the most recent stored run of the same scenario (scale and transport).
+    """
+    for path in sorted(glob.glob(os.path.join(results_dir, "*.json")), reverse=True):
+        with open(path) as fin:
+            result = json.load(fin)
+        if result.get("scenario") == scenario:
+            return path, result
+    return None, None
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(summary: dict, previous: dict = None):
+    print("{:<40} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9}".format(
+        "endpoint", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for endpoint, stats in summary.items():
+        line = "{:<40} {:>8} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            endpoint, stats["count"], stats["errors"], stats["throughput"],
+            stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000)
+        before = previous["endpoints"].get(endpoint) if previous else None
+        if before and before["p95"]:
+            line += "  ({:+.0f}% p95)".format((stats["p95"] / before["p95"] - 1) * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks Annotatron's API against a synthetic corpus.")
+    parser.add_argument("--server", default=fixtures.MAINTENANCE_URL,
+                        help="Maintenance database of the server to create the scratch database on")
+    parser.add_argument("--keep-database", action="store_true")
+    parser.add_argument("--database",
+                        help="Seed this (blank, with the schema applied) database rather than a scratch one, "
+                             "e.g. the one the server given by --url uses. It isn't dropped afterwards.")
+    parser.add_argument("--annotators", type=int, default=10)
+    parser.add_argument("--reviewers", type=int, default=3)
+    parser.add_argument("--assets", type=int, default=500)
+    parser.add_argument("--asset-size", type=int, default=16384, help="Bytes per asset")
+    parser.add_argument("--assignments-per-annotator", type=int, default=20)
+    parser.add_argument("--assets-per-assignment", type=int, default=1)
+    parser.add_argument("--reviewed-fraction", type=float, default=0.5,
+                        help="Fraction of Assignments which have a reviewer")
+    parser.add_argument("--transport", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--url", help="Benchmark a running server, using the database given by --database "
+                                      "(with --transport http)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds to run before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--results-dir", default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                              "benchmark-results"))
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed p95 slowdown against the previous run before it counts as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+    if args.url and not args.database:
+        parser.error("--url needs --database: the server has to be using the database that gets seeded")
+    if args.url and args.transport != "http":
+        parser.error("--url needs --transport http")
+
+    logging.basicConfig(level=logging.WARNING)
+    scale = Scale(args.annotators, args.reviewers, args.assets, args.asset_size, args.assignments_per_annotator,
+                  args.assets_per_assignment, args.reviewed_fraction)
+    scenario = dict(scale._asdict(), transport=args.transport, concurrency=args.concurrency)
+
+    if args.database:
+        db_name, database_url = args.database.rsplit("/", 1)[1], args.database
+    else:
+        db_name, database_url = create_benchmark_database(args.server)
+    engine = create_engine(database_url, pool_size=args.concurrency + 2)
+    try:
+        session = sessionmaker(bind=engine)()
+        seeding_started = time.perf_counter()
+        users = seed(session, scale, args.seed)
+        session.close()
+        print("Seeded {} in {:.1f}s".format(db_name, time.perf_counter() - seeding_started))
+
+        app = create_app(engine)
+        if args.transport == "http":
+            transport = HTTPTransport(app, args.url)
+        else:
+            transport = InProcessTransport(app)
+        try:
+            recorder, elapsed = run_workload(transport, users, args.concurrency, args.duration, args.warmup,
+                                             args.seed)
+        finally:
+            transport.close()
+    finally:
+        engine.dispose()
+        if not args.keep_database and not args.database:
+            drop_benchmark_database(args.server, db_name)
+
+    result = {
+        "started": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "scenario": scenario,
+        "elapsed": elapsed,
+        "endpoints": summarise(recorder, elapsed),
+    }
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    previous_path, previous = find_previous_result(args.results_dir, scenario)
+    result_path = os.path.join(args.results_dir, "{}.json".format(datetime.utcnow().strftime("%Y%m%dT%H%M%S")))
+    with open(result_path, "w") as fout:
+        json.dump(result, fout, indent=2, sort_keys=True)
+
+    print_report(result["endpoints"], previous)
+    print("Results written to {}".format(result_path))
+
+    if previous:
+        regressions = compare_results(previous, result, args.tolerance)
+        if regressions:
+            print("Regressions against {}:".format(previous_path))
+            for r in regressions:
+                print("    " + r)
+            if args.fail_on_regression:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Caching for resources which don't change once they're created (Assets and Questions).
+
+Each is identified by a strong ETag derived from the row (an Asset's checksum, a
+Question's id and creation time), so clients can revalidate with If-None-Match
+and get a 304 without the server loading the payload. The converted external
+objects are also kept in a small in-process LRU, keyed by database id (and, for
+Questions, creation time too, so that a database restored from a snapshot can't
+be served another one's Question under the same id). Ids aren't otherwise
+reused, so entries can only go stale by being deleted, which callers must
+report through invalidate().
+"""
+import threading
+from collections import OrderedDict
+
+import falcon
+
+
+class LRUCache:
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: The cached value, or None if it isn't present.
+        """
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        """
+        Returns the cached value for key, calling create() to fill it if absent.
+        """
+        value = self.get(key)
+        if value is None:
+            value = create()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+asset_descriptions = LRUCache(4096)
+questions = LRUCache(4096)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against a (strong) ETag, using the weak
+    comparison RFC 7232 asks for.
+    """
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
+
+
+def not_modified(req, resp, etag: str, cache_control: str = "private, no-cache") -> bool:
+    """
+    Labels the response with etag and, if the client already has that version,
+    turns it into a 304.
+    :return: True if the response is a 304 and the handler should stop.
+    """
+    resp.set_header("ETag", '"%s"' % etag)
+    resp.set_header("Cache-Control", cache_control)
+    if etag_matches(req.get_header("If-None-Match"), etag):
+        resp.status = falcon.HTTP_NOT_MODIFIED
+        return True
+    return False
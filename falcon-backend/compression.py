@@ -0,0 +1,156 @@
+"""
+Content-Encoding negotiation for JSON and text responses.
+
+gzip is always available. Brotli and Zstandard are offered when the `brotli`
+and `zstandard` packages are installed.
+"""
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Below this many bytes, compression costs more than it saves.
+MINIMUM_SIZE = 1024
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+def _gzip_compressor():
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress, c.flush
+
+
+def _brotli_compressor():
+    c = brotli.Compressor(quality=5)
+    return c.process, c.finish
+
+
+def _zstd_compressor():
+    c = zstandard.ZstdCompressor(level=3).compressobj()
+    return c.compress, c.flush
+
+
+# In order of preference, for when the client likes several equally.
+ENCODERS = []
+if zstandard is not None:
+    ENCODERS.append(("zstd", _zstd_compressor))
+if brotli is not None:
+    ENCODERS.append(("br", _brotli_compressor))
+ENCODERS.append(("gzip", _gzip_compressor))
+
+
+def parse_accept_encoding(header: str) -> dict:
+    """
+    :return: A map from each coding in an Accept-Encoding header to its q-value.
+    """
+    ret = {}
+    if not header:
+        return ret
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ret[coding] = q
+    return ret
+
+
+def negotiate(header: str, available: [str]) -> str:
+    """
+    Picks the coding the client prefers (by q-value, then by the order of
+    available) out of those available.
+    :return: A coding, or None if the response should be sent as-is.
+    """
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress_static(content: bytes) -> bytes:
+    """
+    Gzips content for storing alongside the original (e.g. an_assets.content_gzip).
+    The output is deterministic, so it only depends on content.
+    """
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def _compress_stream(stream, compressor):
+    write, finish = compressor()
+    read = stream.read if hasattr(stream, "read") else None
+    chunks = iter(lambda: read(STREAM_CHUNK_SIZE), b"") if read else stream
+    for chunk in chunks:
+        compressed = write(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+
+class CompressionComponent:
+    """
+    Compresses JSON and text responses. Has to come before JSONTranslatorComponent
+    in the middleware list, so that its process_response sees the encoded body.
+    Responses which already have a Content-Encoding (e.g. pre-compressed assets)
+    are left alone.
+    """
+
+    def __init__(self, minimum_size: int = MINIMUM_SIZE, encoders: list = None):
+        self.minimum_size = minimum_size
+        self.encoders = dict(encoders or ENCODERS)
+        self.available = [name for name, _ in (encoders or ENCODERS)]
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        content_type = resp.content_type or ""
+        if not any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES):
+            return
+        if resp.get_header("Content-Encoding"):
+            return
+        resp.append_header("Vary", "Accept-Encoding")
+
+        body = resp.body if resp.body is not None else resp.data
+        if body is None and resp.stream is None:
+            return
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        if body is not None and len(body) < self.minimum_size:
+            return
+
+        coding = negotiate(req.get_header("Accept-Encoding"), self.available)
+        if coding is None:
+            return
+        compressor = self.encoders[coding]
+
+        if body is not None:
+            write, finish = compressor()
+            resp.body = None
+            resp.data = write(body) + finish()
+        else:
+            resp.stream = _compress_stream(resp.stream, compressor)
+            resp.stream_len = None
+        resp.set_header("Content-Encoding", coding)
+
+        # The compressed bytes are a different representation, so a strong ETag no longer applies
+        etag = resp.get_header("ETag")
+        if etag and not etag.startswith("W/"):
+            resp.set_header("ETag", "W/" + etag)
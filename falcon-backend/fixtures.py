@@ -0,0 +1,205 @@
+"""
+Scratch databases for tests and benchmarks, and synthetic data to fill them.
+
+Creating a database and replaying db.sql into it takes far longer than most
+tests do. Instead, the schema (plus, optionally, a synthetic data set) is built
+once into a template database, and every test gets its own copy of that with
+CREATE DATABASE ... TEMPLATE, which copies the files rather than re-running
+anything. Templates are named after a hash of what went into them, so editing
+db.sql or the seed statements builds a new one, and the stale ones are dropped.
+Within a test, MyTestCase still rolls back everything it did. Everything is
+made on the server that ANNOTATRON_DATABASE_URL points at.
+
+    python fixtures.py build --fixture corpora    # build a template ahead of a test run
+    python fixtures.py clean                      # drop every template
+"""
+import argparse
+import gc
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import string
+
+from sqlalchemy import create_engine, exc, text
+
+import config
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../docker/postgres/files/db.sql")
+
+TEMPLATE_PREFIX = "annotatron_template_"
+
+# Synthetic corpora, big enough that a sequential scan is never the cheapest plan
+# for a selective lookup. Each Asset's speaker recurs every 1000 Assets, each
+# Question's prompt once per corpus, and each response's label every 500 Assignments.
+CORPORA_STATEMENTS = """
+    INSERT INTO an_users (username, email, password, role, random_seed)
+      SELECT 'user' || i, 'user' || i || '@example.com', '\\x00', 'Annotator', 'seed' || i
+      FROM generate_series(1, :users) AS i;
+    INSERT INTO an_user_tokens (user_id, expires, token)
+      SELECT id, now() + interval '7 days', md5(id::text) FROM an_users;
+    INSERT INTO an_corpora (name) SELECT 'corpus' || i FROM generate_series(1, :corpora) AS i;
+    INSERT INTO an_assets (name, content, checksum, mime_type, type_description, corpus_id, uploader_id,
+                           user_metadata)
+      SELECT 'asset' || i, convert_to(i::text, 'utf8'), public.sha512(convert_to(i::text, 'utf8')), 'text/plain',
+             'UTF8_TEXT', (SELECT min(id) FROM an_corpora) + mod(i, :corpora), (SELECT min(id) FROM an_users),
+             jsonb_build_object('speaker', 'speaker' || mod(i, 1000), 'duration', mod(i, 60))
+      FROM generate_series(1, :assets) AS i;
+    INSERT INTO an_questions (kind, content, summary_code, creator_id, corpus_id)
+      SELECT 'TextQuestion', jsonb_build_object('humanPrompt', 'Transcribe prompt' || g), 'CODE',
+             (SELECT min(id) FROM an_users), c.id
+      FROM an_corpora c, generate_series(1, :questions) AS g;
+    INSERT INTO an_assignments (summary_code, assigned_user_id, annotator_id, corpus_id, question, response)
+      SELECT 'CODE', u, u, (SELECT min(id) FROM an_corpora) + mod(i, :corpora), '{}',
+             jsonb_build_object('content', 'label' || mod(i, 500))
+      FROM generate_series(1, :assignments) AS i,
+           LATERAL (SELECT (SELECT min(id) FROM an_users) + mod(i, :users) AS u) AS x;
+    INSERT INTO an_assignment_history (assignment_id, corpus_id, updating_user_id, updated_on, state)
+      SELECT id, corpus_id, annotator_id, now(), 'Submitted' FROM an_assignments;
+    UPDATE an_assignment_history SET notes = 'Reviewed by checker' || mod(id, 1000);
+    INSERT INTO an_assignments_assets_xref (assignment_id, corpus_id, asset_id)
+      SELECT a.id, a.corpus_id, (SELECT min(id) FROM an_assets) + mod(a.id, :assets) FROM an_assignments a;
+    ANALYZE;
+"""
+
+# What a template can start out with: the arguments to seed_corpora, or None for an empty database.
+FIXTURES = {
+    "empty": None,
+    "corpora": {"users": 2000, "corpora": 20, "assets": 20000, "questions": 200, "assignments": 50000},
+}
+
+# Templates known to exist, so that the server is only asked once per process
+_templates = set()
+
+
+def database_url(server_url: str, db_name: str) -> str:
+    return "{}/{}".format(server_url.rsplit("/", 1)[0], db_name)
+
+
+# Scratch databases are made on the same server as the configured database (see config.py)
+MAINTENANCE_URL = database_url(config.load_settings().database_url, "postgres")
+
+
+def random_db_name(prefix: str) -> str:
+    return "{}_{}".format(prefix, ''.join(random.sample(string.ascii_lowercase, 8)))
+
+
+def read_schema() -> str:
+    with open(SCHEMA_FILE, "r") as fin:
+        return fin.read()
+
+
+def seed_corpora(connection, users: int = 2000, corpora: int = 20, assets: int = 20000, questions: int = 200,
+                 assignments: int = 50000):
+    """
+    Bulk inserts synthetic users (each with a token), corpora, Assets, Questions and
+    Assignments, with history and notes, into a database with the current schema.
+    Everything is generated on the server, so even the default sizes take seconds.
+    """
+    connection.execute(text(CORPORA_STATEMENTS), {"users": users, "corpora": corpora, "assets": assets,
+                                                  "questions": questions, "assignments": assignments})
+
+
+def template_name(fixture: str) -> str:
+    digest = hashlib.sha256(read_schema().encode("utf8"))
+    if FIXTURES[fixture] is not None:
+        digest.update(CORPORA_STATEMENTS.encode("utf8"))
+        digest.update(json.dumps(FIXTURES[fixture], sort_keys=True).encode("utf8"))
+    return "{}{}_{}".format(TEMPLATE_PREFIX, fixture, digest.hexdigest()[:12])
+
+
+def list_templates(conn, fixture: str = None) -> [str]:
+    pattern = re.compile("^{}({})_[0-9a-f]{{12}}$".format(TEMPLATE_PREFIX, fixture or "|".join(FIXTURES)))
+    return [name for name, in conn.execute("SELECT datname FROM pg_database") if pattern.match(name)]
+
+
+def ensure_template(fixture: str = "empty", server_url: str = MAINTENANCE_URL) -> str:
+    """
+    Builds the template database for fixture, unless it's already there.
+    :return: The template's name.
+    """
+    name = template_name(fixture)
+    if name in _templates:
+        return name
+
+    conn = create_engine(server_url, isolation_level="AUTOCOMMIT").connect()
+    try:
+        existing = list_templates(conn, fixture)
+        if name not in existing:
+            logging.info("Building template database %s...", name)
+            # Built under another name and renamed, so a half-built template is never copied
+            building = random_db_name("annotatron_building")
+            conn.execute("CREATE DATABASE {}".format(building))
+            engine = create_engine(database_url(server_url, building), isolation_level="AUTOCOMMIT")
+            try:
+                engine.execute(read_schema())
+                if FIXTURES[fixture] is not None:
+                    seed_corpora(engine, **FIXTURES[fixture])
+            except Exception:
+                engine.dispose()
+                conn.execute("DROP DATABASE {}".format(building))
+                raise
+            engine.dispose()
+            try:
+                conn.execute("ALTER DATABASE {} RENAME TO {}".format(building, name))
+            except exc.ProgrammingError:
+                # Another process built it first
+                conn.execute("DROP DATABASE {}".format(building))
+
+            for stale in existing:
+                try:
+                    conn.execute("DROP DATABASE {}".format(stale))
+                except exc.DBAPIError as e:
+                    logging.warning("Could not drop stale template %s: %s", stale, e)
+    finally:
+        conn.close()
+
+    _templates.add(name)
+    return name
+
+
+def create_database(prefix: str, fixture: str = "empty", server_url: str = MAINTENANCE_URL) -> (str, str):
+    """
+    Creates a database with the current schema, as a copy of fixture's template.
+    :param server_url: A SQLAlchemy URL for the server's maintenance database.
+    :return: (name of the new database, URL to connect to it)
+    """
+    template = ensure_template(fixture, server_url)
+    db_name = random_db_name(prefix)
+    # Copying fails while anything is connected to the template, including
+    # connections that are only waiting to be garbage collected
+    gc.collect()
+    conn = create_engine(server_url, isolation_level="AUTOCOMMIT").connect()
+    conn.execute("CREATE DATABASE {} TEMPLATE {}".format(db_name, template))
+    conn.close()
+    return db_name, database_url(server_url, db_name)
+
+
+def drop_database(db_name: str, server_url: str = MAINTENANCE_URL):
+    gc.collect()
+    conn = create_engine(server_url, isolation_level="AUTOCOMMIT").connect()
+    conn.execute("DROP DATABASE IF EXISTS {}".format(db_name))
+    conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage template databases for tests and benchmarks")
+    parser.add_argument("command", choices=["build", "clean"])
+    parser.add_argument("--fixture", action="append", choices=sorted(FIXTURES),
+                        help="Which template to build (all of them by default)")
+    parser.add_argument("--server", default=MAINTENANCE_URL,
+                        help="Maintenance database of the server holding the templates")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "build":
+        for fixture in args.fixture or sorted(FIXTURES):
+            print(ensure_template(fixture, args.server))
+    else:
+        conn = create_engine(args.server, isolation_level="AUTOCOMMIT").connect()
+        for name in list_templates(conn):
+            conn.execute("DROP DATABASE {}".format(name))
+            print("Dropped", name)
+        conn.close()
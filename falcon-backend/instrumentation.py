@@ -0,0 +1,210 @@
+"""
+Per-route request metrics, exposed in the Prometheus text format at /metrics.
+
+InstrumentationComponent times each request and, through SQLAlchemy's cursor
+events, counts the statements it ran, how long they took and how many rows
+they returned. Requests which are slow (or run suspiciously many statements)
+are logged along with their queries. Only administrators can read them.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import falcon
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def render(self, name: str, labels: str) -> [str]:
+        ret = []
+        for bound, count in zip(self.buckets, self.counts):
+            ret.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+        ret.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count))
+        ret.append('%s_sum{%s} %s' % (name, labels, self.sum))
+        ret.append('%s_count{%s} %d' % (name, labels, self.count))
+        return ret
+
+
+class RouteMetrics:
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.statuses = defaultdict(int)
+        self.sql_seconds = 0.0
+        self.rows = 0
+        self.response_bytes = 0
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(RouteMetrics)
+
+    def record(self, route: str, method: str, status: str, elapsed: float, statements: int,
+               sql_seconds: float, rows: int, response_bytes: int):
+        with self.lock:
+            m = self.routes[(route, method)]
+            m.latency.observe(elapsed)
+            m.statements.observe(statements)
+            m.statuses[status] += 1
+            m.sql_seconds += sql_seconds
+            m.rows += rows
+            m.response_bytes += response_bytes
+
+    def record_bytes(self, route: str, method: str, response_bytes: int):
+        """
+        Counts a streamed response body, once it's been sent.
+        """
+        with self.lock:
+            self.routes[(route, method)].response_bytes += response_bytes
+
+    def render(self) -> str:
+        latency, statements, requests, sql_seconds, rows, response_bytes = [], [], [], [], [], []
+        with self.lock:
+            for (route, method), m in sorted(self.routes.items()):
+                labels = 'route="%s",method="%s"' % (route, method)
+                latency.extend(m.latency.render("annotatron_request_duration_seconds", labels))
+                statements.extend(m.statements.render("annotatron_sql_statements_per_request", labels))
+                for status, count in sorted(m.statuses.items()):
+                    requests.append('annotatron_requests_total{%s,status="%s"} %d' % (labels, status, count))
+                sql_seconds.append('annotatron_sql_duration_seconds_total{%s} %s' % (labels, m.sql_seconds))
+                rows.append('annotatron_sql_rows_total{%s} %d' % (labels, m.rows))
+                response_bytes.append('annotatron_response_bytes_total{%s} %d' % (labels, m.response_bytes))
+
+        ret = []
+        for name, kind, description, lines in [
+            ("annotatron_request_duration_seconds", "histogram", "Time spent handling requests", latency),
+            ("annotatron_sql_statements_per_request", "histogram", "SQL statements run per request", statements),
+            ("annotatron_requests_total", "counter", "Requests handled, by status", requests),
+            ("annotatron_sql_duration_seconds_total", "counter", "Time spent executing SQL", sql_seconds),
+            ("annotatron_sql_rows_total", "counter", "Rows returned by SQL statements", rows),
+            ("annotatron_response_bytes_total", "counter", "Response body bytes sent", response_bytes),
+        ]:
+            ret.append("# HELP %s %s" % (name, description))
+            ret.append("# TYPE %s %s" % (name, kind))
+            ret.extend(lines)
+        return "\n".join(ret) + "\n"
+
+
+def _counted(stream, on_close):
+    """
+    Passes a response stream (an iterable or file-like object) through, then
+    calls on_close with the number of bytes that were sent.
+    """
+    sent = 0
+    chunks = iter(lambda: stream.read(64 * 1024), b"") if hasattr(stream, "read") else stream
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        on_close(sent)
+
+
+class InstrumentationComponent:
+    """
+    Must be the first middleware, so that its timing covers the others.
+    """
+
+    def __init__(self, engine, registry: MetricsRegistry = None, slow_request_seconds: float = 0.5,
+                 slow_request_statements: int = 50):
+        self.registry = registry or MetricsRegistry()
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_request_statements = slow_request_statements
+        self.route_templates = {}
+        self.local = threading.local()
+        self.listen(engine)
+
+    def listen(self, engine):
+        """
+        Counts statements run against another engine (e.g. a replica) too.
+        """
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def add_route(self, app, template: str, resource):
+        """
+        Registers a route with the app, remembering its template for labelling metrics.
+        """
+        app.add_route(template, resource)
+        self.route_templates[id(resource)] = template
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self.local, "queries", None) is not None:
+            self.local.statement_started = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        queries = getattr(self.local, "queries", None)
+        if queries is None:
+            return
+        elapsed = time.perf_counter() - self.local.statement_started
+        rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+        queries.append((statement, elapsed, rows))
+
+    def process_request(self, req, resp):
+        self.local.queries = []
+        self.local.request_started = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        queries = getattr(self.local, "queries", None)
+        if queries is None:
+            return
+        elapsed = time.perf_counter() - self.local.request_started
+        self.local.queries = None
+
+        route = self.route_templates.get(id(resource), "unrouted")
+        body = resp.body if resp.body is not None else resp.data
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        response_bytes = len(body) if body is not None else 0
+        if body is None and resp.stream is not None:
+            # Not sent until after this returns, so counted as it goes (see record_bytes)
+            resp.stream = _counted(resp.stream, lambda sent: self.registry.record_bytes(route, req.method, sent))
+        status = resp.status.split(" ")[0] if resp.status else "200"
+        sql_seconds = sum(q[1] for q in queries)
+
+        self.registry.record(route, req.method, status, elapsed, len(queries), sql_seconds,
+                             sum(q[2] for q in queries), response_bytes)
+
+        if elapsed >= self.slow_request_seconds or len(queries) >= self.slow_request_statements:
+            logging.warning("Slow request: %s %s (%s) took %.3fs, %d statements (%.3fs in SQL)",
+                            req.method, req.path, route, elapsed, len(queries), sql_seconds)
+            for statement, statement_elapsed, rows in queries:
+                logging.warning("    %.4fs %4d rows: %s", statement_elapsed, rows, " ".join(statement.split()))
+
+
+class MetricsResource:
+    """
+    Scrapers authenticate with an administrator's token, like any other client.
+    """
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def on_get(self, req, resp):
+        # Routes, timings and slow queries describe the whole deployment
+        user = getattr(req, "user", None)
+        if user is None or user.role != "Administrator":
+            raise falcon.HTTPForbidden("Must be admin")
+        resp.content_type = "text/plain; version=0.0.4"
+        resp.body = self.registry.render()
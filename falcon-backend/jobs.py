@@ -0,0 +1,359 @@
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+import config
+from compression import MINIMUM_SIZE, compress_static
+from models import InternalJob, InternalAsset
+
+# Maps a job kind onto the function that runs it. Handlers take (session, payload) and
+# return a JSON-serializable result, which is recorded against the job.
+JOB_HANDLERS = {}
+
+
+def job_handler(kind: str):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+class JobController:
+
+    # How long a claimed job is a worker's before it's presumed dead. run_job renews the
+    # lease every LEASE / 3 while the handler runs, however long that takes.
+    LEASE = timedelta(minutes=5)
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def enqueue(self, kind: str, payload: dict, run_after: datetime = None, enqueued_by: int = None) -> InternalJob:
+        """
+        Adds a job to the queue. The job is only visible to workers once the
+        surrounding transaction commits, so it can be enqueued alongside the
+        rows it refers to.
+        :param kind: One of the keys in JOB_HANDLERS.
+        :param payload: JSON arguments for the handler.
+        :param run_after: Don't start the job before this time.
+        :param enqueued_by: The user the job is being run for, who may then look it up (see JobResource).
+        :return: The (uncommitted) InternalJob
+        """
+        if kind not in JOB_HANDLERS:
+            raise ValueError((kind, "No handler registered for this kind of job"))
+        job = InternalJob(kind=kind, payload=payload, state="queued", attempts=0, enqueued_by=enqueued_by,
+                          created=datetime.utcnow(), run_after=run_after or datetime.utcnow())
+        self.storage.add(job)
+        return job
+
+    def retrieve_job(self, non_obfuscated_id: int) -> InternalJob:
+        return self.storage.query(InternalJob).get(non_obfuscated_id)
+
+    def claim_next_job(self) -> InternalJob:
+        """
+        Marks the oldest runnable job as running and returns it. Rows locked by
+        other workers are skipped rather than waited on.
+        :return: The claimed InternalJob, or None if the queue is empty.
+        """
+        job = self.storage.query(InternalJob)\
+            .filter(InternalJob.state == "queued")\
+            .filter(InternalJob.run_after <= datetime.utcnow())\
+            .order_by(InternalJob.run_after, InternalJob.id)\
+            .with_for_update(skip_locked=True)\
+            .first()
+        if job is None:
+            self.storage.rollback()
+            return None
+        job.state = "running"
+        job.started = datetime.utcnow()
+        job.lease_expires = job.started + self.LEASE
+        job.attempts += 1
+        self.storage.commit()
+        return job
+
+    def _renew_lease(self, job_id: int, stop: threading.Event):
+        """
+        Heartbeat for a running job, on a connection of its own: the handler's
+        transaction isn't committed until it finishes.
+        """
+        bind = self.storage.get_bind()
+        engine = getattr(bind, "engine", bind)
+        while not stop.wait(self.LEASE.total_seconds() / 3):
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text("UPDATE an_jobs SET lease_expires = :expires "
+                                            "WHERE id = :id AND state = 'running'"),
+                                       expires=datetime.utcnow() + self.LEASE, id=job_id)
+            except Exception as e:
+                logging.error("Couldn't renew the lease on job %d: %s", job_id, e)
+
+    def _run_handler(self, job: InternalJob):
+        """
+        Runs the job's handler, renewing its lease in the background until it returns.
+        """
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_lease, args=(job.id, stop), daemon=True)
+        heartbeat.start()
+        try:
+            return JOB_HANDLERS[job.kind](self.storage, job.payload)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def run_job(self, job: InternalJob):
+        """
+        Runs a claimed job and records its outcome. Failed jobs are re-queued
+        until they run out of attempts.
+        """
+        try:
+            result = self._run_handler(job)
+        except Exception as e:
+            logging.error("Job %d (%s) failed: %s", job.id, job.kind, e)
+            self.storage.rollback()
+            job.last_error = traceback.format_exc()
+            if job.attempts >= job.max_attempts:
+                job.state = "failed"
+                job.finished = datetime.utcnow()
+            else:
+                job.state = "queued"
+                job.run_after = datetime.utcnow() + timedelta(seconds=2 ** job.attempts)
+            self.storage.commit()
+            return False
+
+        job.state = "done"
+        job.result = result
+        job.finished = datetime.utcnow()
+        self.storage.commit()
+        return True
+
+    def run_next_job(self) -> bool:
+        """
+        Claims and runs a single job.
+        :return: True if a job was run (successfully or not), False if the queue was empty.
+        """
+        job = self.claim_next_job()
+        if job is None:
+            return False
+        self.run_job(job)
+        return True
+
+    def requeue_expired_jobs(self) -> int:
+        """
+        Puts jobs back on the queue whose worker has stopped renewing their lease (so has
+        presumably died part-way through). The lost run counted as an attempt when the job
+        was claimed, so a job which keeps killing its worker eventually fails.
+        :return: How many jobs were requeued or failed.
+        """
+        now = datetime.utcnow()
+        expired = self.storage.query(InternalJob)\
+            .filter(InternalJob.state == "running")\
+            .filter(InternalJob.lease_expires < now)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        for job in expired:
+            logging.error("Job %d (%s) lost its worker", job.id, job.kind)
+            job.last_error = "Lease expired: the worker stopped responding"
+            job.lease_expires = None
+            if job.attempts >= job.max_attempts:
+                job.state = "failed"
+                job.finished = now
+            else:
+                job.state = "queued"
+                job.run_after = now + timedelta(seconds=2 ** job.attempts)
+        self.storage.commit()
+        return len(expired)
+
+
+# Leading bytes of the formats we're likely to see uploaded.
+MIME_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"fLaC", "audio/flac"),
+    (b"OggS", "audio/ogg"),
+    (b"ID3", "audio/mpeg"),
+    (b"\xff\xfb", "audio/mpeg"),
+]
+
+
+def sniff_mime_type(content: bytes) -> str:
+    for signature, mime_type in MIME_SIGNATURES:
+        if content.startswith(signature):
+            return mime_type
+    if content[:4] == b"RIFF" and content[8:12] == b"WAVE":
+        return "audio/wav"
+    try:
+        content.decode("utf8")
+        return "text/plain"
+    except UnicodeDecodeError:
+        return "application/octet-stream"
+
+
+@job_handler("process_asset")
+def process_asset(storage, payload):
+    """
+    Ingest-time processing for a newly uploaded asset: checks the declared MIME
+    type against the content. (Its checksum was verified on upload, and is
+    re-verified by scrub_assets.)
+    """
+    asset = storage.query(InternalAsset).get(payload["assetId"])
+    if asset is None:
+        return {"missing": True}
+
+    detected = sniff_mime_type(asset.content)
+    result = {
+        "detectedMimeType": detected,
+        "mimeTypeMatches": detected == asset.mime_type,
+    }
+
+    # Text is served compressed to most clients, so do it once up-front
+    result["compressed"] = False
+    if detected.startswith("text/") and len(asset.content) >= MINIMUM_SIZE:
+        compressed = compress_static(asset.content)
+        if len(compressed) < len(asset.content):
+            asset.content_gzip = compressed
+            result["compressed"] = True
+    return result
+
+
+# Assets re-hashed by each scrub_assets job, and how long to wait between passes over them all
+SCRUB_BATCH_SIZE = 200
+SCRUB_INTERVAL = timedelta(days=7)
+
+
+@job_handler("scrub_assets")
+def scrub_assets(storage, payload):
+    """
+    Re-verifies a batch of stored Assets against their checksums, recording when each
+    was last verified and flagging any whose content has been corrupted. (Assets in
+    cloned corpora are covered by the original holding their content.)
+
+    The Assets are split into payload["shards"] (by id), each scrubbed by its own chain
+    of jobs, so that several workers can share the work. Each job queues the next batch
+    of its shard (or, at the end, the start of the next pass) in the same transaction
+    as its results, so a pass resumes where it left off after a worker dies.
+    """
+    after, shard, shards = payload.get("after", 0), payload.get("shard", 0), payload.get("shards", 1)
+    batch_size = payload.get("batchSize", SCRUB_BATCH_SIZE)
+
+    rows = storage.query(InternalAsset.id, InternalAsset.checksum, InternalAsset.content)\
+        .filter(InternalAsset.id > after)\
+        .filter(InternalAsset.id % shards == shard)\
+        .filter(InternalAsset.content_asset_id.is_(None))\
+        .order_by(InternalAsset.id)\
+        .limit(batch_size)\
+        .execution_options(stream_results=True)\
+        .yield_per(8)
+    verified, corrupt, last = [], [], after
+    for asset_id, checksum, content in rows:
+        if hashlib.sha512(content).hexdigest() == checksum:
+            verified.append(asset_id)
+        else:
+            logging.error("Asset %d failed checksum verification", asset_id)
+            corrupt.append(asset_id)
+        last = asset_id
+
+    now = datetime.utcnow()
+    if verified:
+        storage.query(InternalAsset).filter(InternalAsset.id.in_(verified))\
+            .update({"last_verified": now}, synchronize_session=False)
+    if corrupt:
+        storage.query(InternalAsset).filter(InternalAsset.id.in_(corrupt))\
+            .update({"corrupted_on": now}, synchronize_session=False)
+
+    controller = JobController(storage)
+    if len(verified) + len(corrupt) == batch_size:
+        controller.enqueue("scrub_assets", dict(payload, after=last))
+    else:
+        interval = payload.get("interval", SCRUB_INTERVAL.total_seconds())
+        controller.enqueue("scrub_assets", dict(payload, after=0), run_after=now + timedelta(seconds=interval))
+    return {"verified": len(verified), "corrupt": corrupt, "after": last}
+
+
+def schedule_scrubbing(storage, shards: int, interval: timedelta = SCRUB_INTERVAL):
+    """
+    Starts a pass of the scrub_assets job over each shard, unless they're already scheduled.
+    """
+    if storage.query(InternalJob).filter(InternalJob.kind == "scrub_assets")\
+            .filter(InternalJob.state.in_(["queued", "running"])).first() is not None:
+        return
+    controller = JobController(storage)
+    for shard in range(shards):
+        controller.enqueue("scrub_assets", {"shard": shard, "shards": shards, "interval": interval.total_seconds()})
+    storage.commit()
+
+
+@job_handler("aggregate_corpus")
+def aggregate_corpus(storage, payload):
+    """
+    Re-runs the summary functions over a whole corpus (see aggregation.py).
+    """
+    # Imported here so that the API process doesn't pay for NumPy
+    import aggregation
+    return aggregation.aggregate_corpus(storage, payload["corpusId"], processes=payload.get("processes"))
+
+
+@job_handler("rebuild_agreement")
+def rebuild_agreement(storage, payload):
+    """
+    Recomputes a corpus' inter-annotator agreement statistics from an_annotations.
+    """
+    from agreement import AgreementController
+    AgreementController(storage).rebuild(payload["corpusId"])
+    return {"rebuilt": True}
+
+
+def run_worker(database_url: str, poll_interval: float):
+    """
+    Entry point for a single worker process. Each process has its own engine,
+    as connections can't be shared across a fork. Whenever the queue is empty,
+    jobs whose worker has died are put back on it.
+    """
+    engine = create_engine(database_url)
+    session = sessionmaker(bind=engine)()
+    controller = JobController(session)
+    while True:
+        try:
+            if not controller.run_next_job() and not controller.requeue_expired_jobs():
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            logging.error("Worker error: %s", e)
+            session.rollback()
+            time.sleep(poll_interval)
+
+
+def run_worker_pool(database_url: str, processes: int, poll_interval: float = 1.0, scrub: bool = True):
+    if scrub:
+        engine = create_engine(database_url)
+        schedule_scrubbing(sessionmaker(bind=engine)(), processes)
+        engine.dispose()
+    workers = []
+    for _ in range(processes):
+        p = multiprocessing.Process(target=run_worker, args=(database_url, poll_interval))
+        p.start()
+        workers.append(p)
+    for p in workers:
+        p.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs Annotatron's background job workers.")
+    parser.add_argument("--database", default=config.load_settings().database_url)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--no-scrub", action="store_true", help="Don't schedule re-verification of stored assets")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run_worker_pool(args.database, args.processes, args.poll_interval, scrub=not args.no_scrub)
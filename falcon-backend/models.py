@@ -1,5 +1,6 @@
-from sqlalchemy import Boolean, Column, Integer, String, DateTime, LargeBinary, Enum, ForeignKey, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, Integer, String, DateTime, LargeBinary, Enum, ForeignKey, JSON, Float, \
+    ForeignKeyConstraint, Index, ARRAY
+from sqlalchemy.orm import relationship, deferred
 from sqlalchemy.ext.declarative import declarative_base
 
 import datetime
@@ -36,8 +37,8 @@ class InternalToken(Base):
     __tablename__ = "an_user_tokens"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('an_users.id'))
-    expires = Column(DateTime)
+    user_id = Column(Integer, ForeignKey('an_users.id'), index=True)
+    expires = Column(DateTime, index=True)
     token = Column(String, unique=True)
     user = relationship("InternalUser", back_populates="tokens")
 
@@ -50,23 +51,34 @@ class InternalCorpus(Base):
     description = Column(String, nullable=True)
     created = Column(DateTime, nullable=True, default=datetime.datetime.utcnow())
     copyright_usage_restrictions = Column(String)
+    archived_on = Column(DateTime, nullable=True)
     assets = relationship("InternalAsset")
     questions = relationship("InternalQuestion")
 
 
 class InternalAsset(Base):
     __tablename__ = "an_assets"
+    __table_args__ = (
+        Index("an_assets_user_metadata_idx", "user_metadata", postgresql_using="gin",
+              postgresql_ops={"user_metadata": "jsonb_path_ops"}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
     content = Column(LargeBinary)
+    content_gzip = Column(LargeBinary, nullable=True)
+    # For Assets in cloned corpora, the Asset whose content (and content_gzip) this shares
+    content_asset_id = Column(Integer, ForeignKey("an_assets.id"), nullable=True)
     user_metadata = Column(JSON)
     date_uploaded = Column(DateTime, nullable=True, default=datetime.datetime.utcnow())
     copyright_usage_restrictions = Column(String)
     checksum = Column(String)
+    # Maintained by the scrub_assets job
+    last_verified = Column(DateTime, nullable=True)
+    corrupted_on = Column(DateTime, nullable=True)
     mime_type = Column(String)
     type_description = Column(String)
-    corpus_id = Column(Integer, ForeignKey("an_corpora.id"))
+    corpus_id = Column(Integer, ForeignKey("an_corpora.id"), index=True)
     uploader_id = Column(Integer, ForeignKey("an_users.id"))
 
     corpus = relationship("InternalCorpus", back_populates="assets")
@@ -77,9 +89,14 @@ class InternalAsset(Base):
 class InternalAssignmentAssetXRef(Base):
 
     __tablename__ = "an_assignments_assets_xref"
+    __table_args__ = (
+        ForeignKeyConstraint(["assignment_id", "corpus_id"], ["an_assignments.id", "an_assignments.corpus_id"]),
+    )
     id = Column(Integer, primary_key=True)
-    asset_id = Column(Integer, ForeignKey("an_assets.id"))
-    assignment_id = Column(Integer, ForeignKey("an_assignments.id"))
+    asset_id = Column(Integer, ForeignKey("an_assets.id"), index=True)
+    assignment_id = Column(Integer, index=True)
+    # Partition key, copied from the Assignment
+    corpus_id = Column(Integer)
 
     assignment = relationship("InternalAssignment", back_populates="asset_refs")
     asset = relationship("InternalAsset", back_populates="assignment_refs")
@@ -88,15 +105,23 @@ class InternalAssignmentAssetXRef(Base):
 class InternalAssignment(Base):
 
     __tablename__ = "an_assignments"
+    # Partitioned by corpus_id, so the database's primary key is (id, corpus_id); IDs are still unique.
     id = Column(Integer, primary_key=True)
     summary_code=Column(String, nullable=False)
-    assigned_user_id = Column(Integer, ForeignKey("an_users.id"), nullable=True)
+    assigned_user_id = Column(Integer, ForeignKey("an_users.id"), nullable=True, index=True)
     reviewer_id = Column(Integer, ForeignKey("an_users.id"), nullable=True)
     annotator_id = Column(Integer, ForeignKey("an_users.id"), nullable=True)
     corpus_id = Column(Integer, ForeignKey("an_corpora.id"))
     created = Column(DateTime, default=datetime.datetime.utcnow())
-    question = Column(JSON, nullable=False)
-    response = Column(JSON)
+    # Either a reference to one of the Corpus' Questions, or (for ad-hoc ones) a copy of it
+    question_id = Column(Integer, ForeignKey("an_questions.id"), nullable=True, index=True)
+    # The JSON columns are only loaded (and decoded) when they're used
+    question = deferred(Column(JSON, nullable=True))
+    response = deferred(Column(JSON))
+    # The segments and annotations of a large segmentation response, see packing.py
+    response_packed = deferred(Column(LargeBinary, nullable=True))
+    # Its distinct labels, so that they're searchable (see db.sql)
+    response_labels = deferred(Column(ARRAY(String), nullable=True))
     state = Column(String)
 
     asset_refs = relationship("InternalAssignmentAssetXRef")
@@ -108,8 +133,13 @@ class InternalAssignment(Base):
 class InternalAssignmentHistory(Base):
 
     __tablename__ = "an_assignment_history"
+    __table_args__ = (
+        ForeignKeyConstraint(["assignment_id", "corpus_id"], ["an_assignments.id", "an_assignments.corpus_id"]),
+    )
     id = Column(Integer, primary_key=True)
-    assignment_id = Column(Integer, ForeignKey("an_assignments.id"))
+    assignment_id = Column(Integer, index=True)
+    # Partition key, copied from the Assignment
+    corpus_id = Column(Integer)
     updated_on = Column(DateTime, default=datetime.datetime.utcnow())
     updating_user_id = Column(Integer, ForeignKey("an_users.id"))
     state = Column(String)
@@ -122,9 +152,9 @@ class InternalQuestion(Base):
     __tablename__ = "an_questions"
     id = Column(Integer, primary_key=True)
     content = Column(JSON, nullable=False)
-    created = Column(DateTime, nullable=True, default=datetime.datetime.utcnow())
+    created = Column(DateTime, nullable=True, default=datetime.datetime.utcnow)
     creator_id = Column(Integer, ForeignKey("an_users.id"))
-    corpus_id = Column(Integer, ForeignKey("an_corpora.id"))
+    corpus_id = Column(Integer, ForeignKey("an_corpora.id"), index=True)
     summary_code = Column(String)
     kind = Column(String)
 
@@ -132,3 +162,67 @@ class InternalQuestion(Base):
     creator = relationship("InternalUser")
 
 
+
+
+class InternalJob(Base):
+
+    __tablename__ = "an_jobs"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    state = Column(String, nullable=False, default="queued")
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    run_after = Column(DateTime, default=datetime.datetime.utcnow)
+    started = Column(DateTime, nullable=True)
+    finished = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    result = Column(JSON, nullable=True)
+    last_error = Column(String, nullable=True)
+    enqueued_by = Column(Integer, ForeignKey('an_users.id'), nullable=True)
+    # Renewed by the worker running the job, see JobController.LEASE
+    lease_expires = Column(DateTime, nullable=True)
+
+
+class InternalAnnotation(Base):
+
+    __tablename__ = "an_annotations"
+    id = Column(Integer, primary_key=True)
+    source = Column(Enum("Reference", "SystemGenerated", "Human", "Aggregated", name="an_annotation_source_v1"),
+                    nullable=False)
+    summary_code = Column(String, nullable=False)
+    created = Column(DateTime, default=datetime.datetime.utcnow)
+    kind = Column(String, nullable=False)
+    content = Column(JSON, nullable=False)
+    asset_id = Column(Integer, ForeignKey("an_assets.id"))
+    assignment_id = Column(Integer, ForeignKey("an_assignments.id"), nullable=True)
+    annotator_id = Column(Integer, ForeignKey("an_users.id"), nullable=True)
+
+    asset = relationship("InternalAsset")
+
+
+class InternalAgreementStats(Base):
+
+    __tablename__ = "an_agreement_stats"
+    corpus_id = Column(Integer, ForeignKey("an_corpora.id"), primary_key=True)
+    summary_code = Column(String, primary_key=True)
+    ratings = Column(Integer, nullable=False, default=0)
+    items = Column(Integer, nullable=False, default=0)
+    pairable = Column(Integer, nullable=False, default=0)
+    observed_agreement = Column(Float, nullable=False, default=0.0)
+    fleiss_sum_p = Column(Float, nullable=False, default=0.0)
+    category_totals = Column(JSON, nullable=False, default=dict)
+    cohen_kappa_sum = Column(Float, nullable=False, default=0.0)
+    cohen_kappa_pairs = Column(Integer, nullable=False, default=0)
+
+
+class InternalAgreementPair(Base):
+
+    __tablename__ = "an_agreement_pairs"
+    corpus_id = Column(Integer, ForeignKey("an_corpora.id"), primary_key=True)
+    summary_code = Column(String, primary_key=True)
+    rater_a = Column(Integer, ForeignKey("an_users.id"), primary_key=True)
+    rater_b = Column(Integer, ForeignKey("an_users.id"), primary_key=True)
+    label_a = Column(String, primary_key=True)
+    label_b = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,153 @@
+"""
+Compact storage for dense TimeSeriesSegmentationAnnotation responses.
+
+An hour of audio segmented word by word is tens of thousands of boundaries and
+labels, which as JSON is large and slow to decode. Packed, the boundaries are a
+float32 array (float64 if any of them wouldn't survive the conversion), and the
+labels are a dictionary of the distinct ones plus an index into it per segment.
+The rest of the response stays as JSON, and unpack_response puts it back
+together exactly as it was sent.
+
+    [header][boundaries][dictionary: (length, UTF-8 bytes) per label][label indices]
+
+All integers and arrays are little-endian.
+"""
+import struct
+import sys
+from array import array
+
+MAGIC = b"AN"
+VERSION = 1
+# magic, version, boundary typecode, index typecode, boundaries, dictionary size, labels
+HEADER = struct.Struct("<2sBccIII")
+LABEL_LENGTH = struct.Struct("<I")
+
+PACKABLE_KINDS = {"TimeSeriesSegmentationAnnotation"}
+
+# Below this many segments, the JSON is small enough that packing isn't worth it.
+MINIMUM_SEGMENTS = 64
+
+
+def _to_bytes(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    a = array(typecode)
+    a.frombytes(data)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def can_pack(response: dict) -> bool:
+    """
+    Whether response is a segmentation which pack_response can store (and give back
+    unchanged): every boundary a float and every label a string.
+    """
+    if not response or response.get("kind") not in PACKABLE_KINDS:
+        return False
+    segments, annotations = response.get("segments"), response.get("annotations")
+    if not isinstance(segments, list) or not isinstance(annotations, list):
+        return False
+    if len(segments) < MINIMUM_SEGMENTS:
+        return False
+    return all(type(x) is float for x in segments) and all(isinstance(x, str) for x in annotations)
+
+
+def pack(segments: [float], annotations: [str]) -> bytes:
+    boundaries = array("f", segments)
+    if boundaries.tolist() != segments:
+        boundaries = array("d", segments)
+
+    dictionary = {}
+    for label in annotations:
+        dictionary.setdefault(label, len(dictionary))
+    indices = array("H" if len(dictionary) <= 0xFFFF else "I", (dictionary[label] for label in annotations))
+
+    parts = [HEADER.pack(MAGIC, VERSION, boundaries.typecode.encode("ascii"), indices.typecode.encode("ascii"),
+                         len(boundaries), len(dictionary), len(indices)),
+             _to_bytes(boundaries)]
+    for label in dictionary:
+        encoded = label.encode("utf8")
+        parts.append(LABEL_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    parts.append(_to_bytes(indices))
+    return b"".join(parts)
+
+
+def unpack(data: bytes) -> ([float], [str]):
+    """
+    :return: The (segments, annotations) given to pack.
+    """
+    data = memoryview(data)
+    magic, version, boundary_type, index_type, n_boundaries, n_labels, n_indices = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a packed segmentation (version {})".format(VERSION))
+    offset = HEADER.size
+
+    boundary_type = boundary_type.decode("ascii")
+    size = array(boundary_type).itemsize * n_boundaries
+    segments = _from_bytes(boundary_type, data[offset:offset + size]).tolist()
+    offset += size
+
+    dictionary = []
+    for _ in range(n_labels):
+        length, = LABEL_LENGTH.unpack_from(data, offset)
+        offset += LABEL_LENGTH.size
+        dictionary.append(str(data[offset:offset + length], "utf8"))
+        offset += length
+
+    index_type = index_type.decode("ascii")
+    size = array(index_type).itemsize * n_indices
+    annotations = [dictionary[i] for i in _from_bytes(index_type, data[offset:offset + size])]
+    return segments, annotations
+
+
+def pack_response(response: dict) -> (dict, bytes):
+    """
+    Splits a response (which must satisfy can_pack) into the JSON to store as-is
+    and the packed segments and annotations.
+    """
+    rest = {k: v for k, v in response.items() if k not in ("segments", "annotations")}
+    return rest, pack(response["segments"], response["annotations"])
+
+
+def unpack_response(rest: dict, packed: bytes) -> dict:
+    ret = dict(rest)
+    ret["segments"], ret["annotations"] = unpack(packed)
+    return ret
+
+
+def benchmark(segments: int = 20000, vocabulary: int = 500, repeat: int = 20):
+    """
+    Compares packed storage with JSON for a word-level segmentation of about an hour of audio.
+    """
+    import json
+    import random
+    import timeit
+
+    rng = random.Random(0)
+    boundaries = sorted(round(rng.uniform(0, 3600), 3) for _ in range(segments))
+    words = ["word{}".format(i) for i in range(vocabulary)]
+    response = {"kind": "TimeSeriesSegmentationAnnotation", "source": "Human", "summaryCode": "WORDS",
+                "created": "2018-04-23T18:25:43.511000Z", "segments": boundaries,
+                "annotations": [rng.choice(words) for _ in boundaries]}
+
+    encoded = json.dumps(response)
+    rest, packed = pack_response(response)
+    packed_json = json.dumps(rest)
+    assert unpack_response(json.loads(packed_json), packed) == response
+
+    json_time = timeit.timeit(lambda: json.loads(encoded), number=repeat) / repeat
+    packed_time = timeit.timeit(lambda: unpack_response(json.loads(packed_json), packed), number=repeat) / repeat
+    print("{} segments, {} distinct labels".format(segments, vocabulary))
+    print("  JSON:   {:>10} bytes  {:8.2f} ms to decode".format(len(encoded), json_time * 1000))
+    print("  Packed: {:>10} bytes  {:8.2f} ms to decode".format(len(packed) + len(packed_json), packed_time * 1000))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,128 @@
+"""
+Routes read-only requests to streaming replicas, keeping writes (and the reads
+that must observe them) on the primary.
+
+A user who has just written is "sticky" to the primary until a replica has
+replayed past the primary's WAL position at the time of their write, or until
+`sticky_seconds` have passed, whichever is first. Stickiness is tracked in
+process, so multiple API processes should sit behind session affinity.
+"""
+import itertools
+import threading
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas: list, sticky_seconds: float = 10.0):
+        self.replicas = list(replicas)
+        self.sticky_seconds = sticky_seconds
+        self.lock = threading.Lock()
+        self.last_writes = {}
+        self.next_replica = itertools.cycle(self.replicas)
+
+    def choose_replica(self):
+        with self.lock:
+            return next(self.next_replica)
+
+    def mark_write(self, user_id: int, lsn: str):
+        """
+        Records that a user has written, and the primary's WAL position once they had.
+        """
+        with self.lock:
+            self.last_writes[user_id] = (lsn, time.monotonic())
+
+    def pending_write(self, user_id: int) -> str:
+        """
+        :return: The WAL position a replica must have replayed before it can serve this
+                 user, or None if they haven't written recently.
+        """
+        with self.lock:
+            write = self.last_writes.get(user_id)
+            if write is None:
+                return None
+            lsn, written = write
+            if time.monotonic() - written > self.sticky_seconds:
+                del self.last_writes[user_id]
+                return None
+            return lsn
+
+    def caught_up(self, user_id: int):
+        with self.lock:
+            self.last_writes.pop(user_id, None)
+
+
+class RoutingSession(Session):
+    """
+    A Session which uses its bind (the primary) unless use_replica() has been
+    called, after which reads go to a single replica for the rest of the session.
+    Flushes and bulk UPDATE/DELETEs always go to the primary.
+    """
+
+    def __init__(self, router: ReplicaRouter = None, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+        self.replica = None
+
+    def use_replica(self, replica=None):
+        if self.router is not None and self.router.replicas:
+            self.replica = replica or self.router.choose_replica()
+
+    def use_primary(self):
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is None or self._flushing or isinstance(clause, UpdateBase):
+            return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+        return self.replica
+
+
+def primary_wal_position(session) -> str:
+    return session.execute(text("SELECT pg_current_wal_lsn()::text")).scalar()
+
+
+def replica_has_replayed(replica, lsn: str) -> bool:
+    with replica.connect() as conn:
+        return bool(conn.execute(text("SELECT pg_last_wal_replay_lsn() >= CAST(:lsn AS pg_lsn)"),
+                                 {"lsn": lsn}).scalar())
+
+
+class ReplicaRoutingComponent:
+    """
+    Sends GET requests to a replica, unless the user is waiting on their own write
+    to replicate. Has to run after GetSessionTokenComponent, which authenticates
+    against the primary, so that freshly issued tokens always work.
+    """
+
+    READ_ONLY_METHODS = {"GET", "HEAD"}
+
+    def __init__(self, router: ReplicaRouter):
+        self.router = router
+
+    def process_request(self, req, resp):
+        if req.method not in self.READ_ONLY_METHODS or not self.router.replicas:
+            return
+        user = getattr(req, "user", None)
+        replica = self.router.choose_replica()
+        if user is not None:
+            lsn = self.router.pending_write(user.id)
+            if lsn is not None:
+                if not replica_has_replayed(replica, lsn):
+                    return
+                self.router.caught_up(user.id)
+        req.session.use_replica(replica)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.method in self.READ_ONLY_METHODS or not self.router.replicas or not req_succeeded:
+            return
+        user = getattr(req, "user", None)
+        if user is None:
+            return
+        session = getattr(req, "session", None)
+        if session is None:
+            return
+        self.router.mark_write(user.id, primary_wal_position(session))
@@ -0,0 +1,56 @@
+"""
+Full-text search over Questions, Assignment responses and reviewers' notes.
+
+Each table's search_vector column is maintained by a trigger (see db.sql) and
+GIN-indexed, so matching never reads the documents themselves. Queries use
+websearch_to_tsquery syntax: words, "quoted phrases", OR and -excluded.
+"""
+from sqlalchemy import text
+
+QUERY = "websearch_to_tsquery('english', :q)"
+
+# What can be searched: the kind of result, and the query finding its matches.
+# Notes are reported against the Assignment they were written about.
+SOURCES = {
+    "questions": """
+        SELECT 'question' AS kind, q.id, q.corpus_id, ts_rank_cd(q.search_vector, {query}) AS rank
+        FROM an_questions q
+        WHERE q.search_vector @@ {query} {corpus_filter}
+    """,
+    "responses": """
+        SELECT 'response' AS kind, a.id, a.corpus_id, ts_rank_cd(a.search_vector, {query}) AS rank
+        FROM an_assignments a
+        WHERE a.search_vector @@ {query} {corpus_filter}
+    """,
+    "notes": """
+        SELECT 'notes' AS kind, h.assignment_id AS id, h.corpus_id, ts_rank_cd(h.search_vector, {query}) AS rank
+        FROM an_assignment_history h
+        WHERE h.search_vector @@ {query} {corpus_filter}
+    """,
+}
+
+
+class SearchController:
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def search(self, q: str, sources: [str] = None, corpus_id: int = None, limit: int = 20,
+               offset: int = 0) -> [(str, int, str, float)]:
+        """
+        :param sources: Keys of SOURCES to search (defaults to all of them).
+        :param corpus_id: Only search within this Corpus (which also prunes the
+                          partitioned Assignment tables down to its partitions).
+        :return: (kind, id, corpus name, rank) tuples, best match first.
+        """
+        sources = sources or sorted(SOURCES)
+        corpus_filter = "AND corpus_id = :corpus_id" if corpus_id is not None else ""
+        matches = " UNION ALL ".join(SOURCES[s].format(query=QUERY, corpus_filter=corpus_filter) for s in sources)
+        statement = text("""
+            SELECT m.kind, m.id, c.name, m.rank
+            FROM ({matches}) m JOIN an_corpora c ON c.id = m.corpus_id
+            ORDER BY m.rank DESC, m.kind, m.id
+            LIMIT :limit OFFSET :offset
+        """.format(matches=matches))
+        return self.storage.execute(statement, {"q": q, "corpus_id": corpus_id, "limit": limit,
+                                                "offset": offset}).fetchall()
@@ -0,0 +1,378 @@
+"""
+Corpus-level snapshots, as an alternative to pg_dump for BYTEA-heavy databases.
+
+An archive is a directory of content-addressed chunks plus one manifest per
+snapshot:
+
+    chunks/ab/ab12...    zlib-compressed (if that helps) data, named by its SHA-256
+    snapshots/<name>     JSON manifest: the (parts of) tables, as lists of chunks of JSON rows
+
+Asset content is split into CHUNK_SIZE chunks, and rows are written in batches
+ordered by id, so anything already in the archive (the same Asset, an unchanged
+batch of history) isn't written again. Snapshots are incremental by default:
+Assets which were in the previous snapshot reuse its chunk lists, so their
+content isn't even read from the database. Asset content is read (and restored)
+by a pool of worker processes, each with its own connection.
+
+    python snapshot.py take /backups/annotatron --corpus speech --processes 8
+    python snapshot.py restore /backups/annotatron --database postgresql+psycopg2://...
+
+Restoring expects an empty database with db.sql applied. Agreement statistics
+aren't included; rebuild them with the rebuild_agreement job. A cloned corpus
+has to be snapshotted along with the one it was cloned from.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import zlib
+from datetime import datetime
+
+import psycopg2.extensions
+import psycopg2.extras
+from sqlalchemy import create_engine
+
+import config
+
+VERSION = 1
+CHUNK_SIZE = 4 * 1024 * 1024
+BATCH_ROWS = 1000
+# Binary values up to this size are kept in the row (base64) rather than chunked
+INLINE_BYTES = 1024
+
+# Restored in this order, so that foreign keys are satisfied. Each is filtered to the
+# snapshotted corpora (a list of ids, passed as %(corpora)s).
+TABLES = [
+    ("an_users", "TRUE"),
+    ("an_corpora", "id = ANY(%(corpora)s)"),
+    ("an_assets", "corpus_id = ANY(%(corpora)s) AND content_asset_id IS NULL"),
+    # Assets in cloned corpora refer to the Asset holding their content, so have to come after it
+    ("an_assets", "corpus_id = ANY(%(corpora)s) AND content_asset_id IS NOT NULL"),
+    ("an_questions", "corpus_id = ANY(%(corpora)s)"),
+    ("an_assignments", "corpus_id = ANY(%(corpora)s)"),
+    ("an_assignments_assets_xref", "corpus_id = ANY(%(corpora)s)"),
+    ("an_assignment_history", "corpus_id = ANY(%(corpora)s)"),
+    ("an_annotations", "asset_id IN (SELECT id FROM an_assets WHERE corpus_id = ANY(%(corpora)s))"),
+]
+
+# Tables whose binary columns are read by the worker pool, separately from the rest of the row
+BLOB_TABLES = {"an_assets"}
+
+# Maintained by triggers, so recomputed on restore
+SKIPPED_TYPES = {"tsvector"}
+
+
+class ChunkStore:
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "chunks", digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        compressed = zlib.compress(data, 6)
+        stored = b"z" + compressed if len(compressed) < len(data) else b"r" + data
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside and renamed, so that a chunk is never seen half-written
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as fout:
+            fout.write(stored)
+        os.replace(temporary, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as fin:
+            stored = fin.read()
+        data = zlib.decompress(stored[1:]) if stored[:1] == b"z" else stored[1:]
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("Chunk {} is corrupt".format(digest))
+        return data
+
+    def put_blob(self, data: bytes) -> [str]:
+        return [self.put(data[i:i + CHUNK_SIZE]) for i in range(0, len(data), CHUNK_SIZE)] or [self.put(b"")]
+
+    def get_blob(self, digests: [str]) -> bytes:
+        return b"".join(self.get(d) for d in digests)
+
+    def put_rows(self, rows: [dict]) -> str:
+        return self.put("\n".join(json.dumps(r, sort_keys=True, default=str) for r in rows).encode("utf8"))
+
+    def get_rows(self, digest: str) -> [dict]:
+        return [json.loads(line) for line in self.get(digest).decode("utf8").split("\n") if line]
+
+    def list_snapshots(self) -> [str]:
+        directory = os.path.join(self.root, "snapshots")
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def read_manifest(self, name: str) -> dict:
+        with open(os.path.join(self.root, "snapshots", name)) as fin:
+            return json.load(fin)
+
+    def write_manifest(self, name: str, manifest: dict):
+        os.makedirs(os.path.join(self.root, "snapshots"), exist_ok=True)
+        path = os.path.join(self.root, "snapshots", name)
+        with open(path + ".tmp", "w") as fout:
+            json.dump(manifest, fout, indent=1)
+        os.replace(path + ".tmp", path)
+
+
+def table_columns(cursor, table: str) -> [(str, str)]:
+    cursor.execute("SELECT column_name, data_type FROM information_schema.columns "
+                   "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position", (table,))
+    return [(name, data_type) for name, data_type in cursor.fetchall() if data_type not in SKIPPED_TYPES]
+
+
+def encode_binary(store: ChunkStore, value: bytes) -> dict:
+    if value is None:
+        return None
+    value = bytes(value)
+    if len(value) <= INLINE_BYTES:
+        return {"base64": base64.b64encode(value).decode("ascii")}
+    return {"chunks": store.put_blob(value)}
+
+
+def decode_binary(store: ChunkStore, value: dict) -> bytes:
+    if value is None:
+        return None
+    if "base64" in value:
+        return base64.b64decode(value["base64"])
+    return store.get_blob(value["chunks"])
+
+
+# Per-process state for the worker pool
+_worker = {}
+
+
+def _init_worker(database_url: str, archive: str, snapshot_id: str = None):
+    _worker["connection"] = create_engine(database_url).raw_connection()
+    _worker["store"] = ChunkStore(archive)
+    if snapshot_id:
+        # Read what the process taking the snapshot sees, however long the pool takes
+        cursor = _worker["connection"].cursor()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+
+
+def _read_blobs(connection, store: ChunkStore, table: str, binary_columns: [str], ids: [int]) -> dict:
+    """
+    :return: A map from each row's id to its encoded binary columns.
+    """
+    if not ids:
+        return {}
+    cursor = connection.cursor()
+    cursor.execute("SELECT id, {} FROM {} WHERE id = ANY(%s)".format(", ".join(binary_columns), table), (ids,))
+    ret = {}
+    for row in cursor:
+        ret[row[0]] = {name: encode_binary(store, value) for name, value in zip(binary_columns, row[1:])}
+    cursor.close()
+    return ret
+
+
+def _read_blobs_in_worker(args):
+    return _read_blobs(_worker["connection"], _worker["store"], *args)
+
+
+def _insert_rows(connection, store: ChunkStore, table: str, columns: [(str, str)], digest: str):
+    rows = store.get_rows(digest)
+    values = []
+    for row in rows:
+        value = []
+        for name, data_type in columns:
+            v = row.get(name)
+            if data_type == "bytea":
+                v = decode_binary(store, v)
+            elif data_type in ("json", "jsonb") and v is not None:
+                v = psycopg2.extras.Json(v)
+            value.append(v)
+        values.append(value)
+    cursor = connection.cursor()
+    psycopg2.extras.execute_values(cursor, "INSERT INTO {} ({}) VALUES %s".format(
+        table, ", ".join(name for name, _ in columns)), values, page_size=100)
+    cursor.close()
+    return len(rows)
+
+
+def _insert_rows_in_worker(args):
+    count = _insert_rows(_worker["connection"], _worker["store"], *args)
+    _worker["connection"].commit()
+    return count
+
+
+def take_snapshot(connection, archive: str, corpora: [str] = None, full: bool = False,
+                  database_url: str = None, processes: int = 1) -> str:
+    """
+    Writes a snapshot of the given corpora (by name; all unarchived ones by default).
+    Every table is read in one REPEATABLE READ transaction (the caller's, if one is
+    open), which the worker processes share via pg_export_snapshot, so the
+    snapshot is consistent.
+    :param connection: A DB-API connection to read from.
+    :param full: Read every Asset's content, rather than re-using the previous snapshot's.
+    :param database_url: Where the worker processes connect to, if processes > 1.
+    :return: The new snapshot's name.
+    """
+    store = ChunkStore(archive)
+    cursor = connection.cursor()
+    owned = connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    if owned:
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+    if corpora:
+        cursor.execute("SELECT id FROM an_corpora WHERE name = ANY(%s) ORDER BY id", (list(corpora),))
+    else:
+        cursor.execute("SELECT id FROM an_corpora WHERE archived_on IS NULL ORDER BY id")
+    corpus_ids = [row[0] for row in cursor.fetchall()]
+
+    # Asset id -> encoded binary columns, from the previous snapshot
+    previous = {}
+    snapshots = store.list_snapshots()
+    parent = snapshots[-1] if snapshots and not full else None
+    if parent:
+        for entry in store.read_manifest(parent)["tables"]:
+            if entry["table"] not in BLOB_TABLES:
+                continue
+            for digest in entry["batches"]:
+                for row in store.get_rows(digest):
+                    previous[row["id"]] = row
+
+    pool = None
+    if processes > 1:
+        cursor.execute("SELECT pg_export_snapshot()")
+        pool = multiprocessing.Pool(processes, _init_worker, (database_url, archive, cursor.fetchone()[0]))
+
+    manifest = {"version": VERSION, "created": datetime.utcnow().isoformat(), "parent": parent,
+                "corpora": corpus_ids, "tables": []}
+    try:
+        for table, condition in TABLES:
+            columns = table_columns(cursor, table)
+            binary_columns = [name for name, data_type in columns if data_type == "bytea"]
+            blobs_separately = table in BLOB_TABLES and binary_columns
+            # Only whether the blobs are there, for now: their content is read below if needs be
+            select = ", ".join("{0} IS NOT NULL AS {0}".format(name) if blobs_separately and name in binary_columns
+                               else name for name, _ in columns)
+
+            batches = []
+            rows = connection.cursor(name="snapshot_" + table)
+            rows.itersize = BATCH_ROWS
+            rows.execute("SELECT {} FROM {} WHERE {} ORDER BY id".format(select, table, condition),
+                         {"corpora": corpus_ids})
+            batch = []
+            for values in rows:
+                row = dict(zip([name for name, _ in columns], values))
+                if not blobs_separately:
+                    for name in binary_columns:
+                        row[name] = encode_binary(store, row[name])
+                batch.append(row)
+                if len(batch) == BATCH_ROWS:
+                    batches.append(batch)
+                    batch = []
+            if batch:
+                batches.append(batch)
+            rows.close()
+
+            if blobs_separately:
+                # Re-use the previous snapshot's chunks for Assets it had (with the same columns present)
+                wanted = []
+                for batch in batches:
+                    ids = []
+                    for row in batch:
+                        old = previous.get(row["id"])
+                        if old and all((old.get(name) is not None) == row[name] for name in binary_columns):
+                            row.update({name: old.get(name) for name in binary_columns})
+                        else:
+                            ids.append(row["id"])
+                    wanted.append((table, binary_columns, ids))
+                if pool:
+                    results = pool.imap(_read_blobs_in_worker, wanted)
+                else:
+                    results = (_read_blobs(connection, store, *args) for args in wanted)
+                for batch, blobs in zip(batches, results):
+                    for row in batch:
+                        row.update(blobs.get(row["id"], {}))
+
+            manifest["tables"].append({"table": table, "columns": columns, "rows": sum(len(b) for b in batches),
+                                       "batches": [store.put_rows(b) for b in batches]})
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        # Only once the workers are done, as they're reading its snapshot
+        if owned:
+            connection.rollback()
+
+    name = datetime.utcnow().strftime("%Y%m%dT%H%M%S%fZ")
+    store.write_manifest(name, manifest)
+    return name
+
+
+def restore_snapshot(connection, archive: str, name: str = None, database_url: str = None,
+                     processes: int = 1) -> dict:
+    """
+    Loads a snapshot (the latest by default) into an empty database. With processes > 1,
+    each table's batches are inserted (and committed) in parallel by worker processes
+    connecting to database_url, otherwise everything goes through connection, uncommitted.
+    :return: A map from each table to the number of rows restored.
+    """
+    store = ChunkStore(archive)
+    name = name or store.list_snapshots()[-1]
+    manifest = store.read_manifest(name)
+    if manifest["version"] != VERSION:
+        raise ValueError("Unsupported snapshot version {}".format(manifest["version"]))
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (database_url, archive))
+    counts = {}
+    cursor = connection.cursor()
+    try:
+        for entry in manifest["tables"]:
+            table = entry["table"]
+            columns = [tuple(c) for c in entry["columns"]]
+            work = [(table, columns, digest) for digest in entry["batches"]]
+            if pool:
+                restored = sum(pool.imap_unordered(_insert_rows_in_worker, work))
+            else:
+                restored = sum(_insert_rows(connection, store, *args) for args in work)
+            counts[table] = counts.get(table, 0) + restored
+            # Carry on handing out identifiers from where the snapshot left off
+            cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), max(id)) FROM {} HAVING max(id) IS NOT NULL"
+                           .format(table), (table,))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Takes and restores corpus-level snapshots of Annotatron.")
+    parser.add_argument("command", choices=["take", "restore", "list"])
+    parser.add_argument("archive", help="Directory holding the snapshots")
+    parser.add_argument("--database", default=config.load_settings().database_url)
+    parser.add_argument("--corpus", action="append", help="Only snapshot this corpus (may be repeated)")
+    parser.add_argument("--full", action="store_true", help="Don't re-use the previous snapshot's asset content")
+    parser.add_argument("--snapshot", help="Restore this snapshot, rather than the latest")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "list":
+        for snapshot in ChunkStore(args.archive).list_snapshots():
+            print(snapshot)
+    else:
+        connection = create_engine(args.database).raw_connection()
+        if args.command == "take":
+            logging.info("Wrote snapshot %s", take_snapshot(connection, args.archive, args.corpus, args.full,
+                                                            args.database, args.processes))
+        else:
+            for table, count in restore_snapshot(connection, args.archive, args.snapshot, args.database,
+                                                 args.processes).items():
+                logging.info("Restored %d rows into %s", count, table)
+        connection.commit()
+        connection.close()
@@ -0,0 +1,98 @@
+from falcon import testing
+import falcon
+import numpy as np
+
+from aggregation import majority_vote, segment_iou, summarise_groups, aggregate_corpus
+from models import InternalAnnotation, InternalCorpus
+from test_asset import TestAssetLifecycleWithDefaultFileBase
+
+
+class TestSummaryFunctions(testing.TestCase):
+
+    def test_majority_vote(self):
+        votes = majority_vote([["cat", "dog", "dog"], ["mongoose"], ["b", "a"]])
+        self.assertEqual(votes[0], ("dog", 2, 3))
+        self.assertEqual(votes[1], ("mongoose", 1, 1))
+        # Ties go to whichever label sorts first
+        self.assertEqual(votes[2], ("a", 1, 2))
+
+    def test_identical_segmentations_agree(self):
+        boundaries = [np.array([0.0, 1.0, 2.0])] * 2
+        labels = [np.array([0, 1, 0])] * 2
+        np.testing.assert_allclose(segment_iou(boundaries, labels), np.ones((2, 2)))
+
+    def test_disjoint_segmentations_disagree(self):
+        boundaries = [np.array([0.0, 1.0]), np.array([0.0, 1.0])]
+        labels = [np.array([0, 0]), np.array([1, 1])]
+        iou = segment_iou(boundaries, labels)
+        self.assertEqual(iou[0, 1], 0.0)
+
+    def test_skips_segmentations_missing_labels(self):
+        rows = summarise_groups([{
+            "assetId": 1, "summaryCode": "WORDS", "kind": "TimeSeriesSegmentationAnnotation",
+            "contents": [{"segments": [0.0, 1.0], "annotations": ["hi", "there"]},
+                         {"segments": [0.0, 1.0, 2.0], "annotations": ["hi"]}],
+        }, {
+            "assetId": 2, "summaryCode": "WORDS", "kind": "TimeSeriesSegmentationAnnotation",
+            "contents": [{"segments": [0.0, 1.0], "annotations": []}],
+        }])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["content"]["annotations"], ["hi", "there"])
+        self.assertEqual(rows[0]["content"]["agreement"]["annotators"], 1)
+
+    def test_summarise_multiple_choice(self):
+        rows = summarise_groups([{
+            "assetId": 1, "summaryCode": "ANIMALS", "kind": "MultipleChoiceAnnotation",
+            "contents": [{"choices": ["Dog", "Cat"]}, {"choices": ["Cat", "Dog"]}, {"choices": ["Cat"]}],
+        }])
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["source"], "Aggregated")
+        self.assertEqual(rows[0]["content"]["choices"], ["Cat", "Dog"])
+        self.assertAlmostEqual(rows[0]["content"]["agreement"]["support"], 2 / 3)
+
+
+class TestAggregateCorpus(TestAssetLifecycleWithDefaultFileBase):
+
+    def test_approved_responses_are_aggregated(self):
+        user_id = self.get_current_user_id()
+        question = {
+            "created": "2018-04-23T18:25:43.511000Z",
+            "summaryCode": "WORDS",
+            "humanPrompt": "Divide this audio file into words",
+            "kind": "TimeSeriesSegmentationQuestion",
+            "annotationInstructions": "Click between each word",
+            "detailedAnnotationInstructions": "So much more to say",
+            "maximumSegments": 5,
+            "minimumSegments": 1,
+            "segmentChoices": ["hi", "world"],
+            "freeFormAllowed": True,
+            "assets": None,
+        }
+        response = self.simulate_post("/assignments/test_corpus/", json={
+            "assets": [self.get_default_file_id()],
+            "assignedUserId": user_id,
+            "assignedAnnotatorId": user_id,
+            "question": question,
+        })
+        inserted_id = response.json["insertedId"]
+        response = self.simulate_patch("/assignments/{}/submit".format(inserted_id), json={
+            "notes": "",
+            "response": {
+                "created": "2018-04-23T18:25:43.511000Z",
+                "kind": "TimeSeriesSegmentationAnnotation",
+                "source": "Human",
+                "summaryCode": "WORDS",
+                "segments": [0.1, 2.0],
+                "annotations": ["hello", "world"]
+            }
+        })
+        self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+        self.assertEqual(self.session.query(InternalAnnotation).filter_by(source="Human").count(), 1)
+
+        corpus = self.session.query(InternalCorpus).filter_by(name="test_corpus").one()
+        result = aggregate_corpus(self.session, corpus.id, processes=1)
+        self.assertEqual(result["written"], 1)
+
+        aggregated = self.session.query(InternalAnnotation).filter_by(source="Aggregated").one()
+        self.assertEqual(aggregated.content["segments"], [0.1, 2.0])
+        self.assertEqual(aggregated.content["agreement"]["annotators"], 1)
@@ -0,0 +1,75 @@
+from collections import Counter
+from datetime import datetime
+
+from falcon import testing
+
+import fixtures
+from agreement import AgreementController, item_contribution, krippendorff_alpha, fleiss_kappa, cohen_kappa
+from models import InternalAgreementStats, InternalAnnotation, InternalAsset, InternalUser
+from test_users import MyTestCase
+
+
+class TestAgreementStatistics(testing.TestCase):
+
+    def build_stats(self, items):
+        stats = InternalAgreementStats(items=0, pairable=0, observed_agreement=0.0, fleiss_sum_p=0.0,
+                                       category_totals={})
+        for ratings in items:
+            AgreementController._apply(stats, item_contribution(Counter(ratings)), 1)
+        return stats
+
+    def test_two_raters(self):
+        stats = self.build_stats([["a", "a"], ["a", "b"], ["b", "b"], ["c"]])
+        self.assertAlmostEqual(krippendorff_alpha(stats), 4 / 9)
+        self.assertAlmostEqual(fleiss_kappa(stats), 1 / 3)
+        self.assertAlmostEqual(cohen_kappa({("a", "a"): 1, ("a", "b"): 1, ("b", "b"): 1}), 0.4)
+
+    def test_incremental_matches_batch(self):
+        incremental = self.build_stats([["a", "b"]])
+        before, after = Counter(["a", "b"]), Counter(["a", "b", "a"])
+        AgreementController._apply(incremental, item_contribution(before), -1)
+        AgreementController._apply(incremental, item_contribution(after), 1)
+
+        batch = self.build_stats([["a", "b", "a"]])
+        self.assertEqual(incremental.pairable, batch.pairable)
+        self.assertAlmostEqual(incremental.observed_agreement, batch.observed_agreement)
+        self.assertAlmostEqual(incremental.fleiss_sum_p, batch.fleiss_sum_p)
+        self.assertEqual(incremental.category_totals, batch.category_totals)
+
+    def test_undefined_without_pairs(self):
+        stats = self.build_stats([["a"], ["b"]])
+        self.assertIsNone(krippendorff_alpha(stats))
+        self.assertIsNone(fleiss_kappa(stats))
+
+
+class TestAgreementController(MyTestCase):
+
+    def rate(self, asset, annotator_id, label):
+        annotation = {"kind": "TextAnnotation", "content": label, "summaryCode": "CODE"}
+        AgreementController(self.session).record_rating(asset.corpus_id, "CODE", asset.id, annotator_id, annotation)
+        self.session.add(InternalAnnotation(source="Human", summary_code="CODE", kind="TextAnnotation",
+                                            content=annotation, asset_id=asset.id, annotator_id=annotator_id,
+                                            created=datetime.utcnow()))
+        self.session.flush()
+
+    def test_incremental_matches_rebuild(self):
+        fixtures.seed_corpora(self.session, users=3, corpora=1, assets=4, questions=0, assignments=0)
+        users = [u for u, in self.session.query(InternalUser.id).order_by(InternalUser.id)]
+        assets = self.session.query(InternalAsset).order_by(InternalAsset.id).all()
+        for asset, labels in zip(assets, ["aab", "bbb", "abb", "aa"]):
+            for user_id, label in zip(users, labels):
+                self.rate(asset, user_id, label)
+        controller = AgreementController(self.session)
+        incremental = controller.get_metrics(assets[0].corpus_id)["CODE"]
+        self.assertEqual(incremental["annotatorPairs"], 3)
+        # users[0] and users[1] rated (a, a), (b, b), (a, b) and (a, a)
+        self.assertAlmostEqual(incremental["cohenKappa"], sum(cohen_kappa(c) for c in [
+            {("a", "a"): 2, ("b", "b"): 1, ("a", "b"): 1},
+            {("a", "b"): 2, ("b", "b"): 1},
+            {("a", "b"): 1, ("b", "b"): 2},
+        ]) / 3)
+
+        controller.rebuild(assets[0].corpus_id)
+        rebuilt = controller.get_metrics(assets[0].corpus_id)["CODE"]
+        self.assertEqual(rebuilt["annotatorPairs"], incremental["annotatorPairs"])
+        self.assertAlmostEqual(rebuilt["cohenKappa"], incremental["cohenKappa"])
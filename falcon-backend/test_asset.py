@@ -31,6 +31,14 @@ class TestAssetLifecycleUpload(TestAssetLifecycleBase):
     def test_asset_upload(self):
         self.create_default_asset()
 
+    def test_checksum_mismatch_rejected(self):
+        b = BinaryAsset(content=b"hello", metadata={}, copyright="No redistribution", mime_type="text/plain",
+                        type_description=BinaryAssetKind.UTF8_TEXT, checksum=hashlib.sha512(b"world").hexdigest())
+        response = self.simulate_post("/corpus/test_corpus/assets/mismatch", json=b.to_json())
+        self.assertEqual(response.status, falcon.HTTP_NOT_ACCEPTABLE)
+        response = self.simulate_get("/corpus/test_corpus/assets")
+        self.assertEqual(response.json, [])
+
     def test_corpus_initially_empty(self):
         response = self.simulate_get("/corpus/test_corpus/assets")
         self.assertEqual(response.status, falcon.HTTP_OK)
@@ -77,3 +85,74 @@ class TestAssetLifecycleWithDefaultFile(TestAssetLifecycleWithDefaultFileBase):
     def test_delete(self):
         response = self.simulate_delete("/corpus/test_corpus/assets/testFile")
         self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+
+    def test_metadata_query(self):
+        asset_id = self.get_default_file_id()
+        response = self.simulate_get("/corpus/test_corpus/assets",
+                                     params={"contains": '{"someKey": {"someChildKey": "someValue"}}'})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertEqual(response.json["assets"], [{"id": asset_id, "name": "testFile"}])
+        self.assertIsNone(response.json["next"])
+
+        response = self.simulate_get("/corpus/test_corpus/assets", params={"path": '$.someKey ? (@.someChildKey == "x")'})
+        self.assertEqual(response.json["assets"], [])
+
+        response = self.simulate_get("/corpus/test_corpus/assets", params={"path": "$$$"})
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+
+        response = self.simulate_get("/corpus/test_corpus/assets", params={"path": "$", "after": "abc"})
+        self.assertEqual(response.status, falcon.HTTP_BAD_REQUEST)
+
+    def test_deleted_asset_not_found(self):
+        self.simulate_delete("/corpus/test_corpus/assets/testFile")
+        response = self.simulate_get("/corpus/test_corpus/assets/testFile")
+        self.assertEqual(response.status, falcon.HTTP_NOT_FOUND)
+
+
+class TestCorpusCloning(TestAssetLifecycleWithDefaultFileBase):
+
+    def test_clone_shares_content(self):
+        response = self.simulate_post("/corpus/test_corpus/clone", json={"name": "test_clone"})
+        self.assertEqual(response.status, falcon.HTTP_201)
+        self.assertEqual(response.json["assets"], 1)
+        self.assertEqual(self.session.execute("SELECT COUNT(content) FROM an_assets").scalar(), 1)
+
+        response = self.simulate_post("/corpus/test_corpus/clone", json={"name": "test_clone"})
+        self.assertEqual(response.status, falcon.HTTP_CONFLICT)
+
+        # Deleting the original hands its content on to the copy
+        self.simulate_delete("/corpus/test_corpus/assets/testFile")
+        response = self.simulate_get("/corpus/test_clone/assets/testFile")
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        response = self.simulate_get("/asset/{}/content".format(response.json["id"]))
+        self.assertEqual(response.content, "ハロー・ワールド".encode("utf8"))
+
+class TestAssetCaching(TestAssetLifecycleWithDefaultFileBase):
+
+    def setUp(self):
+        super().setUp()
+        m = hashlib.sha512()
+        m.update("ハロー・ワールド".encode("utf8"))
+        self.etag = '"{}"'.format(m.hexdigest())
+
+    def test_info_not_modified(self):
+        response = self.simulate_get("/corpus/test_corpus/assets/testFile")
+        self.assertEqual(response.headers["etag"], self.etag)
+
+        response = self.simulate_get("/corpus/test_corpus/assets/testFile", headers={"If-None-Match": self.etag})
+        self.assertEqual(response.status, falcon.HTTP_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+    def test_content_not_modified(self):
+        asset_id = self.get_default_file_id()
+        response = self.simulate_get("/asset/{}/content".format(asset_id))
+        self.assertEqual(response.headers["etag"], self.etag)
+        self.assertIn("immutable", response.headers["cache-control"])
+
+        response = self.simulate_get("/asset/{}/content".format(asset_id), headers={"If-None-Match": self.etag})
+        self.assertEqual(response.status, falcon.HTTP_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+        response = self.simulate_get("/asset/{}/content".format(asset_id), headers={"If-None-Match": '"stale"'})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertEqual(response.content, "ハロー・ワールド".encode("utf8"))
@@ -1,9 +1,11 @@
 from falcon import testing
 import falcon
+import base64
 import hashlib
 
-from pyannotatron.models import Question
+from pyannotatron.models import Question, BinaryAsset, BinaryAssetKind, UserKind
 
+from main import obfuscate_int64_field
 from test_asset import TestAssetLifecycleWithDefaultFileBase
 
 
@@ -185,3 +187,328 @@ class TestAssignmentLifecycle(TestAssetLifecycleWithDefaultFileBase):
         # TODO: make sure this appears in the Corpus' approved list.
         
         """
+
+
+class TestCorpusArchival(TestAssetLifecycleWithDefaultFileBase):
+
+    def test_archive_detaches_partitions(self):
+        user_id = self.get_current_user_id()
+        response = self.simulate_post("/assignments/test_corpus/", json={
+            "assets": [self.get_default_file_id()],
+            "assignedUserId": user_id,
+            "assignedAnnotatorId": user_id,
+            "question": {
+                "created": "2018-04-23T18:25:43.511000Z",
+                "summaryCode": "WORDS",
+                "humanPrompt": "Divide this audio file into words",
+                "kind": "TimeSeriesSegmentationQuestion",
+                "annotationInstructions": "Click between each word",
+                "detailedAnnotationInstructions": "So much more to say",
+                "maximumSegments": 5,
+                "minimumSegments": 1,
+                "segmentChoices": ["hi", "world"],
+                "freeFormAllowed": True,
+                "assets": None,
+            },
+        })
+        self.assertEqual(response.status, falcon.HTTP_CREATED)
+        corpus_id = self.session.execute("SELECT id FROM an_corpora WHERE name = 'test_corpus'").scalar()
+
+        response = self.simulate_post("/corpus/test_corpus/archive", json={})
+        self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+
+        # The Assignment is no longer part of an_assignments, but survives in the detached partition
+        response = self.simulate_get("/assignments/byCorpus/test_corpus/")
+        self.assertEqual(response.json["forAnnotation"], [])
+        self.assertEqual(self.session.execute(
+            "SELECT COUNT(*) FROM an_assignments_c{}".format(corpus_id)).scalar(), 1)
+        self.assertEqual(self.session.execute(
+            "SELECT COUNT(*) FROM an_assignments_assets_xref_c{}".format(corpus_id)).scalar(), 1)
+
+        response = self.simulate_post("/corpus/test_corpus/archive", json={})
+        self.assertEqual(response.status, falcon.HTTP_CONFLICT)
+
+
+class TestAssignmentBase(TestAssetLifecycleWithDefaultFileBase):
+
+    QUESTION = {
+        "created": "2018-04-23T18:25:43.511000Z",
+        "summaryCode": "WORDS",
+        "humanPrompt": "Divide this audio file into words",
+        "kind": "TimeSeriesSegmentationQuestion",
+        "annotationInstructions": "Click between each word",
+        "detailedAnnotationInstructions": "So much more to say",
+        "maximumSegments": 5,
+        "minimumSegments": 1,
+        "segmentChoices": ["hi", "world"],
+        "freeFormAllowed": True,
+        "assets": None,
+    }
+
+    RESPONSE = {
+        "created": "2018-04-23T18:25:43.511000Z",
+        "kind": "TimeSeriesSegmentationAnnotation",
+        "source": "Human",
+        "summaryCode": "WORDS",
+        "segments": [0.1, 2.0],
+        "annotations": ["hello", "world"]
+    }
+
+    def create_assignment(self, user_id, asset_id, question=None, reviewer_id=None):
+        response = self.simulate_post("/assignments/test_corpus/", json={
+            "assets": [asset_id],
+            "assignedUserId": user_id,
+            "assignedAnnotatorId": user_id,
+            "assignedReviewerId": reviewer_id,
+            "question": question or self.QUESTION,
+        })
+        self.assertEqual(response.status, falcon.HTTP_CREATED)
+        return response.json["insertedId"]
+
+    def assignment_states(self):
+        return self.session.execute("SELECT state, assigned_user_id = annotator_id FROM an_assignments "
+                                    "ORDER BY id").fetchall()
+
+    def count_human_annotations(self):
+        return self.session.execute("SELECT COUNT(*) FROM an_annotations WHERE source = 'Human'").scalar()
+
+
+class TestAssignmentBundle(TestAssignmentBase):
+
+    def test_bundle_with_prefetch(self):
+        user_id = self.get_current_user_id()
+        asset_id = self.get_default_file_id()
+        inserted = [self.create_assignment(user_id, asset_id) for _ in range(3)]
+
+        response = self.simulate_get("/assignments/{}/bundle".format(inserted[0]), params={"prefetch": 5})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertEqual(response.json["id"], inserted[0])
+        self.assertEqual(response.json["question"]["summaryCode"], "WORDS")
+        asset = response.json["assets"][0]
+        self.assertEqual(asset["id"], asset_id)
+        self.assertEqual(base64.b64decode(asset["content"]), "ハロー・ワールド".encode("utf8"))
+        self.assertEqual([a["id"] for a in response.json["prefetched"]], inserted[1:])
+
+        response = self.simulate_get("/assignments/{}/bundle".format(inserted[0]), params={"inline": 0})
+        self.assertNotIn("content", response.json["assets"][0])
+        self.assertEqual(response.json["prefetched"], [])
+
+    def test_multipart_bundle(self):
+        user_id = self.get_current_user_id()
+        asset_id = self.get_default_file_id()
+        inserted = self.create_assignment(user_id, asset_id)
+
+        response = self.simulate_get("/assignments/{}/bundle".format(inserted),
+                                     headers={"Accept": "multipart/mixed, application/json;q=0.5"})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertTrue(response.headers["content-type"].startswith("multipart/mixed"))
+        self.assertIn("Content-ID: <{}>".format(asset_id).encode("ascii"), response.content)
+        self.assertIn("ハロー・ワールド".encode("utf8"), response.content)
+
+
+class TestAssignmentReview(TestAssignmentBase):
+
+    def submit_for_review(self):
+        user_id = self.get_current_user_id()
+        inserted = self.create_assignment(user_id, self.get_default_file_id(), reviewer_id=user_id)
+        response = self.simulate_patch("/assignments/{}/submit".format(inserted),
+                                       json={"notes": "a", "response": self.RESPONSE})
+        self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+        self.assertEqual(self.assignment_states(), [("pending", False)])
+        return inserted
+
+    def test_approve(self):
+        inserted = self.submit_for_review()
+        response = self.simulate_patch("/assignments/{}/approve".format(inserted), json={"notes": "OK"})
+        self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+        self.assertEqual(self.assignment_states(), [("approved", None)])
+        self.assertEqual(self.count_human_annotations(), 1)
+
+        # Approving again would count the annotation twice
+        response = self.simulate_patch("/assignments/{}/approve".format(inserted), json={"notes": "OK"})
+        self.assertEqual(response.status, falcon.HTTP_CONFLICT)
+        self.assertEqual(self.count_human_annotations(), 1)
+
+    def test_reject(self):
+        inserted = self.submit_for_review()
+        response = self.simulate_patch("/assignments/{}/reject".format(inserted), json={"notes": "What?"})
+        self.assertEqual(response.status, falcon.HTTP_ACCEPTED)
+        self.assertEqual(self.assignment_states(), [("created", True)])
+        self.assertEqual(self.count_human_annotations(), 0)
+
+        response = self.simulate_patch("/assignments/{}/reject".format(inserted), json={"notes": "What?"})
+        self.assertEqual(response.status, falcon.HTTP_CONFLICT)
+
+    def test_batch_approve_and_reject(self):
+        approved, rejected = self.submit_for_review(), self.submit_for_review()
+        response = self.simulate_patch("/assignments/batch", json={"actions": [
+            {"id": approved, "action": "approve", "notes": "OK"},
+            {"id": rejected, "action": "reject", "notes": "What?"},
+            {"id": approved, "action": "approve", "notes": "Again"},
+            {"id": obfuscate_int64_field(2 ** 40), "action": "approve", "notes": "Not an Assignment"},
+        ]})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        results = response.json["results"]
+        self.assertEqual([r["status"] for r in results], ["applied", "applied", "rejected", "rejected"])
+        self.assertEqual([r["code"] for r in results], [202, 202, 409, 404])
+        self.assertEqual(self.assignment_states(), [("approved", None), ("created", True)])
+        self.assertEqual(self.count_human_annotations(), 1)
+
+
+class TestAssignmentBatch(TestAssignmentBase):
+
+    def test_batch_submit(self):
+        user_id = self.get_current_user_id()
+        asset_id = self.get_default_file_id()
+        inserted = [self.create_assignment(user_id, asset_id) for _ in range(3)]
+        response_json = {
+            "created": "2018-04-23T18:25:43.511000Z",
+            "kind": "TimeSeriesSegmentationAnnotation",
+            "source": "Human",
+            "summaryCode": "WORDS",
+            "segments": [0.1, 2.0],
+            "annotations": ["hello", "world"]
+        }
+
+        response = self.simulate_patch("/assignments/batch", json={"actions": [
+            {"id": inserted[0], "action": "submit", "notes": "a", "response": response_json},
+            {"id": inserted[1], "action": "approve", "notes": "b", "response": response_json},
+            {"id": inserted[2], "action": "frobnicate"},
+            {"id": inserted[2], "action": "submit", "notes": "c", "response": 42},
+            {"id": inserted[2], "action": "submit", "notes": "c", "response": response_json},
+        ]})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        results = response.json["results"]
+        self.assertEqual([r["status"] for r in results], ["applied", "rejected", "rejected", "rejected", "applied"])
+        self.assertEqual([r["code"] for r in results], [202, 403, 406, 400, 202])
+        self.assertEqual(results[1]["id"], inserted[1])
+
+        response = self.simulate_get("/assignments/byCorpus/test_corpus/")
+        self.assertEqual(sorted(response.json["completed"]), sorted([inserted[0], inserted[2]]))
+        self.assertEqual(response.json["forAnnotation"], [inserted[1]])
+        self.assertEqual(self.session.execute("SELECT COUNT(*) FROM an_assignment_history").scalar(), 2)
+
+    def test_dense_segmentation_packed(self):
+        user_id = self.get_current_user_id()
+        inserted = self.create_assignment(user_id, self.get_default_file_id())
+        response_json = {
+            "created": "2018-04-23T18:25:43.511000Z",
+            "kind": "TimeSeriesSegmentationAnnotation",
+            "source": "Human",
+            "summaryCode": "WORDS",
+            "segments": [i * 0.25 for i in range(1000)],
+            "annotations": ["hello", "world"] * 500
+        }
+
+        response = self.simulate_patch("/assignments/batch", json={"actions": [
+            {"id": inserted, "action": "submit", "notes": "a", "response": response_json},
+        ]})
+        self.assertEqual(response.json["results"][0]["status"], "applied")
+        self.assertEqual(self.session.execute(
+            "SELECT COUNT(*) FROM an_assignments WHERE response_packed IS NOT NULL").scalar(), 1)
+        # The labels are still searchable
+        self.assertEqual(self.session.execute(
+            "SELECT COUNT(*) FROM an_assignments WHERE search_vector @@ to_tsquery('english', 'world')").scalar(), 1)
+
+        response = self.simulate_get("/assignments/{}".format(inserted))
+        self.assertEqual(response.json["response"]["segments"], response_json["segments"])
+        self.assertEqual(response.json["response"]["annotations"], response_json["annotations"])
+
+
+class TestAssignmentSharedQuestion(TestAssignmentBase):
+
+    def count_inline_questions(self):
+        return self.session.execute("SELECT COUNT(*) FROM an_assignments WHERE question IS NOT NULL").scalar()
+
+    def test_question_stored_once(self):
+        user_id = self.get_current_user_id()
+        asset_id = self.get_default_file_id()
+        ad_hoc = self.create_assignment(user_id, asset_id)
+        self.assertEqual(self.count_inline_questions(), 1)
+
+        response = self.simulate_post("/corpus/test_corpus/questions", json=Question.from_json(self.QUESTION).to_json())
+        question_id = response.json["insertedId"]
+        by_content = self.create_assignment(user_id, asset_id)
+        by_id = self.create_assignment(user_id, asset_id, dict(self.QUESTION, id=question_id))
+        self.assertEqual(self.count_inline_questions(), 1)
+
+        for inserted in [ad_hoc, by_content, by_id]:
+            response = self.simulate_get("/assignments/{}".format(inserted))
+            self.assertEqual(response.json["question"]["humanPrompt"], self.QUESTION["humanPrompt"])
+
+        response = self.simulate_delete("/corpus/test_corpus/questions/{}".format(question_id))
+        self.assertEqual(response.status, falcon.HTTP_CONFLICT)
+
+
+class TestAssignmentMaterialisation(TestAssignmentBase):
+
+    def create_asset(self, name, metadata):
+        content = name.encode("utf8")
+        b = BinaryAsset(content=content, metadata=metadata, copyright="No redistribution", mime_type="text/plain",
+                        type_description=BinaryAssetKind.UTF8_TEXT, checksum=hashlib.sha512(content).hexdigest())
+        response = self.simulate_post("/corpus/test_corpus/assets/{}".format(name), json=b.to_json())
+        self.assertEqual(response.status, falcon.HTTP_201)
+
+    def create_question(self):
+        response = self.simulate_post("/corpus/test_corpus/questions", json=Question.from_json(self.QUESTION).to_json())
+        return response.json["insertedId"]
+
+    def assignments_by_asset(self):
+        ret = {}
+        for annotator_id, asset_id in self.session.execute(
+                "SELECT a.annotator_id, x.asset_id FROM an_assignments a "
+                "JOIN an_assignments_assets_xref x ON x.assignment_id = a.id AND x.corpus_id = a.corpus_id "
+                "WHERE a.question_id IS NOT NULL"):
+            ret.setdefault(asset_id, []).append(annotator_id)
+        return ret
+
+    def test_round_robin(self):
+        for i in range(5):
+            self.create_asset("clip{}".format(i), {"speaker": "a" if i < 3 else "b"})
+        annotators = [id for id, user in self.user_map.items() if user.role in (UserKind.ANNOTATOR, UserKind.REVIEWER)]
+        response = self.simulate_post("/corpus/test_corpus/questions/{}".format(self.create_question()), json={
+            "annotators": annotators, "assets": {"contains": {"speaker": "a"}}, "annotatorsPerAsset": 2,
+        })
+        self.assertEqual(response.status, falcon.HTTP_CREATED)
+        self.assertEqual(response.json["assignments"], 6)
+
+        by_asset = self.assignments_by_asset()
+        self.assertEqual(len(by_asset), 3)
+        for annotator_ids in by_asset.values():
+            self.assertEqual(len(set(annotator_ids)), 2)
+        counts = {}
+        for annotator_ids in by_asset.values():
+            for annotator_id in annotator_ids:
+                counts[annotator_id] = counts.get(annotator_id, 0) + 1
+        self.assertEqual(sorted(counts.values()), [3, 3])
+
+    def test_load_balanced(self):
+        for i in range(3):
+            self.create_asset("clip{}".format(i), {"speaker": "a"})
+        question_id = self.create_question()
+        busy = self.get_current_user_id()
+        idle = [id for id, user in self.user_map.items() if user.role == UserKind.ANNOTATOR][0]
+        self.create_assignment(busy, self.get_default_file_id(), dict(self.QUESTION, id=question_id))
+
+        response = self.simulate_post("/corpus/test_corpus/questions/{}".format(question_id), json={
+            "annotators": [busy, idle], "assets": {"path": '$.speaker ? (@ == "a")'}, "distribution": "loadBalanced",
+        })
+        self.assertEqual(response.status, falcon.HTTP_CREATED)
+        self.assertEqual(response.json["assignments"], 3)
+        loads = self.session.execute("SELECT annotator_id, COUNT(*) FROM an_assignments GROUP BY annotator_id")
+        self.assertEqual(sorted(count for _, count in loads), [2, 2])
+
+    def test_rejects_bad_requests(self):
+        question_id = self.create_question()
+        response = self.simulate_post("/corpus/test_corpus/questions/{}".format(question_id), json={
+            "annotators": [self.get_current_user_id()], "distribution": "random",
+        })
+        self.assertEqual(response.status, falcon.HTTP_NOT_ACCEPTABLE)
+        response = self.simulate_post("/corpus/test_corpus/questions/{}".format(question_id), json={
+            "annotators": [self.get_current_user_id()], "annotatorsPerAsset": 2,
+        })
+        self.assertEqual(response.status, falcon.HTTP_NOT_ACCEPTABLE)
+        response = self.simulate_post("/corpus/no_such_corpus/questions/{}".format(question_id), json={
+            "annotators": [self.get_current_user_id()],
+        })
+        self.assertEqual(response.status, falcon.HTTP_NOT_FOUND)
@@ -0,0 +1,49 @@
+from falcon import testing
+
+from benchmark import Recorder, Scale, InProcessTransport, percentile, summarise, compare_results, seed, run_workload
+from test_users import MyTestCase
+
+
+class TestBenchmarkReporting(testing.TestCase):
+
+    def test_percentile(self):
+        samples = [float(x) for x in range(1, 101)]
+        self.assertEqual(percentile(samples, 50), 50.0)
+        self.assertEqual(percentile(samples, 95), 95.0)
+        self.assertEqual(percentile(samples, 99), 99.0)
+        self.assertEqual(percentile([3.0], 99), 3.0)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarise(self):
+        recorder = Recorder()
+        recorder.samples["GET /corpus"] = [0.3, 0.1, 0.2]
+        recorder.errors["GET /corpus"] = 1
+        summary = summarise(recorder, 2.0)
+        self.assertEqual(summary["GET /corpus"]["count"], 3)
+        self.assertEqual(summary["GET /corpus"]["errors"], 1)
+        self.assertEqual(summary["GET /corpus"]["throughput"], 1.5)
+        self.assertEqual(summary["GET /corpus"]["p50"], 0.2)
+
+    def test_compare_flags_regressions(self):
+        previous = {"endpoints": {"GET /corpus": {"p95": 0.1}, "GET /jobs/{id}": {"p95": 0.1}}}
+        current = {"endpoints": {"GET /corpus": {"p95": 0.15}, "GET /jobs/{id}": {"p95": 0.11},
+                                 "GET /metrics": {"p95": 1.0}}}
+        regressions = compare_results(previous, current, tolerance=0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("GET /corpus"))
+
+
+class TestBenchmarkWorkload(MyTestCase):
+
+    def test_smoke_run(self):
+        scale = Scale(annotators=2, reviewers=1, assets=4, asset_size=64, assignments_per_annotator=2,
+                      assets_per_assignment=1, reviewed_fraction=0.5)
+        users = seed(self.session, scale)
+        # Every request goes through the test's one connection, so there's only one worker
+        recorder, elapsed = run_workload(InProcessTransport(self.app), users, concurrency=1, duration=10.0, warmup=0)
+        summary = summarise(recorder, elapsed)
+        for endpoint in ["GET /assignments/byUser/{id}", "PATCH /assignments/{id}/submit"]:
+            self.assertGreater(summary[endpoint]["count"], 0)
+            self.assertEqual(summary[endpoint]["errors"], 0)
+        # Each annotator submits everything they were given
+        self.assertGreaterEqual(summary["PATCH /assignments/{id}/submit"]["count"], 4)
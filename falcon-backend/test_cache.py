@@ -0,0 +1,38 @@
+from falcon import testing
+
+from cache import LRUCache, etag_matches
+
+
+class TestLRUCache(testing.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        c = LRUCache(2)
+        c.put(1, "a")
+        c.put(2, "b")
+        self.assertEqual(c.get(1), "a")
+        c.put(3, "c")
+        self.assertIsNone(c.get(2))
+        self.assertEqual(c.get(1), "a")
+        self.assertEqual(c.get(3), "c")
+        self.assertEqual(len(c), 2)
+
+    def test_get_or_create(self):
+        c = LRUCache(2)
+        self.assertEqual(c.get_or_create(1, lambda: "a"), "a")
+        self.assertEqual(c.get_or_create(1, lambda: "b"), "a")
+        self.assertIsNone(c.get_or_create(2, lambda: None))
+        self.assertEqual(len(c), 1)
+
+    def test_invalidate(self):
+        c = LRUCache(2)
+        c.put(1, "a")
+        c.invalidate(1)
+        c.invalidate(2)
+        self.assertIsNone(c.get(1))
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"abc"', "abc"))
+        self.assertTrue(etag_matches('"xyz", W/"abc"', "abc"))
+        self.assertTrue(etag_matches('*', "abc"))
+        self.assertFalse(etag_matches('"abcd"', "abc"))
+        self.assertFalse(etag_matches(None, "abc"))
@@ -0,0 +1,67 @@
+import gzip
+import hashlib
+
+import falcon
+from falcon import testing
+from pyannotatron.models import BinaryAsset, BinaryAssetKind
+
+from compression import negotiate, parse_accept_encoding
+from jobs import JobController
+from test_corpus import TestCaseWithDefaultCorpus
+
+
+class TestNegotiation(testing.TestCase):
+
+    def test_parse(self):
+        self.assertDictEqual(parse_accept_encoding("gzip, br;q=0.5, *;q=0"), {"gzip": 1.0, "br": 0.5, "*": 0.0})
+        self.assertDictEqual(parse_accept_encoding(None), {})
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate("gzip, br", ["zstd", "br", "gzip"]), "br")
+        self.assertEqual(negotiate("gzip;q=1, br;q=0.5", ["br", "gzip"]), "gzip")
+        self.assertEqual(negotiate("*", ["br", "gzip"]), "br")
+        self.assertIsNone(negotiate("identity", ["gzip"]))
+        self.assertIsNone(negotiate("gzip;q=0", ["gzip"]))
+        self.assertIsNone(negotiate(None, ["gzip"]))
+
+
+class TestCompressedResponses(TestCaseWithDefaultCorpus):
+
+    CONTENT = ("ハロー・ワールド " * 500).encode("utf8")
+
+    def setUp(self):
+        super().setUp()
+        b = BinaryAsset(content=self.CONTENT, metadata={}, copyright="No redistribution", mime_type="text/plain",
+                        type_description=BinaryAssetKind.UTF8_TEXT,
+                        checksum=hashlib.sha512(self.CONTENT).hexdigest())
+        response = self.simulate_post("/corpus/test_corpus/assets/longFile", json=b.to_json())
+        self.assertEqual(response.status, falcon.HTTP_201)
+        self.asset_id = self.simulate_get("/corpus/test_corpus/assets/longFile").json["id"]
+
+    def fetch(self, accept_encoding):
+        return self.simulate_get("/asset/{}/content".format(self.asset_id),
+                                 headers={"Accept-Encoding": accept_encoding})
+
+    def test_compressed_on_the_fly(self):
+        response = self.fetch("gzip")
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), self.CONTENT)
+        self.assertTrue(response.headers["etag"].startswith("W/"))
+
+    def test_identity(self):
+        response = self.fetch("identity")
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.content, self.CONTENT)
+
+    def test_served_precompressed(self):
+        job = JobController(self.session)
+        self.assertTrue(job.run_next_job())
+        self.assertEqual(len(self.session.execute("SELECT content_gzip FROM an_assets WHERE content_gzip IS NOT NULL")
+                             .fetchall()), 1)
+
+        response = self.fetch("gzip")
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), self.CONTENT)
+
+        response = self.fetch("identity")
+        self.assertEqual(response.content, self.CONTENT)
@@ -0,0 +1,37 @@
+from unittest import mock
+
+import fixtures
+from test_users import MyTestCase
+
+
+class TestFixtures(MyTestCase):
+
+    def count(self, table):
+        return self.connection.execute("SELECT COUNT(*) FROM {}".format(table)).scalar()
+
+    def test_template_named_after_schema(self):
+        name = fixtures.template_name("empty")
+        self.assertNotEqual(fixtures.template_name("corpora"), name)
+        with mock.patch("fixtures.read_schema", return_value=fixtures.read_schema() + "\n-- changed"):
+            self.assertNotEqual(fixtures.template_name("empty"), name)
+
+    def test_seed_corpora(self):
+        fixtures.seed_corpora(self.connection, users=10, corpora=2, assets=30, questions=3, assignments=40)
+        self.assertEqual(self.count("an_users"), 10)
+        self.assertEqual(self.count("an_user_tokens"), 10)
+        self.assertEqual(self.count("an_assets"), 30)
+        self.assertEqual(self.count("an_questions"), 6)
+        self.assertEqual(self.count("an_assignments"), 40)
+        self.assertEqual(self.count("an_assignments_assets_xref"), 40)
+        # Spread over all the corpora
+        self.assertEqual(self.connection.execute(
+            "SELECT COUNT(DISTINCT corpus_id) FROM an_assignments").scalar(), 2)
+
+
+class TestCorporaFixture(MyTestCase):
+    fixture = "corpora"
+
+    def test_copied_from_template(self):
+        sizes = fixtures.FIXTURES["corpora"]
+        self.assertEqual(self.connection.execute("SELECT COUNT(*) FROM an_assets").scalar(), sizes["assets"])
+        self.assertEqual(self.connection.execute("SELECT COUNT(*) FROM an_users").scalar(), sizes["users"])
@@ -0,0 +1,45 @@
+import falcon
+from falcon import testing
+
+import io
+
+from instrumentation import MetricsRegistry, _counted
+from test_users import TestCaseWithDefaultAdmin
+
+
+class TestMetricsRegistry(testing.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.record("/corpus", "GET", "200", 0.02, 3, 0.01, 5, 120)
+        registry.record("/corpus", "GET", "403", 0.2, 1, 0.001, 0, 0)
+        rendered = registry.render()
+
+        self.assertIn('annotatron_request_duration_seconds_bucket{route="/corpus",method="GET",le="0.025"} 1',
+                      rendered)
+        self.assertIn('annotatron_request_duration_seconds_count{route="/corpus",method="GET"} 2', rendered)
+        self.assertIn('annotatron_requests_total{route="/corpus",method="GET",status="403"} 1', rendered)
+        self.assertIn('annotatron_sql_rows_total{route="/corpus",method="GET"} 5', rendered)
+
+    def test_streamed_bytes(self):
+        registry = MetricsRegistry()
+        registry.record("/bundle", "GET", "200", 0.02, 3, 0.01, 5, 0)
+        for stream in [iter([b"abc", b"de"]), io.BytesIO(b"fgh")]:
+            b"".join(_counted(stream, lambda sent: registry.record_bytes("/bundle", "GET", sent)))
+        self.assertIn('annotatron_response_bytes_total{route="/bundle",method="GET"} 8', registry.render())
+
+
+class TestMetricsEndpoint(TestCaseWithDefaultAdmin):
+
+    def test_requests_are_counted(self):
+        self.simulate_get("/auth/users")
+        response = self.simulate_get("/metrics", headers={"Accept": "text/plain"})
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertIn('annotatron_requests_total{route="/auth/users",method="GET",status="200"} 1', response.text)
+        self.assertIn('annotatron_sql_statements_per_request_count{route="/auth/users",method="GET"} 1',
+                      response.text)
+
+    def test_requires_admin(self):
+        self.current_token = None
+        response = self.simulate_get("/metrics", headers={"Accept": "text/plain"})
+        self.assertEqual(response.status, falcon.HTTP_FORBIDDEN)
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import falcon
+from falcon import testing
+from pyannotatron.models import LoginRequest
+
+from jobs import JobController, sniff_mime_type, schedule_scrubbing
+from main import obfuscate_int64_field
+from models import InternalJob, InternalAsset
+from test_asset import TestAssetLifecycleBase
+
+
+class TestMimeSniffing(testing.TestCase):
+
+    def test_known_signatures(self):
+        self.assertEqual(sniff_mime_type(b"\x89PNG\r\n\x1a\nrest"), "image/png")
+        self.assertEqual(sniff_mime_type(b"RIFF\x00\x00\x00\x00WAVEfmt "), "audio/wav")
+        self.assertEqual(sniff_mime_type("ハロー・ワールド".encode("utf8")), "text/plain")
+        self.assertEqual(sniff_mime_type(b"\xff\xfe\x00\x81"), "application/octet-stream")
+
+
+class TestAssetProcessingJobs(TestAssetLifecycleBase):
+
+    def test_upload_returns_job(self):
+        self.create_default_asset()
+        job = self.session.query(InternalJob).one()
+        self.assertEqual(job.kind, "process_asset")
+        self.assertEqual(job.state, "queued")
+
+        controller = JobController(self.session)
+        self.assertTrue(controller.run_next_job())
+        self.assertFalse(controller.run_next_job())
+
+        self.session.refresh(job)
+        self.assertEqual(job.state, "done")
+        self.assertTrue(job.result["mimeTypeMatches"])
+
+    def test_job_status_resource(self):
+        self.create_default_asset()
+        job = self.session.query(InternalJob).one()
+        JobController(self.session).run_next_job()
+
+        response = self.simulate_get("/jobs/{}".format(obfuscate_int64_field(job.id)))
+        self.assertEqual(response.status, falcon.HTTP_OK)
+        self.assertEqual(response.json["state"], "done")
+
+        # Only administrators and whoever queued the job can see it
+        login_request = LoginRequest("staff", "kerflaag")
+        self.current_token = self.simulate_post("/auth/token", json=login_request.to_json()).json["token"]
+        response = self.simulate_get("/jobs/{}".format(obfuscate_int64_field(job.id)))
+        self.assertEqual(response.status, falcon.HTTP_FORBIDDEN)
+
+
+class TestJobLeases(TestAssetLifecycleBase):
+
+    def test_requeue_expired_jobs(self):
+        controller = JobController(self.session)
+        jobs = [controller.enqueue("rebuild_agreement", {"corpusId": 0}) for _ in range(3)]
+        self.session.commit()
+        for job in jobs:
+            self.assertIsNotNone(controller.claim_next_job())
+        self.assertEqual(controller.requeue_expired_jobs(), 0)
+
+        # The first two workers died, and the second was the job's last attempt
+        jobs[0].lease_expires = jobs[1].lease_expires = datetime.utcnow() - timedelta(seconds=1)
+        jobs[1].attempts = jobs[1].max_attempts
+        self.session.commit()
+        self.assertEqual(controller.requeue_expired_jobs(), 2)
+        self.assertEqual([j.state for j in jobs], ["queued", "failed", "running"])
+        self.assertGreater(jobs[0].run_after, jobs[0].started)
+        self.assertEqual(jobs[0].attempts, 1)
+
+
+class TestAssetScrubbing(TestAssetLifecycleBase):
+
+    def test_scrub_finds_corruption(self):
+        self.create_default_asset()
+        self.session.query(InternalJob).delete()
+        self.session.execute("UPDATE an_assets SET content = 'corrupted'::bytea")
+        self.session.commit()
+
+        schedule_scrubbing(self.session, 2)
+        schedule_scrubbing(self.session, 2)
+        self.assertEqual(self.session.query(InternalJob).count(), 2)
+        controller = JobController(self.session)
+        for _ in range(2):
+            self.assertTrue(controller.run_next_job())
+
+        asset = self.session.query(InternalAsset).one()
+        self.assertIsNotNone(asset.corrupted_on)
+        self.assertIsNone(asset.last_verified)
+        results = [j.result for j in self.session.query(InternalJob).filter_by(state="done")]
+        self.assertEqual(sorted(r["corrupt"] for r in results), [[], [asset.id]])
+        # Each shard's next pass waits for the interval
+        self.assertEqual(self.session.query(InternalJob).filter_by(state="queued").count(), 2)
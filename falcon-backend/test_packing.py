@@ -0,0 +1,45 @@
+from falcon import testing
+
+from packing import can_pack, pack, unpack, pack_response, unpack_response, MINIMUM_SEGMENTS
+
+
+def segmentation(segments, annotations):
+    return {"kind": "TimeSeriesSegmentationAnnotation", "source": "Human", "summaryCode": "WORDS",
+            "created": "2018-04-23T18:25:43.511000Z", "segments": segments, "annotations": annotations}
+
+
+class TestPacking(testing.TestCase):
+
+    def test_round_trip_float32(self):
+        segments = [i * 0.5 for i in range(100)]
+        annotations = ["hello", "world", "ハロー"] * 33 + [""]
+        packed = pack(segments, annotations)
+        self.assertEqual(unpack(packed), (segments, annotations))
+        # Halves are exact in float32, so four bytes a boundary
+        self.assertLess(len(packed), 100 * 4 + 100 * 2 + 64)
+
+    def test_round_trip_float64(self):
+        segments = [i * 0.1 for i in range(100)]
+        annotations = ["label{}".format(i) for i in range(70000)]
+        self.assertEqual(unpack(pack(segments, annotations)), (segments, annotations))
+
+    def test_round_trip_response(self):
+        response = segmentation([float(i) for i in range(MINIMUM_SEGMENTS)], ["a"] * MINIMUM_SEGMENTS)
+        self.assertTrue(can_pack(response))
+        rest, packed = pack_response(response)
+        self.assertNotIn("segments", rest)
+        self.assertDictEqual(unpack_response(rest, packed), response)
+
+    def test_can_pack(self):
+        n = MINIMUM_SEGMENTS
+        self.assertTrue(can_pack(segmentation([0.0] * n, ["a"] * n)))
+        self.assertFalse(can_pack(segmentation([0.0] * (n - 1), ["a"] * (n - 1))))
+        # Integers would come back as floats
+        self.assertFalse(can_pack(segmentation([0] * n, ["a"] * n)))
+        self.assertFalse(can_pack(segmentation([0.0] * n, [None] * n)))
+        self.assertFalse(can_pack(dict(segmentation([0.0] * n, ["a"] * n), kind="TextAnnotation")))
+        self.assertFalse(can_pack(None))
+
+    def test_rejects_other_data(self):
+        with self.assertRaises(ValueError):
+            unpack(b"XX" + bytes(32))
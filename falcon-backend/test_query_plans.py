@@ -0,0 +1,176 @@
+import json
+import re
+
+from sqlalchemy import event
+
+from main import TokenController, AssetController, AssignmentController, QuestionController
+from search import SearchController
+from models import InternalUser, InternalCorpus, InternalToken, InternalAssignment, InternalAsset
+from test_users import MyTestCase
+
+# Tables which grow with usage, and so must never be scanned sequentially on a hot path.
+LARGE_TABLES = {"an_user_tokens", "an_assets", "an_assignments", "an_assignments_assets_xref", "an_questions",
+                "an_assignment_history"}
+
+INDEX_SCANS = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+# Partitions of the Assignment tables are named <table>_c<corpus id>, or <table>_default
+PARTITION_SUFFIX = re.compile(r"_(c\d+|default)$")
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+class TestQueryPlans(MyTestCase):
+    """
+    Runs the controllers' queries against realistically-sized tables, and checks
+    that EXPLAIN picks an index for each of them.
+    """
+
+    # Enough rows that a sequential scan is never the cheapest plan for a selective lookup
+    fixture = "corpora"
+
+    def capture_statements(self, fn, *args):
+        """
+        Calls fn, returning each (statement, parameters) it sends to the database.
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                statements.append((statement, parameters))
+
+        event.listen(self.connection, "before_cursor_execute", before_cursor_execute)
+        try:
+            fn(*args)
+        finally:
+            event.remove(self.connection, "before_cursor_execute", before_cursor_execute)
+        return statements
+
+    def explain(self, statement: str, parameters, seqscan: bool = True) -> dict:
+        cursor = self.session.connection().connection.cursor()
+        cursor.execute("SET LOCAL enable_seqscan = " + ("on" if seqscan else "off"))
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
+    def assertUsesIndexes(self, fn, *args):
+        statements = self.capture_statements(fn, *args)
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            nodes = list(plan_nodes(self.explain(statement, parameters)))
+            # Default partitions should be empty, so scanning them is free
+            scanned = {PARTITION_SUFFIX.sub("", n["Relation Name"]) for n in nodes
+                       if n["Node Type"] == "Seq Scan" and not n["Relation Name"].endswith("_default")}
+            self.assertFalse(scanned & LARGE_TABLES, "Sequential scan of {} in: {}".format(
+                scanned & LARGE_TABLES, " ".join(statement.split())))
+            relations = {PARTITION_SUFFIX.sub("", n.get("Relation Name", "")) for n in nodes} & LARGE_TABLES
+            if relations:
+                self.assertTrue(INDEX_SCANS & {n["Node Type"] for n in nodes},
+                                "No index used in: {}".format(" ".join(statement.split())))
+
+    def assertIndexUsable(self, index_suffix: str, fn, *args):
+        """
+        Checks that an index ending in index_suffix can answer each query fn makes.
+        For predicates (like matching a tsvector) where the planner rightly prefers
+        a sequential scan at the seeded sizes.
+        """
+        statements = self.capture_statements(fn, *args)
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            nodes = list(plan_nodes(self.explain(statement, parameters, seqscan=False)))
+            self.assertTrue([n for n in nodes if n["Node Type"] == "Bitmap Index Scan"
+                             and n["Index Name"].endswith(index_suffix)],
+                            "{} not used in: {}".format(index_suffix, " ".join(statement.split())))
+            self.assertFalse([n for n in nodes if n["Node Type"] == "Seq Scan"
+                              and not n["Relation Name"].endswith("_default")])
+
+    def assertPrunedToCorpus(self, table: str, corpus: InternalCorpus, fn, *args):
+        """
+        Checks that each query fn makes only touches the Corpus' own partition of table.
+        """
+        for statement, parameters in self.capture_statements(fn, *args):
+            nodes = list(plan_nodes(self.explain(statement, parameters)))
+            partitions = {n["Relation Name"] for n in nodes
+                          if PARTITION_SUFFIX.sub("", n.get("Relation Name", "")) == table}
+            self.assertEqual(partitions, {"{}_c{}".format(table, corpus.id)})
+
+    def some_corpus(self) -> InternalCorpus:
+        return self.session.query(InternalCorpus).filter_by(name="corpus7").one()
+
+    def some_user(self) -> InternalUser:
+        return self.session.query(InternalUser).filter_by(username="user42").one()
+
+    def test_token_lookup(self):
+        token = self.session.query(InternalToken.token).filter_by(user_id=self.some_user().id).scalar()
+        controller = TokenController(self.session)
+        self.assertUsesIndexes(controller.get_user_from_token, token)
+        self.assertUsesIndexes(controller.check_token, token)
+        self.assertUsesIndexes(controller.get_token_for_user, self.some_user())
+
+    def test_asset_lookup(self):
+        controller = AssetController(self.session)
+        self.assertUsesIndexes(controller.get_asset_names, self.some_corpus())
+        self.assertUsesIndexes(controller.get_asset_with_corpus, self.some_corpus(), "asset7")
+
+    def test_assignment_lookup(self):
+        controller = AssignmentController(self.session)
+        corpus = self.some_corpus()
+        self.assertPrunedToCorpus("an_assignments", corpus,
+                                  lambda c: controller.retrieve_assignments_for_corpus(c).all(), corpus)
+        self.assertUsesIndexes(lambda u: controller.retrieve_assignments_for_user(u).all(), self.some_user().id)
+
+        # Selecting just the ID keeps the Assignment out of the identity map, so get() has to query
+        assignment_id = self.session.query(InternalAssignment.id).filter_by(corpus_id=corpus.id).first()[0]
+        self.assertUsesIndexes(controller.retrieve_assignment, assignment_id)
+        self.assertPrunedToCorpus("an_assignments", corpus, controller.retrieve_assignment, assignment_id, corpus.id)
+        self.assertUsesIndexes(controller.retrieve_assignment, assignment_id, corpus.id)
+
+    def test_assignment_asset_refs(self):
+        corpus = self.some_corpus()
+        assignment = self.session.query(InternalAssignment).filter_by(corpus_id=corpus.id).first()
+        self.assertPrunedToCorpus("an_assignments_assets_xref", corpus, lambda: assignment.asset_refs)
+        self.session.expire(assignment, ["asset_refs"])
+        self.assertUsesIndexes(lambda: assignment.asset_refs)
+        asset = self.session.query(InternalAsset).filter_by(corpus_id=self.some_corpus().id).first()
+        self.assertUsesIndexes(lambda: asset.assignment_refs)
+
+    def test_question_lookup(self):
+        controller = QuestionController(self.session)
+        self.assertUsesIndexes(controller.retrieve_questions, self.some_corpus())
+        content = {"humanPrompt": "Transcribe prompt7"}
+        self.assertUsesIndexes(controller.find_question, self.some_corpus(), content)
+        self.assertIsNotNone(controller.find_question(self.some_corpus(), content))
+
+    def test_asset_metadata_query(self):
+        controller = AssetController(self.session)
+        corpus = self.some_corpus()
+        speaker = self.session.query(InternalAsset.user_metadata).filter_by(corpus_id=corpus.id).first()[0]["speaker"]
+        self.assertUsesIndexes(controller.query_assets, corpus, {"speaker": speaker})
+        self.assertUsesIndexes(controller.query_assets, corpus, None, '$.speaker ? (@ == "{}")'.format(speaker))
+
+        assets = controller.query_assets(corpus, {"speaker": speaker})
+        self.assertEqual(len(assets), 20)
+        self.assertEqual(controller.query_assets(corpus, {"speaker": speaker}, None, assets[9][0], 5), assets[10:15])
+
+        short = controller.query_assets(corpus, {"speaker": speaker}, '$.duration ? (@ < 30)')
+        durations = dict(self.session.query(InternalAsset.id, InternalAsset.user_metadata["duration"])
+                         .filter(InternalAsset.id.in_([id for id, _ in assets])))
+        self.assertEqual([id for id, _ in short], [id for id, _ in assets if int(durations[id]) < 30])
+
+    def test_search(self):
+        controller = SearchController(self.session)
+        corpus = self.some_corpus()
+        self.assertIndexUsable("_search_idx", controller.search, "prompt7")
+        for table in ["an_assignments", "an_assignment_history"]:
+            self.assertPrunedToCorpus(table, corpus, controller.search, "label7", None, corpus.id)
+
+        results = controller.search("prompt7", None, corpus.id)
+        self.assertEqual([(kind, name) for kind, _, name, _ in results], [("question", "corpus7")])
+        results = controller.search("label7", ["responses"], None, 1000)
+        self.assertEqual(len(results), 100)
@@ -45,3 +45,30 @@ class TestQuestion(TestAssetLifecycleWithDefaultFileBase):
         response = self.simulate_get("/corpus/test_corpus/questions")
         self.assertFalse(inserted_id in response.json)
 
+    def test_question_not_modified(self):
+        question = Question.from_json({
+            "created": "2018-04-23T18:25:43.511000Z",
+            "summaryCode": "WORDS",
+            "humanPrompt": "Divide this audio file into words",
+            "kind": "TimeSeriesSegmentationQuestion",
+            "annotationInstructions": "Click between each word",
+            "detailedAnnotationInstructions": "So much more to say",
+            "maximumSegments": 5,
+            "minimumSegments": 1,
+            "segmentChoices": ["hi", "world"],
+            "freeFormAllowed": True,
+            "assets": None,
+        })
+        response = self.simulate_post("/corpus/test_corpus/questions", json=question.to_json())
+        inserted_id = response.json["insertedId"]
+
+        response = self.simulate_get("/corpus/test_corpus/questions/{}".format(inserted_id))
+        etag = response.headers["etag"]
+        response = self.simulate_get("/corpus/test_corpus/questions/{}".format(inserted_id),
+                                     headers={"If-None-Match": etag})
+        self.assertEqual(response.status, falcon.HTTP_NOT_MODIFIED)
+
+        self.simulate_delete("/corpus/test_corpus/questions/{}".format(inserted_id))
+        response = self.simulate_get("/corpus/test_corpus/questions/{}".format(inserted_id),
+                                     headers={"If-None-Match": etag})
+        self.assertEqual(response.status, falcon.HTTP_NOT_FOUND)
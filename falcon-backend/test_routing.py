@@ -0,0 +1,46 @@
+from falcon import testing
+from sqlalchemy import create_engine, select, literal
+from sqlalchemy.sql import delete
+
+from models import InternalToken
+from routing import ReplicaRouter, RoutingSession
+
+
+class TestReplicaRouting(testing.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.primary = create_engine("sqlite://")
+        self.replicas = [create_engine("sqlite://"), create_engine("sqlite://")]
+        self.router = ReplicaRouter(self.replicas, sticky_seconds=60)
+
+    def test_sessions_use_primary_by_default(self):
+        session = RoutingSession(bind=self.primary, router=self.router)
+        self.assertIs(session.get_bind(clause=select([literal(1)])), self.primary)
+
+    def test_replica_session_sends_writes_to_primary(self):
+        session = RoutingSession(bind=self.primary, router=self.router)
+        session.use_replica()
+        self.assertIn(session.get_bind(clause=select([literal(1)])), self.replicas)
+        self.assertIs(session.get_bind(clause=delete(InternalToken.__table__)), self.primary)
+
+    def test_replicas_are_chosen_round_robin(self):
+        self.assertEqual([self.router.choose_replica() for _ in range(4)], self.replicas * 2)
+
+    def test_no_replicas_means_primary(self):
+        session = RoutingSession(bind=self.primary, router=ReplicaRouter([]))
+        session.use_replica()
+        self.assertIs(session.get_bind(clause=select([literal(1)])), self.primary)
+
+    def test_writes_are_sticky_until_caught_up(self):
+        self.assertIsNone(self.router.pending_write(1))
+        self.router.mark_write(1, "0/3000060")
+        self.assertEqual(self.router.pending_write(1), "0/3000060")
+        self.assertIsNone(self.router.pending_write(2))
+        self.router.caught_up(1)
+        self.assertIsNone(self.router.pending_write(1))
+
+    def test_stickiness_expires(self):
+        self.router.sticky_seconds = -1
+        self.router.mark_write(1, "0/3000060")
+        self.assertIsNone(self.router.pending_write(1))
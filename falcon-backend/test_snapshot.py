@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+
+import psycopg2.extensions
+
+import snapshot
+from snapshot import ChunkStore, take_snapshot, restore_snapshot, TABLES
+from test_users import MyTestCase
+
+SEED_STATEMENTS = """
+    INSERT INTO an_users (username, email, password, role, random_seed)
+      SELECT 'user' || i, 'user' || i || '@example.com', '\\x00', 'Annotator', 'seed' || i
+      FROM generate_series(1, 3) AS i;
+    INSERT INTO an_corpora (name) VALUES ('kept'), ('other');
+    INSERT INTO an_assets (name, content, checksum, mime_type, type_description, corpus_id, uploader_id,
+                           user_metadata)
+      SELECT 'asset' || i, convert_to(repeat('content' || i, 1000), 'utf8'), 'x', 'text/plain', 'UTF8_TEXT',
+             c.id, (SELECT min(id) FROM an_users), jsonb_build_object('index', i)
+      FROM an_corpora c, generate_series(1, 5) AS i;
+    INSERT INTO an_questions (kind, content, summary_code, creator_id, corpus_id)
+      SELECT 'TextQuestion', '{"humanPrompt": "Say something"}', 'CODE', (SELECT min(id) FROM an_users), id
+      FROM an_corpora;
+    INSERT INTO an_assignments (summary_code, assigned_user_id, annotator_id, corpus_id, question_id)
+      SELECT 'CODE', (SELECT min(id) FROM an_users), (SELECT min(id) FROM an_users), corpus_id, id
+      FROM an_questions;
+    INSERT INTO an_assignments_assets_xref (assignment_id, corpus_id, asset_id)
+      SELECT a.id, a.corpus_id, s.id FROM an_assignments a JOIN an_assets s ON s.corpus_id = a.corpus_id;
+    INSERT INTO an_assignment_history (assignment_id, corpus_id, updating_user_id, updated_on, state, notes)
+      SELECT id, corpus_id, annotator_id, now(), 'Submitted', 'Looks fine' FROM an_assignments;
+"""
+
+
+class TestSnapshot(MyTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.connection.execute(SEED_STATEMENTS)
+        self.archive = tempfile.mkdtemp()
+        self.raw = self.connection.connection
+
+    def tearDown(self):
+        shutil.rmtree(self.archive)
+        super().tearDown()
+
+    def count_chunks(self):
+        return sum(len(files) for _, _, files in os.walk(os.path.join(self.archive, "chunks")))
+
+    def dump(self, table):
+        columns = ", ".join(name for name, _ in snapshot.table_columns(self.raw.cursor(), table))
+        return self.connection.execute("SELECT {} FROM {} ORDER BY id".format(columns, table)).fetchall()
+
+    def test_chunk_store(self):
+        store = ChunkStore(self.archive)
+        data = os.urandom(snapshot.CHUNK_SIZE + 10)
+        digests = store.put_blob(data)
+        self.assertEqual(len(digests), 2)
+        self.assertEqual(store.get_blob(digests), data)
+        self.assertEqual(store.put_blob(data), digests)
+        self.assertEqual(self.count_chunks(), 2)
+
+    def test_workers_share_snapshot(self):
+        self.trans.commit()
+        connection = self.engine.raw_connection()
+        name = take_snapshot(connection, self.archive, ["kept"], database_url=str(self.engine.url), processes=2)
+        # The read-only transaction it opened is over
+        self.assertEqual(connection.get_transaction_status(), psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        connection.close()
+
+        store = ChunkStore(self.archive)
+        rows = [row for entry in store.read_manifest(name)["tables"] if entry["table"] == "an_assets"
+                for digest in entry["batches"] for row in store.get_rows(digest)]
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(row["content"] for row in rows))
+
+    def test_snapshot_and_restore(self):
+        first = take_snapshot(self.raw, self.archive, ["kept"])
+        chunks = self.count_chunks()
+        # Nothing's changed, so the second snapshot only adds its manifest
+        second = take_snapshot(self.raw, self.archive, ["kept"])
+        self.assertEqual(self.count_chunks(), chunks)
+        self.assertEqual(ChunkStore(self.archive).read_manifest(second)["parent"], first)
+
+        kept = self.connection.execute("SELECT id FROM an_corpora WHERE name = 'kept'").scalar()
+        expected = {table: self.dump(table) for table, _ in TABLES}
+        for table, _ in reversed(TABLES):
+            self.connection.execute("DELETE FROM {}".format(table))
+
+        counts = restore_snapshot(self.raw, self.archive)
+        self.assertEqual(counts["an_assets"], 5)
+        self.assertEqual(self.dump("an_users"), expected["an_users"])
+        self.assertEqual(self.dump("an_corpora"), [r for r in expected["an_corpora"] if r["id"] == kept])
+        for table in ["an_assets", "an_questions", "an_assignments", "an_assignments_assets_xref",
+                      "an_assignment_history"]:
+            self.assertEqual(self.dump(table), [r for r in expected[table] if r["corpus_id"] == kept])
+        # Search vectors are recomputed by the triggers
+        self.assertEqual(self.connection.execute(
+            "SELECT COUNT(*) FROM an_assignment_history WHERE search_vector @@ to_tsquery('fine')").scalar(), 1)
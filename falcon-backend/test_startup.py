@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+
+from falcon import testing
+
+from config import load_settings, DEFAULT_DATABASE_URL
+
+# Seconds a fresh interpreter may take to import main. Most of it is falcon and SQLAlchemy.
+IMPORT_BUDGET = 1.0
+
+# Only needed once a request comes in
+DEFERRED_MODULES = ["Crypto", "bcrypt"]
+
+MEASURE_IMPORT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+print(json.dumps({"seconds": time.perf_counter() - started, "app_created": main._app is not None,
+                  "imported": [m for m in %r if m in sys.modules]}))
+"""
+
+# Creating the app mustn't start processes either (the hashing pool waits for a large batch)
+MEASURE_APP = """
+import json, multiprocessing
+import main
+main.get_app()
+print(json.dumps({"hash_pool": main._hash_pool is not None, "children": len(multiprocessing.active_children())}))
+"""
+
+
+class TestStartup(testing.TestCase):
+
+    def test_import_budget(self):
+        output = subprocess.check_output([sys.executable, "-c", MEASURE_IMPORT % DEFERRED_MODULES],
+                                         cwd=os.path.dirname(os.path.realpath(__file__)))
+        measured = json.loads(output.decode("utf8").strip().split("\n")[-1])
+        self.assertFalse(measured["app_created"])
+        self.assertEqual(measured["imported"], [])
+        self.assertLess(measured["seconds"], IMPORT_BUDGET)
+
+    def test_app_starts_no_processes(self):
+        output = subprocess.check_output([sys.executable, "-c", MEASURE_APP],
+                                         cwd=os.path.dirname(os.path.realpath(__file__)),
+                                         env=dict(os.environ, ANNOTATRON_HASH_PROCESSES="2"))
+        measured = json.loads(output.decode("utf8").strip().split("\n")[-1])
+        self.assertEqual(measured, {"hash_pool": False, "children": 0})
+
+    def test_settings(self):
+        settings = load_settings({})
+        self.assertEqual(settings.database_url, DEFAULT_DATABASE_URL)
+        self.assertEqual(settings.replica_urls, [])
+        self.assertFalse(settings.sql_echo)
+
+        settings = load_settings({"ANNOTATRON_DATABASE_URL": "postgresql+psycopg2://db/annotatron",
+                                  "ANNOTATRON_REPLICAS": "postgresql+psycopg2://r1/a, postgresql+psycopg2://r2/a,",
+                                  "ANNOTATRON_SQL_ECHO": "True", "ANNOTATRON_PORT": "9000",
+                                  "ANNOTATRON_HASH_PROCESSES": "0"})
+        self.assertEqual(settings.database_url, "postgresql+psycopg2://db/annotatron")
+        self.assertEqual(settings.replica_urls, ["postgresql+psycopg2://r1/a", "postgresql+psycopg2://r2/a"])
+        self.assertTrue(settings.sql_echo)
+        self.assertEqual(settings.port, 9000)
+        self.assertEqual(settings.hash_processes, 0)
@@ -0,0 +1,78 @@
+package main
+
+import (
+	"encoding/json"
+	"log"
+	"strconv"
+	"time"
+
+	"github.com/lib/pq"
+)
+
+// AssignmentEventChannel must match AssignmentController.EVENT_CHANNEL in the backend.
+const AssignmentEventChannel = "an_assignment_events"
+
+// AssignmentEvent is the NOTIFY payload published by AssignmentController.publish_event.
+// Assignments created in bulk are announced with one event per user instead, carrying
+// Count and AssignedCount rather than an AssignmentId (see publish_created_counts).
+type AssignmentEvent struct {
+	Event          string `json:"event"`
+	UserId         uint64 `json:"userId"`
+	AssignmentId   uint64 `json:"assignmentId"`
+	AssignedToUser bool   `json:"assignedToUser"`
+	State          string `json:"state"`
+	Count          int    `json:"count"`
+	AssignedCount  int    `json:"assignedCount"`
+}
+
+// AssignmentEventMessage tells the client that one of its Assignments (or, with a count,
+// several new ones) has changed, so that it doesn't need to poll /assignments/byUser.
+type AssignmentEventMessage struct {
+	Response
+	Event          string `json:"event"`
+	AssignmentId   uint64 `json:"assignment_id,omitempty"`
+	AssignedToUser bool   `json:"assigned_to_user"`
+	State          string `json:"state,omitempty"`
+	Count          int    `json:"count,omitempty"`
+	AssignedCount  int    `json:"assigned_count,omitempty"`
+}
+
+// ListenForAssignmentEvents forwards each event to the sockets of the user it's addressed to.
+// The listener reconnects by itself if the database goes away.
+func ListenForAssignmentEvents(dsn string) {
+	listener := pq.NewListener(dsn, 10*time.Second, time.Minute, func(ev pq.ListenerEventType, err error) {
+		if err != nil {
+			log.Println("Event listener: ", err)
+		}
+	})
+	if err := listener.Listen(AssignmentEventChannel); err != nil {
+		log.Println("Failed to LISTEN for Assignment events: ", err)
+		return
+	}
+
+	for {
+		select {
+		case n := <-listener.Notify:
+			if n == nil {
+				// Connection was re-established, events in between were lost
+				continue
+			}
+			var event AssignmentEvent
+			if err := json.Unmarshal([]byte(n.Extra), &event); err != nil {
+				log.Println("Failed to parse Assignment event: ", err)
+				continue
+			}
+			registry.SendToUser(strconv.FormatUint(event.UserId, 10), AssignmentEventMessage{
+				Response{"assignment"},
+				event.Event,
+				event.AssignmentId,
+				event.AssignedToUser || event.AssignedCount > 0,
+				event.State,
+				event.Count,
+				event.AssignedCount,
+			})
+		case <-time.After(90 * time.Second):
+			go listener.Ping()
+		}
+	}
+}
@@ -0,0 +1,208 @@
+// Command loadtest opens a large number of annotator sockets against shuttler,
+// publishes Assignment events through Postgres and reports how many arrive and
+// how long they take.
+//
+// Each line of the -credentials file is "token,userId", where userId is the
+// obfuscated ID the backend's /auth/whoAmI redirects to. Sockets cycle through
+// the credentials, so a handful of users can stand in for thousands of sockets.
+// Remember to raise the open file limit (ulimit -n) on both ends beforehand.
+package main
+
+import (
+	"bufio"
+	"database/sql"
+	"encoding/json"
+	"flag"
+	"fmt"
+	"log"
+	"math/rand"
+	"os"
+	"sort"
+	"strings"
+	"sync"
+	"sync/atomic"
+	"time"
+
+	"github.com/gorilla/websocket"
+	_ "github.com/lib/pq"
+)
+
+var url = flag.String("url", "ws://localhost:9002/ws", "Shuttler websocket endpoint")
+var credentialsFile = flag.String("credentials", "credentials.csv", "token,userId pairs, one per line")
+var clients = flag.Int("clients", 10000, "Number of sockets to open")
+var rampUp = flag.Duration("ramp-up", 30*time.Second, "Time over which to open the sockets")
+var duration = flag.Duration("duration", time.Minute, "How long to publish events for once connected")
+var database = flag.String("database", "", "Postgres connection string; if set, events are published with pg_notify")
+var eventsPerSecond = flag.Int("events-per-second", 100, "Rate at which events are published")
+
+type credential struct {
+	token  string
+	userId string
+}
+
+type stats struct {
+	connected     int64
+	authFailures  int64
+	dialFailures  int64
+	disconnected  int64
+	received      int64
+	published     int64
+	latencyLock   sync.Mutex
+	latencies     []time.Duration
+	socketsByUser map[string]int64
+}
+
+func readCredentials(path string) ([]credential, error) {
+	f, err := os.Open(path)
+	if err != nil {
+		return nil, err
+	}
+	defer f.Close()
+	var ret []credential
+	scanner := bufio.NewScanner(f)
+	for scanner.Scan() {
+		parts := strings.SplitN(strings.TrimSpace(scanner.Text()), ",", 2)
+		if len(parts) == 2 {
+			ret = append(ret, credential{parts[0], parts[1]})
+		}
+	}
+	return ret, scanner.Err()
+}
+
+func runClient(c credential, s *stats, stop chan struct{}, wg *sync.WaitGroup) {
+	defer wg.Done()
+	conn, _, err := websocket.DefaultDialer.Dial(*url, nil)
+	if err != nil {
+		atomic.AddInt64(&s.dialFailures, 1)
+		return
+	}
+	defer conn.Close()
+
+	auth := map[string]interface{}{"kind": "authentication", "payload": map[string]string{"string": c.token}}
+	if err := conn.WriteJSON(auth); err != nil {
+		atomic.AddInt64(&s.authFailures, 1)
+		return
+	}
+	var authResponse struct {
+		Successful bool `json:"sucessful"`
+	}
+	if err := conn.ReadJSON(&authResponse); err != nil || !authResponse.Successful {
+		atomic.AddInt64(&s.authFailures, 1)
+		return
+	}
+	atomic.AddInt64(&s.connected, 1)
+
+	go func() {
+		<-stop
+		conn.Close()
+	}()
+
+	for {
+		var event struct {
+			Kind         string `json:"kind"`
+			AssignmentId uint64 `json:"assignment_id"`
+		}
+		if err := conn.ReadJSON(&event); err != nil {
+			select {
+			case <-stop:
+			default:
+				atomic.AddInt64(&s.disconnected, 1)
+			}
+			return
+		}
+		if event.Kind != "assignment" {
+			continue
+		}
+		// The publisher puts its send time (in nanoseconds) where the Assignment ID would go
+		latency := time.Since(time.Unix(0, int64(event.AssignmentId)))
+		atomic.AddInt64(&s.received, 1)
+		s.latencyLock.Lock()
+		s.latencies = append(s.latencies, latency)
+		s.latencyLock.Unlock()
+	}
+}
+
+func publishEvents(db *sql.DB, users []string, s *stats, stop chan struct{}) {
+	ticker := time.NewTicker(time.Second / time.Duration(*eventsPerSecond))
+	defer ticker.Stop()
+	for {
+		select {
+		case <-stop:
+			return
+		case <-ticker.C:
+			userId := users[rand.Intn(len(users))]
+			var numericId uint64
+			fmt.Sscanf(userId, "%d", &numericId)
+			payload, _ := json.Marshal(map[string]interface{}{
+				"event":        "created",
+				"userId":       numericId,
+				"assignmentId": uint64(time.Now().UnixNano()),
+				"state":        "created",
+			})
+			if _, err := db.Exec("SELECT pg_notify('an_assignment_events', $1)", string(payload)); err != nil {
+				log.Println("Failed to publish: ", err)
+				continue
+			}
+			atomic.AddInt64(&s.published, int64(s.socketsByUser[userId]))
+		}
+	}
+}
+
+func percentile(sorted []time.Duration, p float64) time.Duration {
+	if len(sorted) == 0 {
+		return 0
+	}
+	return sorted[int(float64(len(sorted)-1)*p)]
+}
+
+func main() {
+	flag.Parse()
+	credentials, err := readCredentials(*credentialsFile)
+	if err != nil || len(credentials) == 0 {
+		log.Fatal("Need at least one credential: ", err)
+	}
+
+	s := &stats{socketsByUser: make(map[string]int64)}
+	stop := make(chan struct{})
+	var wg sync.WaitGroup
+
+	start := time.Now()
+	interval := *rampUp / time.Duration(*clients)
+	for i := 0; i < *clients; i++ {
+		c := credentials[i%len(credentials)]
+		s.socketsByUser[c.userId]++
+		wg.Add(1)
+		go runClient(c, s, stop, &wg)
+		time.Sleep(interval)
+	}
+	log.Printf("Opened %d sockets in %s (%d connected, %d dial failures, %d auth failures)",
+		*clients, time.Since(start), atomic.LoadInt64(&s.connected),
+		atomic.LoadInt64(&s.dialFailures), atomic.LoadInt64(&s.authFailures))
+
+	publisherStop := make(chan struct{})
+	if *database != "" {
+		db, err := sql.Open("postgres", *database)
+		if err != nil {
+			log.Fatal(err)
+		}
+		users := make([]string, 0, len(s.socketsByUser))
+		for u := range s.socketsByUser {
+			users = append(users, u)
+		}
+		go publishEvents(db, users, s, publisherStop)
+	}
+
+	time.Sleep(*duration)
+	close(publisherStop)
+	// Give in-flight events a moment to land
+	time.Sleep(2 * time.Second)
+	close(stop)
+	wg.Wait()
+
+	sort.Slice(s.latencies, func(i, j int) bool { return s.latencies[i] < s.latencies[j] })
+	fmt.Printf("sockets connected:   %d/%d\n", s.connected, *clients)
+	fmt.Printf("dropped mid-test:    %d\n", s.disconnected)
+	fmt.Printf("events delivered:    %d/%d\n", s.received, s.published)
+	fmt.Printf("delivery latency:    p50=%s p95=%s p99=%s\n",
+		percentile(s.latencies, 0.5), percentile(s.latencies, 0.95), percentile(s.latencies, 0.99))
+}
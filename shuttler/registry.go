@@ -0,0 +1,256 @@
+package main
+
+import (
+	"encoding/json"
+	"hash/fnv"
+	"log"
+	"sync"
+	"sync/atomic"
+	"time"
+
+	"github.com/gorilla/websocket"
+)
+
+// DropPolicy decides what happens when a client's send queue is full.
+type DropPolicy int
+
+const (
+	// DropNewest discards the message that didn't fit, keeping the client connected.
+	DropNewest DropPolicy = iota
+	// DisconnectSlow closes clients which can't keep up; they'll reconnect and refetch.
+	DisconnectSlow
+)
+
+func ParseDropPolicy(s string) DropPolicy {
+	if s == "disconnect" {
+		return DisconnectSlow
+	}
+	return DropNewest
+}
+
+// Socket is the part of *websocket.Conn the writer goroutine needs.
+type Socket interface {
+	WriteMessage(messageType int, data []byte) error
+	SetWriteDeadline(t time.Time) error
+	Close() error
+}
+
+// Client is a single connected socket. Everything written to it goes through its
+// buffered send queue and is drained by its own writer goroutine, so a slow client
+// only ever blocks itself.
+type Client struct {
+	Id     int
+	Token  string
+	UserId string
+
+	socket    Socket
+	send      chan []byte
+	done      chan struct{}
+	closeOnce sync.Once
+	dropped   uint64
+}
+
+// Enqueue queues a message for the writer goroutine without blocking.
+// Returns false if the message was dropped.
+func (c *Client) Enqueue(message []byte, policy DropPolicy) bool {
+	select {
+	case <-c.done:
+		return false
+	default:
+	}
+	select {
+	case c.send <- message:
+		return true
+	default:
+		atomic.AddUint64(&c.dropped, 1)
+		if policy == DisconnectSlow {
+			log.Printf("Disconnecting slow client %d (send queue full)", c.Id)
+			c.Close()
+		}
+		return false
+	}
+}
+
+// EnqueueJSON marshals and queues a message.
+func (c *Client) EnqueueJSON(message interface{}, policy DropPolicy) error {
+	rawBytes, err := json.Marshal(message)
+	if err != nil {
+		return err
+	}
+	c.Enqueue(rawBytes, policy)
+	return nil
+}
+
+// Close stops the writer and closes the socket. Safe to call more than once.
+func (c *Client) Close() {
+	c.closeOnce.Do(func() {
+		close(c.done)
+		c.socket.Close()
+	})
+}
+
+// Dropped returns how many messages were discarded because the queue was full.
+func (c *Client) Dropped() uint64 {
+	return atomic.LoadUint64(&c.dropped)
+}
+
+func (c *Client) writeLoop(writeTimeout time.Duration) {
+	defer c.Close()
+	for {
+		select {
+		case <-c.done:
+			return
+		case message := <-c.send:
+			c.socket.SetWriteDeadline(time.Now().Add(writeTimeout))
+			if err := c.socket.WriteMessage(websocket.TextMessage, message); err != nil {
+				log.Printf("Failed writing to client %d: %s", c.Id, err)
+				return
+			}
+		}
+	}
+}
+
+type registryShard struct {
+	lock    sync.RWMutex
+	clients map[int]*Client
+	byUser  map[string]map[int]*Client
+}
+
+// Registry tracks authenticated clients. Clients are sharded by user, so that
+// registration and per-user pushes only contend with users in the same shard.
+type Registry struct {
+	shards       []*registryShard
+	nextId       int64
+	queueSize    int
+	writeTimeout time.Duration
+	Policy       DropPolicy
+}
+
+func NewRegistry(shardCount int, queueSize int, writeTimeout time.Duration, policy DropPolicy) *Registry {
+	r := &Registry{
+		shards:       make([]*registryShard, shardCount),
+		queueSize:    queueSize,
+		writeTimeout: writeTimeout,
+		Policy:       policy,
+	}
+	for i := range r.shards {
+		r.shards[i] = &registryShard{
+			clients: make(map[int]*Client),
+			byUser:  make(map[string]map[int]*Client),
+		}
+	}
+	return r
+}
+
+func (r *Registry) shardFor(userId string) *registryShard {
+	h := fnv.New32a()
+	h.Write([]byte(userId))
+	return r.shards[h.Sum32()%uint32(len(r.shards))]
+}
+
+// NewClient wraps a socket and starts its writer. The client isn't registered
+// (and won't receive pushes) until it has authenticated.
+func (r *Registry) NewClient(socket Socket) *Client {
+	c := &Client{
+		Id:     int(atomic.AddInt64(&r.nextId, 1)),
+		socket: socket,
+		send:   make(chan []byte, r.queueSize),
+		done:   make(chan struct{}),
+	}
+	go c.writeLoop(r.writeTimeout)
+	return c
+}
+
+// Register makes an authenticated client reachable through SendToUser and Broadcast.
+// A client which authenticates again is moved, rather than staying registered
+// (possibly in another shard) under the user it authenticated as before.
+func (r *Registry) Register(c *Client, token string, userId string) {
+	r.remove(c)
+	shard := r.shardFor(userId)
+	shard.lock.Lock()
+	defer shard.lock.Unlock()
+	c.Token = token
+	c.UserId = userId
+	shard.clients[c.Id] = c
+	if shard.byUser[userId] == nil {
+		shard.byUser[userId] = make(map[int]*Client)
+	}
+	shard.byUser[userId][c.Id] = c
+}
+
+// Deregister removes the client (if registered) and closes it.
+func (r *Registry) Deregister(c *Client) {
+	r.remove(c)
+	c.Close()
+}
+
+// remove takes the client out of the shard it's registered in, if any.
+func (r *Registry) remove(c *Client) {
+	if c.UserId == "" {
+		return
+	}
+	shard := r.shardFor(c.UserId)
+	shard.lock.Lock()
+	defer shard.lock.Unlock()
+	delete(shard.clients, c.Id)
+	if userClients, ok := shard.byUser[c.UserId]; ok {
+		delete(userClients, c.Id)
+		if len(userClients) == 0 {
+			delete(shard.byUser, c.UserId)
+		}
+	}
+	c.UserId = ""
+}
+
+// SendToUser queues a message on every socket the given user has authenticated.
+func (r *Registry) SendToUser(userId string, message interface{}) error {
+	rawBytes, err := json.Marshal(message)
+	if err != nil {
+		return err
+	}
+	shard := r.shardFor(userId)
+	shard.lock.RLock()
+	targets := make([]*Client, 0, len(shard.byUser[userId]))
+	for _, c := range shard.byUser[userId] {
+		targets = append(targets, c)
+	}
+	shard.lock.RUnlock()
+
+	for _, c := range targets {
+		c.Enqueue(rawBytes, r.Policy)
+	}
+	return nil
+}
+
+// Broadcast queues a message on every registered socket. The message is encoded once,
+// and each shard is only read-locked while its clients are collected.
+func (r *Registry) Broadcast(message interface{}) error {
+	rawBytes, err := json.Marshal(message)
+	if err != nil {
+		return err
+	}
+	for _, shard := range r.shards {
+		shard.lock.RLock()
+		targets := make([]*Client, 0, len(shard.clients))
+		for _, c := range shard.clients {
+			targets = append(targets, c)
+		}
+		shard.lock.RUnlock()
+
+		for _, c := range targets {
+			c.Enqueue(rawBytes, r.Policy)
+		}
+	}
+	return nil
+}
+
+// Count returns the number of registered clients.
+func (r *Registry) Count() int {
+	total := 0
+	for _, shard := range r.shards {
+		shard.lock.RLock()
+		total += len(shard.clients)
+		shard.lock.RUnlock()
+	}
+	return total
+}
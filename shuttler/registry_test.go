@@ -0,0 +1,143 @@
+package main
+
+import (
+	"fmt"
+	"sync"
+	"sync/atomic"
+	"testing"
+	"time"
+)
+
+// fakeSocket counts writes, optionally blocking each one until released.
+type fakeSocket struct {
+	writes  int64
+	blocked chan struct{}
+	closed  int32
+}
+
+func (s *fakeSocket) WriteMessage(messageType int, data []byte) error {
+	if s.blocked != nil {
+		<-s.blocked
+	}
+	atomic.AddInt64(&s.writes, 1)
+	return nil
+}
+
+func (s *fakeSocket) SetWriteDeadline(t time.Time) error { return nil }
+
+func (s *fakeSocket) Close() error {
+	atomic.StoreInt32(&s.closed, 1)
+	return nil
+}
+
+func waitFor(t testing.TB, condition func() bool) {
+	deadline := time.Now().Add(5 * time.Second)
+	for !condition() {
+		if time.Now().After(deadline) {
+			t.Fatal("timed out")
+		}
+		time.Sleep(time.Millisecond)
+	}
+}
+
+func TestSendToUserOnlyReachesThatUser(t *testing.T) {
+	r := NewRegistry(4, 8, time.Second, DropNewest)
+	a, b := &fakeSocket{}, &fakeSocket{}
+	r.Register(r.NewClient(a), "tokenA", "1")
+	r.Register(r.NewClient(b), "tokenB", "2")
+
+	r.SendToUser("1", map[string]string{"kind": "assignment"})
+	waitFor(t, func() bool { return atomic.LoadInt64(&a.writes) == 1 })
+	if atomic.LoadInt64(&b.writes) != 0 {
+		t.Fatal("message delivered to the wrong user")
+	}
+}
+
+func TestReauthenticationMovesClient(t *testing.T) {
+	r := NewRegistry(64, 8, time.Second, DropNewest)
+	socket := &fakeSocket{}
+	c := r.NewClient(socket)
+	r.Register(c, "tokenA", "1")
+	r.Register(c, "tokenB", "2")
+	if r.Count() != 1 {
+		t.Fatalf("expected 1 registered client, got %d", r.Count())
+	}
+
+	r.SendToUser("1", map[string]string{"kind": "assignment"})
+	r.SendToUser("2", map[string]string{"kind": "assignment"})
+	waitFor(t, func() bool { return atomic.LoadInt64(&socket.writes) == 1 })
+	time.Sleep(10 * time.Millisecond)
+	if atomic.LoadInt64(&socket.writes) != 1 {
+		t.Fatal("message delivered for the user the client authenticated as before")
+	}
+
+	r.Deregister(c)
+	if r.Count() != 0 {
+		t.Fatalf("expected no registered clients, got %d", r.Count())
+	}
+}
+
+func TestSlowClientDoesNotBlockOthers(t *testing.T) {
+	r := NewRegistry(4, 2, time.Second, DropNewest)
+	slow := &fakeSocket{blocked: make(chan struct{})}
+	slowClient := r.NewClient(slow)
+	r.Register(slowClient, "slow", "1")
+	fast := &fakeSocket{}
+	r.Register(r.NewClient(fast), "fast", "2")
+
+	// The slow client never finishes a write, but the fast one keeps receiving
+	for i := 0; i < 10; i++ {
+		r.Broadcast(i)
+		waitFor(t, func() bool { return atomic.LoadInt64(&fast.writes) == int64(i+1) })
+	}
+	if slowClient.Dropped() == 0 {
+		t.Fatal("expected the slow client's queue to overflow")
+	}
+	close(slow.blocked)
+}
+
+func TestDisconnectPolicyClosesSlowClient(t *testing.T) {
+	r := NewRegistry(4, 1, time.Second, DisconnectSlow)
+	slow := &fakeSocket{blocked: make(chan struct{})}
+	r.Register(r.NewClient(slow), "slow", "1")
+
+	for i := 0; i < 5; i++ {
+		r.SendToUser("1", i)
+	}
+	waitFor(t, func() bool { return atomic.LoadInt32(&slow.closed) == 1 })
+	close(slow.blocked)
+}
+
+// BenchmarkBroadcast10k measures fanning one message out to 10,000 registered sockets
+// while other goroutines register and deregister clients.
+func BenchmarkBroadcast10k(b *testing.B) {
+	r := NewRegistry(64, 64, time.Second, DropNewest)
+	for i := 0; i < 10000; i++ {
+		r.Register(r.NewClient(&fakeSocket{}), "token", fmt.Sprintf("%d", i))
+	}
+
+	stop := make(chan struct{})
+	var churn sync.WaitGroup
+	churn.Add(1)
+	go func() {
+		defer churn.Done()
+		for i := 0; ; i++ {
+			select {
+			case <-stop:
+				return
+			default:
+			}
+			c := r.NewClient(&fakeSocket{})
+			r.Register(c, "churn", fmt.Sprintf("churn-%d", i))
+			r.Deregister(c)
+		}
+	}()
+
+	b.ResetTimer()
+	for i := 0; i < b.N; i++ {
+		r.Broadcast(i)
+	}
+	b.StopTimer()
+	close(stop)
+	churn.Wait()
+}